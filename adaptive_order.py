@@ -0,0 +1,111 @@
+import os
+from typing import Dict, List
+
+from asm_grammar_spec import AsmGrammarSpec
+from spec_analysis import RowConflicts
+
+# This module implements adaptive reordering of the rows of instruction definitions, enabled with '--adaptive-order'.
+# The parser normally tries the rows of a definition top to bottom, in the order the spec author wrote them. In adaptive
+# mode, it counts how often each row matches, and every so often reorders the rows it tries so the most frequently
+# matched ones come first. Rows are only moved past rows which static analysis (see spec_analysis.py) proves can never
+# match the same input, so the row which matches, and therefore the assembled machine code, never changes.
+#
+# The hit counts are saved to a profile file, which later runs load to start with the learned order. The profile has the
+# same format as the file written by '--suggest-order', so a profile of a single run can be used as a starting point.
+# A definition's hit counts are only used if the rows of the definition are unchanged since the profile was saved.
+
+# Number of matches after which the rows are reordered.
+DEFAULT_REORDER_INTERVAL = 256
+
+
+# Keeps hit counts for the rows of each definition of a spec, and the order in which the parser should try them.
+# spec - spec whose definitions are reordered
+# reorder_interval - number of matches after which the rows are reordered
+class AdaptiveOrdering:
+
+    def __init__(self, spec: AsmGrammarSpec, reorder_interval=DEFAULT_REORDER_INTERVAL):
+        self.spec = spec
+        self.reorder_interval = reorder_interval
+        self.row_conflicts = RowConflicts(spec)
+
+        # Only definitions with at least two rows which can be reordered are tracked.
+        self.hits = {}              # type: Dict[str, List[int]]
+        for defn_name in spec.spec.keys():
+            if self.row_conflicts.is_reorderable(defn_name):
+                self.hits[defn_name] = [0] * len(spec.spec[defn_name].spec_patterns)
+
+        # Order in which the parser tries the rows of each definition. Definitions which aren't in this dict are tried
+        # in spec order.
+        self.orders = {}            # type: Dict[str, List[int]]
+        self.matches_since_reorder = 0
+        return
+
+    # Called by the parser when a row of a definition matches.
+    def record_hit(self, defn_name, row):
+        hits = self.hits.get(defn_name)
+        if hits is None:
+            return
+        hits[row] += 1
+
+        self.matches_since_reorder += 1
+        if self.matches_since_reorder >= self.reorder_interval:
+            self.reorder()
+        return
+
+    def reorder(self):
+        for defn_name, hits in self.hits.items():
+            order = self.row_conflicts.get_constrained_order(defn_name, hits)
+            if order == list(range(len(order))):
+                self.orders.pop(defn_name, None)
+            else:
+                self.orders[defn_name] = order
+        self.matches_since_reorder = 0
+        return
+
+    # Loads hit counts from a profile file, and reorders the rows accordingly. Does nothing if the file doesn't exist.
+    def load_profile(self, profile_path):
+        if not os.path.isfile(profile_path):
+            return
+
+        import json
+
+        with open(profile_path, "r") as profile_file:
+            try:
+                profile = json.load(profile_file)
+            except ValueError:
+                print("ERROR: Adaptive order profile '%s' is not valid JSON" % profile_path)
+                raise ValueError
+
+        for defn_name, defn_profile in profile.get("definitions", {}).items():
+            if defn_name not in self.hits:
+                continue
+
+            rows = defn_profile.get("rows", [])
+            patterns = self.spec.spec[defn_name].spec_patterns
+            if [r.get("pattern") for r in rows] != [p.text for p in patterns]:
+                continue
+
+            for row, r in enumerate(rows):
+                self.hits[defn_name][row] += r.get("matches", 0)
+
+        self.reorder()
+        return
+
+    def to_dict(self):
+        definitions = {}
+        for defn_name, hits in self.hits.items():
+            defn = self.spec.spec[defn_name]
+            definitions[defn_name] = {
+                "line": defn.line_num + 1,
+                "order": self.orders.get(defn_name, list(range(len(hits)))),
+                "rows": [{"row": row, "line": p.line_num, "pattern": p.text, "matches": hits[row]}
+                         for row, p in enumerate(defn.spec_patterns)],
+            }
+        return {"definitions": definitions}
+
+    def save_profile(self, profile_path):
+        import json
+
+        with open(profile_path, "w+") as profile_file:
+            json.dump(self.to_dict(), profile_file, indent=2)
+        return
@@ -0,0 +1,242 @@
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import asm_scheduler
+from asm_int_types import IntTypeRegistry
+from asm_server import AssemblerService
+from assembler import Assembler
+from bitstream_gen import DEFAULT_IMAGEBASE
+from obj_writer import ObjectWriter
+from output_writers import write_outputs
+from template_registry import TemplateRegistry
+
+# This module implements batch mode, used when main.py is started with '--batch MANIFEST'. Batch mode assembles many
+# listings in a single invocation: the plugins are loaded once per worker process, each distinct spec is read once per
+# worker, and the entries of the manifest are spread across the worker pool. A failing entry never stops the batch,
+# its errors are recorded in the summary file and the remaining entries are still assembled.
+#
+# The manifest is a text file with one JSON object per line. Empty lines and lines starting with '#' are skipped. Each
+# entry can have the following fields, named after the matching command line flags of main.py:
+#
+#   spec            - path of the spec file (REQUIRED)
+#   asm             - path of the assembly source code file (REQUIRED)
+#   imagebase       - memory address the code will be loaded at. Defaults to 0x1000.
+#   sigma16_labels  - parse labels as Sigma16 labels. Defaults to false.
+#   write_bin       - file where the bytes of the assembled machine code are saved
+#   write_sigma16   - file where the assembled sigma16 bytecode is saved
+#   write_ihex      - file where the machine code is saved as Intel HEX records
+#   write_srec      - file where the machine code is saved as Motorola S-records
+#   write_c_array   - C header file where the machine code is saved as a byte array
+#   write_object    - file where the object file is saved. Requires template_path.
+#   template_path   - path of the template object file
+#
+# Relative paths are relative to the folder of the manifest. If an entry has none of the write_* fields, the machine code
+# is saved next to the source code file, with '.bin' appended to its name.
+#
+# The summary file is a JSON object with the total number of entries, the number of entries which assembled ok and
+# which failed, and for each entry its manifest line number, source file, 'ok' flag, and the list of 'errors' in the same
+# format as the replies of the assembler daemon.
+
+# Fields of a manifest entry holding paths, which are resolved relative to the folder of the manifest.
+PATH_FIELDS = ["spec", "asm", "write_bin", "write_sigma16", "write_ihex", "write_srec", "write_c_array", "write_object",
+               "template_path"]
+
+# Maps the write_* fields of a manifest entry to the output formats of output_writers.py, and to the object output.
+OUTPUT_FIELDS = {"bin": "write_bin", "sigma16": "write_sigma16", "ihex": "write_ihex", "srec": "write_srec",
+                 "c_array": "write_c_array", "object": "write_object"}
+
+# Number of entries sent to a worker process at once. Batches are typically made of many small listings, so sending
+# them one at a time would spend more time on inter-process communication than on assembling.
+ENTRIES_PER_CHUNK = 16
+
+# Reads the manifest, and returns its entries. Each entry is a tuple of its line number and its decoded JSON object,
+# with paths made absolute. Lines which aren't valid JSON objects are returned as entries too, and fail when assembled,
+# so one bad line doesn't stop the rest of the batch.
+def read_manifest(manifest_path) -> List[tuple]:
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+
+    with open(manifest_path, "r") as manifest_file:
+        for line_num, line in enumerate(manifest_file, start=1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+
+            try:
+                entry = json.loads(line)
+            except ValueError as e:
+                entry = "Invalid JSON: %s" % e
+
+            if isinstance(entry, dict):
+                for field in PATH_FIELDS:
+                    if isinstance(entry.get(field), str):
+                        entry[field] = os.path.join(base_dir, entry[field])
+
+            entries.append((line_num, entry))
+
+    return entries
+
+
+# Converts a manifest entry into a request for the assembler service. Returns the request, and a dict mapping each
+# requested output to the file it's saved to.
+def entry_to_request(entry):
+    if not isinstance(entry, dict):
+        raise ValueError(entry if isinstance(entry, str) else "Manifest entry must be a JSON object")
+    if not isinstance(entry.get("asm"), str):
+        raise ValueError("Manifest field 'asm' is required and must be a string")
+
+    output_paths = {}
+    for output, field in OUTPUT_FIELDS.items():
+        if entry.get(field) is not None:
+            output_paths[output] = entry[field]
+    if len(output_paths) == 0:
+        output_paths["bin"] = entry["asm"] + ".bin"
+
+    with open(entry["asm"], "r") as asm_file:
+        source = asm_file.read()
+
+    if "object" in output_paths and not isinstance(entry.get("template_path"), str):
+        raise ValueError("Manifest field 'template_path' is required with 'write_object' and must be a string")
+
+    # Only the machine code is requested from the service. All outputs are written from it by write_entry_outputs, the
+    # formats in a single pass over it, and the object by patching a copy of the template in place.
+    request = {
+        "spec": entry.get("spec"),
+        "source": source,
+        "imagebase": entry.get("imagebase", DEFAULT_IMAGEBASE),
+        "sigma16_labels": entry.get("sigma16_labels", False),
+        "outputs": ["bin"],
+    }
+    if "template_path" in entry:
+        request["template_path"] = entry["template_path"]
+
+    return request, output_paths
+
+
+# Saves the outputs of an assembled manifest entry to their files. Object files are written using the templates of the
+# given registry. reply_address is the address of the first byte of machine code, as returned by the service. Errors are
+# printed to output, or to the console if it's None.
+def write_entry_outputs(request, outputs, output_paths, template_registry: TemplateRegistry = None,
+                        reply_address=None, output=None):
+    raw_bytes = outputs["bin"]
+
+    format_paths = {output: path for output, path in output_paths.items() if output != "object"}
+    if len(format_paths) > 0:
+        address = reply_address if reply_address is not None else request["imagebase"]
+        write_outputs([(address, raw_bytes)], format_paths, imagebase=address, output=output)
+
+    if "object" in output_paths:
+        ObjectWriter(raw_bytes, template_registry, output).write_object(request["template_path"], output_paths["object"])
+
+    return
+
+
+# Assembles a single manifest entry with the given service, saves its outputs, and returns its summary record. Never
+# raises, any error is recorded in the returned summary record instead.
+def run_entry(service: AssemblerService, line_num, entry) -> dict:
+    start_time = time.perf_counter()
+    record = {"line": line_num}
+    if isinstance(entry, dict):
+        record["asm"] = entry.get("asm")
+
+    stage = "manifest"
+    try:
+        request, output_paths = entry_to_request(entry)
+
+        stage = "assemble"
+        reply = service.assemble(request)
+
+        if reply["ok"]:
+            stage = "write"
+            captured_output = io.StringIO()
+            try:
+                write_entry_outputs(request, reply["outputs"], output_paths, service.template_registry,
+                                    reply.get("address"), captured_output)
+            except ValueError as e:
+                raise ValueError(Assembler.get_error_message(captured_output, e))
+            record["outputs"] = output_paths
+
+        record["ok"] = reply["ok"]
+        if not reply["ok"]:
+            record["errors"] = reply["errors"]
+
+    except Exception as e:
+        record["ok"] = False
+        record["errors"] = [{"stage": stage, "message": str(e) if len(str(e)) > 0 else type(e).__name__}]
+
+    record["seconds"] = time.perf_counter() - start_time
+    return record
+
+
+# Assembles a chunk of manifest entries in a worker process, using the assembler service created by
+# asm_scheduler.init_worker.
+def run_chunk(chunk) -> List[dict]:
+    return [run_entry(asm_scheduler.worker_service, line_num, entry) for line_num, entry in chunk]
+
+
+# Returns the summary records of a chunk of manifest entries which couldn't be assembled by a worker process.
+def failed_chunk_records(chunk, e: Exception) -> List[dict]:
+    records = []
+    for line_num, entry in chunk:
+        record = {"line": line_num}
+        if isinstance(entry, dict):
+            record["asm"] = entry.get("asm")
+        record["ok"] = False
+        record["errors"] = [{"stage": "worker", "message": "Worker failed: %r" % e}]
+        record["seconds"] = 0.0
+        records.append(record)
+    return records
+
+
+# Assembles all entries of a manifest, and returns the summary.
+# workers - number of worker processes. 1 assembles all entries in the main process, 0 uses one worker per CPU.
+def run_batch(manifest_path, workers=1, plugin_places=None, spec_cache_dir=None) -> dict:
+    start_time = time.perf_counter()
+    entries = read_manifest(manifest_path)
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if workers == 1 or len(entries) <= 1:
+        int_type_registry = IntTypeRegistry(plugin_places)
+        int_type_registry.load_plugins()
+        service = AssemblerService(int_type_registry, spec_cache_dir=spec_cache_dir)
+        records = [run_entry(service, line_num, entry) for line_num, entry in entries]
+    else:
+        # Entries with the same spec are kept together, so each worker reads as few distinct specs as possible.
+        entries = sorted(entries, key=lambda e: str(e[1].get("spec")) if isinstance(e[1], dict) else "")
+        chunks = [entries[i:i + ENTRIES_PER_CHUNK] for i in range(0, len(entries), ENTRIES_PER_CHUNK)]
+
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=asm_scheduler.get_worker_context(),
+                                       initializer=asm_scheduler.init_worker, initargs=(plugin_places, spec_cache_dir))
+        with executor:
+            futures = [(chunk, executor.submit(run_chunk, chunk)) for chunk in chunks]
+            records = []
+            for chunk, future in futures:
+                try:
+                    records.extend(future.result())
+                except Exception as e:
+                    # The worker process died, for example killed by the OOM killer, or the chunk couldn't be sent to
+                    # it. Every entry of the chunk is recorded as failed, and the rest of the batch carries on.
+                    records.extend(failed_chunk_records(chunk, e))
+        records.sort(key=lambda r: r["line"])
+
+    ok_count = sum(1 for r in records if r["ok"])
+    return {
+        "manifest": os.path.abspath(manifest_path),
+        "total": len(records),
+        "ok": ok_count,
+        "failed": len(records) - ok_count,
+        "seconds": time.perf_counter() - start_time,
+        "entries": records,
+    }
+
+
+def write_summary(summary, summary_path):
+    with open(summary_path, "w+") as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    return
@@ -0,0 +1,140 @@
+import base64
+import json
+import os
+import socket
+import sys
+from optparse import OptionParser
+
+# Thin client for the assembler daemon (see asm_server.py, started with 'python main.py --serve SOCKET'). It accepts the
+# same flags as main.py for assembling and writing output files, but sends the work to the daemon instead of loading
+# the plugins and spec itself. It deliberately only imports modules from the standard library, so starting it is cheap.
+
+DEFAULT_SOCKET_PATH = "/tmp/assembler.sock"
+
+
+def load_args():
+
+    parser = OptionParser()
+
+    parser.add_option("--socket", dest="socket_path", default=DEFAULT_SOCKET_PATH,
+                      help="Unix socket the assembler daemon is listening on.", metavar="SOCKET")
+
+    parser.add_option("-s", "--spec-file", dest="spec_path",
+                      help="Spec file of architecture being assembled. REQUIRED", metavar="FILE")
+
+    parser.add_option("-a", "--asm-file", dest="asm_path",
+                      help="Assembly source code file to be assembled. REQUIRED", metavar="FILE")
+
+    parser.add_option("--sigma16-labels",
+                      action="store_true", dest="sigma16_labels", default=False,
+                      help="Parse labels as Sigma16 labels.")
+
+    parser.add_option("--imagebase",
+                      type=int, dest="imagebase", default=0x1000,
+                      help="Specify memory address that generated code will be loaded at.")
+
+    parser.add_option("--write-bin", dest="bin_path",
+                      help="""Specifies file where bytes of assembled machine code should be saved. """, metavar="FILE")
+
+    parser.add_option("--write-sigma16", dest="sigma16_path",
+                      help="""Specifies file where assembled sigma16 bytecode should be saved. """, metavar="FILE")
+
+    parser.add_option("--write-object", dest="template_out_path",
+                      help="Specifies output path of object file. Template object file that machine code will be \
+                      inserted into must be specified via --template-path.", metavar="FILE")
+
+    parser.add_option("--template-path", dest="template_in_path",
+                      help="Path to template object file into which machine code will be inserted. Must be specified \
+                      if --write-object is specified.", metavar="FILE")
+
+    (opts, args) = parser.parse_args()
+
+    error_str = ""
+
+    if opts.spec_path is None:
+        error_str += "ERROR: --spec-file is required\n"
+    if opts.asm_path is None:
+        error_str += "ERROR: --asm-file is required\n"
+
+    if opts.template_out_path and not opts.template_in_path:
+        error_str += "ERROR: If --write-object is set, --template-path must also be set\n"
+
+    if len(error_str) > 0:
+        print("")
+        print(error_str)
+        print("====================================\n")
+
+        parser.print_help()
+        return None
+
+    return opts
+
+
+# Sends a single request to the daemon and returns its reply.
+def send_request(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        sock.shutdown(socket.SHUT_WR)
+
+        with sock.makefile("rb") as reply_file:
+            return json.loads(reply_file.readline().decode("utf-8"))
+
+
+def main():
+
+    opts = load_args()
+    if opts is None:
+        return 1
+
+    bin_path = opts.bin_path
+    if not opts.bin_path and not opts.sigma16_path and not opts.template_out_path:
+        bin_path = "default.out"
+
+    outputs = []
+    if bin_path:
+        outputs.append("bin")
+    if opts.sigma16_path:
+        outputs.append("sigma16")
+    if opts.template_out_path:
+        outputs.append("object")
+
+    with open(opts.asm_path, "r") as f:
+        source = f.read()
+
+    request = {
+        "spec": os.path.abspath(opts.spec_path),
+        "source": source,
+        "imagebase": opts.imagebase,
+        "sigma16_labels": opts.sigma16_labels,
+        "outputs": outputs,
+    }
+    if opts.template_in_path:
+        request["template_path"] = os.path.abspath(opts.template_in_path)
+
+    reply = send_request(opts.socket_path, request)
+
+    if not reply["ok"]:
+        for error in reply["errors"]:
+            if "line" in error:
+                print("Assembler ERROR (%s, line %s):" % (error["stage"], error["line"]))
+            else:
+                print("Assembler ERROR (%s):" % error["stage"])
+            print(error["message"])
+        return 1
+
+    if bin_path:
+        with open(bin_path, "wb+") as out_file:
+            out_file.write(base64.b64decode(reply["outputs"]["bin"]))
+    if opts.sigma16_path:
+        with open(opts.sigma16_path, "w+") as out_file:
+            out_file.write(reply["outputs"]["sigma16"])
+    if opts.template_out_path:
+        with open(opts.template_out_path, "wb+") as out_file:
+            out_file.write(base64.b64decode(reply["outputs"]["object"]))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,13 +1,24 @@
-from asm_int_types import AsmIntTypes
+from asm_int_types import IntTypeRegistry
+from native_int_types import NativeIntType
 from parse_utils import ParseUtils
 from enum import Enum
 from typing import Dict, List, Optional
+import hashlib
+import os
 
 # This module is responsible for parsing the custom ADL spec file, which describes the assembler architecture. Once the
 # parsing is done, all information will be held in an AsmGrammarSpec object, which will be passed to the assembly
 # parser for use while parsing the assembly source code
 
 
+# Version of the compiled spec format saved in the spec cache. Must be increased whenever the objects saved in the cache
+# change, so that stale cache files are ignored.
+COMPILED_SPEC_FORMAT_VERSION = 4
+
+# Directives which start a new section of the spec file.
+SECTION_DIRECTIVES = [".BIT_FIELDS", ".INT_TYPES", ".ASM_INSTRUCTIONS"]
+
+
 # This object holds the name and size of each possible bitfield in an instruction of the specified architecture
 class BitfieldDefinition:
 
@@ -23,12 +34,15 @@ class BitfieldDefinition:
 # PLACEHOLDER - A placeholder token which is expanded into another instruction definition
 # INT_TOKEN - Int which should be parsed and emitted by a plugin
 # LABEL_TOKEN - Label which should be parsed and emitted by a plugin
+# LITERAL - Run of raw tokens and whitespace merged by the spec optimizer. Each space in its value stands for 1 or more
+#               whitespace characters.
 class TokenTypes(Enum):
     WHITESPACE = 1
     RAW_TOKEN = 2
     PLACEHOLDER = 3
     INT_TOKEN = 4
     LABEL_TOKEN = 5
+    LITERAL = 6
 
 
 # This enum describes the different possible types of Bitfield Modifiers.
@@ -51,12 +65,15 @@ class BitfieldModifier:
 
 
 # Object which contains a token pattern and its bitfield modifiers of an instruction definition parsed from the
-# spec file
+# spec file. line_num and text are the 1-based line number and text of the pattern in the spec file, used to point
+# spec authors at the pattern, for example in the parser profile.
 class DefinitionPattern:
 
-    def __init__(self, token_patterns, bitfield_modifiers):
+    def __init__(self, token_patterns, bitfield_modifiers, line_num=None, text=""):
         self.token_patterns = token_patterns
         self.bitfield_modifiers = bitfield_modifiers  # type: List[BitfieldModifier]
+        self.line_num = line_num
+        self.text = text
 
 
 # Object contains information for a single instruction definition parsed from the spec file.
@@ -88,12 +105,21 @@ class AsmInstructionDefinition:
 # spec - dictionary which allows the program to look up any instruction definition by name
 # bitfields - list of all possible bitfields, in a given order
 # bitfield_indexes_map - lets program look up index of bitfield in 'bitfields' list by its name
+# native_int_types - native int types declared in the optional .INT_TYPES section, looked up by name
+# int_type_registry - registry of int/label types which the spec can use. If the spec declares native int types, they
+#                       are registered in a copy of the registry which was passed in, so the passed in registry can be
+#                       shared between several specs.
+# output - text stream which error messages are printed to. None prints them to the console.
 class AsmGrammarSpec:
 
-    def __init__(self):
+    def __init__(self, int_type_registry: IntTypeRegistry, output=None):
         self.parsed_asm_instruction_types = False
         self.parsed_bitfields_definitions = False
+        self.parsed_int_types = False
         self.spec = {}  # type: Dict[str, AsmInstructionDefinition]
+        self.native_int_types = {}  # type: Dict[str, NativeIntType]
+        self.int_type_registry = int_type_registry
+        self.output = output
 
         self.bitfields = []  # type: List[BitfieldDefinition]
         self.bitfield_indexes_map = {}  # type: Dict[str, int]
@@ -106,16 +132,124 @@ class AsmGrammarSpec:
         return
 
     # Entrypoint for this module, responsible for reading spec file and parsing it, and then validating it for common
-    # errors
-    def read_spec(self, spec_file_path):
+    # errors.
+    # cache_dir - optional folder for the compiled spec cache. If the spec was already compiled with the same plugins,
+    #               the compiled spec is loaded from the cache instead, skipping parsing and validation entirely.
+    # optimize - run the spec optimizer (see spec_optimizer.py) on the validated spec
+    def read_spec(self, spec_file_path, cache_dir=None, optimize=False):
         with open(spec_file_path, "r") as f:
-            input_file = f.readlines()
+            spec_text = f.read()
+
+        self.read_spec_text(spec_text, cache_dir, optimize)
 
-        self.parse_spec(input_file)
+        return
+
+    # Parses and validates a spec held in a string. Can also use the compiled spec cache, same as read_spec.
+    def read_spec_text(self, spec_text: str, cache_dir=None, optimize=False):
+
+        cache_path = None
+        if cache_dir is not None:
+            cache_path = os.path.join(cache_dir, self.get_cache_key(spec_text, optimize) + ".spec.pickle")
+            if self.load_compiled(cache_path):
+                return
+
+        self.parse_spec(spec_text.splitlines(keepends=True))
         self.validate_spec()
 
+        if optimize:
+            from spec_optimizer import SpecOptimizer
+            SpecOptimizer(self).optimize()
+
+        if cache_path is not None:
+            self.save_compiled(cache_path)
+
+        return
+
+    # The cache key of a spec is derived from the spec text, the fingerprint of the plugin registry, the version of the
+    # compiled spec format, and whether the spec is optimized.
+    def get_cache_key(self, spec_text: str, optimize=False):
+        h = hashlib.sha256()
+        h.update(str(COMPILED_SPEC_FORMAT_VERSION).encode("utf-8") + b"\0")
+        h.update((b"optimized" if optimize else b"plain") + b"\0")
+        h.update(self.int_type_registry.fingerprint().encode("utf-8") + b"\0")
+        h.update(spec_text.encode("utf-8"))
+        return h.hexdigest()
+
+    # Saves the compiled and validated spec to a file. The plugin registry is not saved, as it holds plugin code. The
+    # file is written to a temporary file first and then moved in place, so concurrent runs never see a partial file.
+    # The spec cache is optional, so if the spec can't be saved a warning is printed and the run carries on, and the
+    # spec is compiled again by the next run.
+    def save_compiled(self, cache_path):
+        state = {
+            "format_version": COMPILED_SPEC_FORMAT_VERSION,
+            "spec": self.spec,
+            "bitfields": self.bitfields,
+            "bitfield_indexes_map": self.bitfield_indexes_map,
+            "native_int_types": self.native_int_types,
+        }
+
+        # Only needed with a spec cache, so not imported up front.
+        import pickle
+        import tempfile
+
+        cache_dir = os.path.dirname(cache_path)
+        temp_path = None
+        try:
+            if len(cache_dir) > 0:
+                os.makedirs(cache_dir, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir if len(cache_dir) > 0 else None, suffix=".tmp")
+            with os.fdopen(fd, "wb") as temp_file:
+                pickle.dump(state, temp_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, cache_path)
+        except Exception as e:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.unlink(temp_path)
+            print("Spec Cache WARNING: Unable to save compiled spec to '%s': %s" % (cache_path, e), file=self.output)
+
         return
 
+    # Loads a compiled spec saved by save_compiled. Returns False if there is no usable compiled spec at the given path,
+    # in which case the spec must be parsed normally, and the cache entry is overwritten with the newly compiled spec.
+    # A cache file which fails to load in any way, for example because it's truncated or corrupted, counts as missing.
+    # The spec is only changed once the whole cache file loaded.
+    def load_compiled(self, cache_path):
+        if not os.path.isfile(cache_path):
+            return False
+
+        import pickle
+        try:
+            with open(cache_path, "rb") as cache_file:
+                state = pickle.load(cache_file)
+
+            if not isinstance(state, dict) or state.get("format_version") != COMPILED_SPEC_FORMAT_VERSION:
+                return False
+
+            spec = state["spec"]
+            bitfields = state["bitfields"]
+            bitfield_indexes_map = state["bitfield_indexes_map"]
+            native_int_types = state["native_int_types"]
+
+            int_type_registry = self.int_type_registry
+            if len(native_int_types) > 0:
+                int_type_registry = self.copy_registry()
+                for native_type in native_int_types.values():
+                    int_type_registry.register_native_type(native_type)
+        except Exception:
+            return False
+
+        self.spec = spec
+        self.bitfields = bitfields
+        self.bitfield_indexes_map = bitfield_indexes_map
+        self.native_int_types = native_int_types
+        self.int_type_registry = int_type_registry
+
+        if len(native_int_types) > 0:
+            self.parsed_int_types = True
+        self.parsed_bitfields_definitions = True
+        self.parsed_asm_instruction_types = True
+
+        return True
+
     # This function receives all the lines of the spec file and parses them one-by-one
     def parse_spec(self, spec_file_lines):
 
@@ -131,16 +265,25 @@ class AsmGrammarSpec:
 
             if line == ".BIT_FIELDS":
                 if self.parsed_bitfields_definitions:
-                    print("ERROR: duplicate .BIT_FIELDS directive (line %s)" % (line_num+1))
+                    print("ERROR: duplicate .BIT_FIELDS directive (line %s)" % (line_num+1), file=self.output)
                     raise ValueError
 
                 line_num = self.parse_bitfield_definitions(line_num, spec_file_lines)
                 self.parsed_bitfields_definitions = True
                 continue
 
+            elif line == ".INT_TYPES":
+                if self.parsed_int_types:
+                    print("ERROR: duplicate .INT_TYPES directive (line %s)" % (line_num+1), file=self.output)
+                    raise ValueError
+
+                line_num = self.parse_int_type_definitions(line_num, spec_file_lines)
+                self.parsed_int_types = True
+                continue
+
             elif line == ".ASM_INSTRUCTIONS":
                 if self.parsed_asm_instruction_types:
-                    print("ERROR: duplicate .ASM_INSTRUCTIONS directive (line %s)" % (line_num+1))
+                    print("ERROR: duplicate .ASM_INSTRUCTIONS directive (line %s)" % (line_num+1), file=self.output)
                     raise ValueError
 
                 self.parse_asm_instructions_spec(line_num, spec_file_lines)
@@ -150,23 +293,23 @@ class AsmGrammarSpec:
             line_num += 1
 
         if not self.parsed_asm_instruction_types:
-            print("ERROR: .ASM_INSTRUCTIONS directive was not found in spec file!")
+            print("ERROR: .ASM_INSTRUCTIONS directive was not found in spec file!", file=self.output)
             raise ValueError
 
         if not self.parsed_bitfields_definitions:
-            print("ERROR: .BIT_FIELDS directive was not found in spec file!")
+            print("ERROR: .BIT_FIELDS directive was not found in spec file!", file=self.output)
             raise ValueError
 
         return
 
     # This function is responsible for parsing the bitfield definitions, which specify the names and sizes of all
     # possible bitfields in an instruction in this architecture. The function keeps parsing until it hits the end
-    # of the file, or the .ASM_INSTRUCTIONS directive. The function will start parsing from the .BIT_FIELDS directive.
+    # of the file, or the directive of the next section. The function will start parsing from the .BIT_FIELDS directive.
     def parse_bitfield_definitions(self, start_line_num, spec_file_lines):
 
         line_num = start_line_num
         if not spec_file_lines[line_num].startswith(".BIT_FIELDS"):
-            print("ERROR: Parsing bitfield definitions, but current line doesn't start with .BIT_FIELDS (line %s)" % (line_num+1))
+            print("ERROR: Parsing bitfield definitions, but current line doesn't start with .BIT_FIELDS (line %s)" % (line_num+1), file=self.output)
 
         line_num += 1
 
@@ -179,14 +322,14 @@ class AsmGrammarSpec:
                 line_num += 1
                 continue
 
-            if line == ".ASM_INSTRUCTIONS":
+            if line in SECTION_DIRECTIVES:
                 return line_num
 
             bitfield_name_line_num = line_num
             bitfield_size_line_num = line_num+1
 
             if bitfield_size_line_num >= len(spec_file_lines):
-                print("ERROR: EOL after line %s when attempting to read bitfield size" % (line_num+1))
+                print("ERROR: EOL after line %s when attempting to read bitfield size" % (line_num+1), file=self.output)
                 raise ValueError
 
             bitfield_name_line = spec_file_lines[bitfield_name_line_num].strip()
@@ -199,14 +342,118 @@ class AsmGrammarSpec:
 
             line_num += 2
 
-        print("ERROR: .ASM_INSTRUCTIONS is not present in spec file after .BIT_FIELDS")
+        print("ERROR: .ASM_INSTRUCTIONS is not present in spec file after .BIT_FIELDS", file=self.output)
         raise ValueError
 
+    # Returns a copy of the int type registry, in which the native int types of this spec are registered. The copy
+    # belongs to this spec, so its error messages are printed to the spec's output.
+    def copy_registry(self) -> IntTypeRegistry:
+        registry = self.int_type_registry.copy()
+        registry.output = self.output
+        return registry
+
+    # This function is responsible for parsing the native int type declarations of the optional .INT_TYPES section.
+    # Each declaration is a list of 'key: value' lines, and a new declaration begins at every 'name:' line. The
+    # function keeps parsing until it hits the directive of the next section. For example:
+    #
+    #   name: int_16_bits_le
+    #   size: 16
+    #   signedness: any
+    #   byte_order: little
+    #   formats: decimal hex_suffix
+    def parse_int_type_definitions(self, start_line_num, spec_file_lines):
+
+        line_num = start_line_num + 1
+        declarations = []
+
+        while line_num < len(spec_file_lines):
+
+            line = spec_file_lines[line_num].strip()
+
+            # Skip empty lines and comments
+            if len(line) == 0 or line.startswith("//"):
+                line_num += 1
+                continue
+
+            if line in SECTION_DIRECTIVES:
+                break
+
+            key, pos = ParseUtils.read_token(line, 0, break_chars=[' ', '\t', ':'], valid_chars=ParseUtils.valid_identifier_chars_map)
+            if ParseUtils.read_next_char(line, pos) != ":":
+                print("ERROR: Int type declaration on line %s must have the form 'key: value'" % (line_num+1), file=self.output)
+                raise ValueError
+            value = line[pos+1:].strip()
+
+            if key == "name":
+                declarations.append((line_num, {}))
+            elif len(declarations) == 0:
+                print("ERROR: Int type declaration on line %s must start with 'name:'" % (line_num+1), file=self.output)
+                raise ValueError
+
+            if key in declarations[-1][1]:
+                print("ERROR: Duplicate key '%s' in int type declaration on line %s" % (key, line_num+1), file=self.output)
+                raise ValueError
+            declarations[-1][1][key] = value
+
+            line_num += 1
+
+        self.int_type_registry = self.copy_registry()
+
+        for declaration_line_num, declaration in declarations:
+            native_type = self.build_native_int_type(declaration, declaration_line_num)
+            if native_type.name in self.native_int_types:
+                print("ERROR: Duplicate int type declaration '%s' on line %s" % (native_type.name, declaration_line_num+1), file=self.output)
+                raise ValueError
+            self.int_type_registry.register_native_type(native_type)
+            self.native_int_types[native_type.name] = native_type
+
+        return line_num
+
+    # Builds a native int type from the keys and values of its declaration in the .INT_TYPES section.
+    def build_native_int_type(self, declaration: Dict[str, str], line_num: int) -> NativeIntType:
+
+        known_keys = ["name", "size", "signedness", "byte_order", "formats", "prefix", "chars", "digits"]
+        for key in declaration.keys():
+            if key not in known_keys:
+                print("ERROR: Unknown key '%s' in int type declaration on line %s" % (key, line_num+1), file=self.output)
+                raise ValueError
+
+        for key in ["name", "size", "formats"]:
+            if key not in declaration:
+                print("ERROR: Int type declaration on line %s is missing '%s:'" % (line_num+1, key), file=self.output)
+                raise ValueError
+
+        try:
+            size = int(declaration["size"])
+        except ValueError:
+            print("ERROR: Unable to parse the size of int type declaration on line %s" % (line_num+1), file=self.output)
+            raise ValueError
+
+        digits = None
+        if "digits" in declaration:
+            try:
+                digits = int(declaration["digits"])
+            except ValueError:
+                print("ERROR: Unable to parse the number of digits of int type declaration on line %s" % (line_num+1), file=self.output)
+                raise ValueError
+
+        try:
+            return NativeIntType(declaration["name"], size,
+                                 declaration.get("signedness", "any"),
+                                 declaration.get("byte_order", "big"),
+                                 declaration["formats"].split(),
+                                 prefix=declaration.get("prefix", ""),
+                                 chars=declaration.get("chars"),
+                                 digits=digits)
+        except ValueError as e:
+            print("ERROR: %s (line %s)" % (e, line_num+1), file=self.output)
+            raise ValueError
+
     # Parses and returns the name of a bitfield from a bitfield definition.
     def parse_bitfield_name(self, name_line: str, line_num: int):
 
         if not name_line.startswith("name:"):
-            print("ERROR: Bitfield definition name on line %s must start with 'name:'" % (line_num+1))
+            print("ERROR: Bitfield definition name on line %s must start with 'name:'" % (line_num+1), file=self.output)
             raise ValueError
 
         pos = len("name:")
@@ -216,7 +463,7 @@ class AsmGrammarSpec:
 
         # After reading the name of the bitfield, make sure the rest of the line is empty.
         if not ParseUtils.is_rest_empty(name_line, pos):
-            print("ERROR: Extra characters present on line %s after bitfield name" % (line_num+1))
+            print("ERROR: Extra characters present on line %s after bitfield name" % (line_num+1), file=self.output)
             raise ValueError
 
         return bitfield_name
@@ -224,7 +471,7 @@ class AsmGrammarSpec:
     # Parses and returns the size of a bitfield from a bitfield definition
     def parse_bitfield_size(self, size_line: str, line_num: int):
         if not size_line.startswith("size:"):
-            print("ERROR: Bitfield definition size on line %s must start with 'size:'" % (line_num+1))
+            print("ERROR: Bitfield definition size on line %s must start with 'size:'" % (line_num+1), file=self.output)
             raise ValueError
 
         pos = len("size:")
@@ -234,13 +481,13 @@ class AsmGrammarSpec:
 
         # After reading the name of the bitfield, make sure the rest of the line is empty.
         if not ParseUtils.is_rest_empty(size_line, pos):
-            print("ERROR: Extra characters present on line %s after bitfield size" % (line_num+1))
+            print("ERROR: Extra characters present on line %s after bitfield size" % (line_num+1), file=self.output)
             raise ValueError
 
         try:
             bitfield_size = int(bitfield_size)
         except ValueError:
-            print("ERROR: Unable to parse the number for bitfield size on line %s" % (line_num+1))
+            print("ERROR: Unable to parse the number for bitfield size on line %s" % (line_num+1), file=self.output)
             raise ValueError
 
         return bitfield_size
@@ -251,7 +498,7 @@ class AsmGrammarSpec:
 
         line_num = start_line_num
         if not spec_file_lines[line_num].startswith(".ASM_INSTRUCTIONS"):
-            print("ERROR: Parsing asm instructions directive, but current line doesn't start with .ASM_INSTRUCTIONS (line %s)" % (line_num+1))
+            print("ERROR: Parsing asm instructions directive, but current line doesn't start with .ASM_INSTRUCTIONS (line %s)" % (line_num+1), file=self.output)
             raise ValueError
 
         line_num += 1
@@ -269,7 +516,7 @@ class AsmGrammarSpec:
             asm_defn, line_num = self.parse_single_asm_instr_defn(line_num, spec_file_lines)
 
             if asm_defn.name in self.spec:
-                print("ERROR: Duplicate instruction definition found: '%s' (line %s)" % (asm_defn.name, instr_defn_line+1))
+                print("ERROR: Duplicate instruction definition found: '%s' (line %s)" % (asm_defn.name, instr_defn_line+1), file=self.output)
                 raise ValueError
 
             self.spec[asm_defn.name] = asm_defn
@@ -301,7 +548,7 @@ class AsmGrammarSpec:
                     asm_defn.add_pattern(pattern)
 
         if len(asm_defn.spec_patterns) == 0:
-            print("ERROR: Empty instruction definition on line %s" % (start_line_num+1))
+            print("ERROR: Empty instruction definition on line %s" % (start_line_num+1), file=self.output)
             raise ValueError
 
         return asm_defn, line_num
@@ -312,14 +559,14 @@ class AsmGrammarSpec:
         name, pos = ParseUtils.read_identifier(line)
 
         if len(name) == 0:
-            print("ERROR: Unable to read definition identifier on line %s." % (line_num+1))
+            print("ERROR: Unable to read definition identifier on line %s." % (line_num+1), file=self.output)
             raise ValueError
 
         # Expect a '=' after the identifier
         token, pos = ParseUtils.read_token(line, pos)
 
         if token != "=":
-            print("ERROR: Expected '=' after definition identifier on line %s" % (line_num+1))
+            print("ERROR: Expected '=' after definition identifier on line %s" % (line_num+1), file=self.output)
             raise ValueError
 
         return name
@@ -344,7 +591,7 @@ class AsmGrammarSpec:
             while pos < len(line):
                 next_char = ParseUtils.read_next_char(line, pos)
                 if next_char is None:
-                    print("ERROR: Expected asm instruction patterns on line %s after '|'." % (line_num+1))
+                    print("ERROR: Expected asm instruction patterns on line %s after '|'." % (line_num+1), file=self.output)
                     raise ValueError
 
                 elif next_char == '%':
@@ -352,7 +599,7 @@ class AsmGrammarSpec:
                     placeholder_name, pos = ParseUtils.read_identifier(line, pos)
                     next_char = ParseUtils.read_next_char(line, pos)
                     if next_char != "%":
-                        print("ERROR: Expected asm definition identifier to be terminated with %% character on line %s." % (line_num+1))
+                        print("ERROR: Expected asm definition identifier to be terminated with %% character on line %s." % (line_num+1), file=self.output)
                         raise ValueError
                     pos += 1
                     pattern_tokens.append((TokenTypes.PLACEHOLDER, placeholder_name))
@@ -374,7 +621,7 @@ class AsmGrammarSpec:
 
                         break
                     else:
-                        print("ERROR: Unexpected ':' character on line %s" % (line_num+1))
+                        print("ERROR: Unexpected ':' character on line %s" % (line_num+1), file=self.output)
                         raise ValueError
 
                 # TODO: Is it wise, handling comma characters in a special way like this?
@@ -386,23 +633,23 @@ class AsmGrammarSpec:
                     # TODO: Audit [ and ] in the break chars.
                     next_token, pos = ParseUtils.read_token(line, pos, break_chars=[' ', '\t', '%', '[', ']'])
                     if next_token.startswith("int_"):
-                        if not AsmIntTypes.is_defined_type(next_token):
-                            print("ERROR: int of type '%s' is not defined in any plugin. Line: %s" % (next_token, line_num+1))
+                        if not self.int_type_registry.is_defined_type(next_token):
+                            print("ERROR: int of type '%s' is not defined in any plugin. Line: %s" % (next_token, line_num+1), file=self.output)
                             raise ValueError
                         pattern_tokens.append((TokenTypes.INT_TOKEN, next_token))
                     elif next_token.startswith("label_"):
-                        if not AsmIntTypes.is_defined_type(next_token):
-                            print("ERROR: label of type '%s' is not defined in any plugin. Line: %s" % (next_token, line_num+1))
+                        if not self.int_type_registry.is_defined_type(next_token):
+                            print("ERROR: label of type '%s' is not defined in any plugin. Line: %s" % (next_token, line_num+1), file=self.output)
                             raise ValueError
                         pattern_tokens.append((TokenTypes.LABEL_TOKEN, next_token))
                     else:
                         pattern_tokens.append((TokenTypes.RAW_TOKEN, next_token))
 
         else:
-            print("ERROR: Expected ';' or '|' on line %s, got '%s' instead" % ((line_num+1), first_token))
+            print("ERROR: Expected ';' or '|' on line %s, got '%s' instead" % ((line_num+1), first_token), file=self.output)
             raise ValueError
 
-        return DefinitionPattern(pattern_tokens, bitfield_modifiers)
+        return DefinitionPattern(pattern_tokens, bitfield_modifiers, line_num, line)
 
     # Parse and return the list of bitfield modifiers associated with the current token pattern.
     def read_bitfield_modifiers(self, raw_bitfield_modifiers: str, line_num: int) -> List[BitfieldModifier]:
@@ -422,39 +669,39 @@ class AsmGrammarSpec:
             modifier_arr = modifier_string.split("=")
 
             if len(modifier_arr) != 2:
-                print("ERROR: Unable to parse bitfield modifier '%s' on line %s" % (modifier_string, line_num+1))
+                print("ERROR: Unable to parse bitfield modifier '%s' on line %s" % (modifier_string, line_num+1), file=self.output)
                 raise ValueError
 
             bitfield_name = modifier_arr[0]
             if bitfield_name not in self.bitfield_indexes_map:
-                print("ERROR: Trying to assign to unknown bitfield '%s' in bitfield modifier on line '%s" % (bitfield_name, line_num+1))
+                print("ERROR: Trying to assign to unknown bitfield '%s' in bitfield modifier on line '%s" % (bitfield_name, line_num+1), file=self.output)
                 raise ValueError
 
             if modifier_arr[1].startswith("%") and modifier_arr[1].endswith("%"):
                 placeholder_name = modifier_arr[1][1:-1]
                 if placeholder_name.startswith("int_"):
-                    if not AsmIntTypes.is_defined_type(placeholder_name):
-                        print("ERROR: Unknown bitfield modifier int placeholder '%s' on line %s. Please make sure that this int type is defined in a plugin." % (modifier_arr[1], line_num + 1))
+                    if not self.int_type_registry.is_defined_type(placeholder_name):
+                        print("ERROR: Unknown bitfield modifier int placeholder '%s' on line %s. Please make sure that this int type is defined in a plugin." % (modifier_arr[1], line_num + 1), file=self.output)
                         raise ValueError
                     return BitfieldModifier(ModifierTypes.INT_PLACEHOLDER, bitfield_name, placeholder_name)
                 elif placeholder_name.startswith("label_"):
-                    if not AsmIntTypes.is_defined_type(placeholder_name):
-                        print("ERROR: Unknown bitfield modifier label placeholder '%s' on line %s. Please make sure that this label type is defined in a plugin." % (modifier_arr[1], line_num + 1))
+                    if not self.int_type_registry.is_defined_type(placeholder_name):
+                        print("ERROR: Unknown bitfield modifier label placeholder '%s' on line %s. Please make sure that this label type is defined in a plugin." % (modifier_arr[1], line_num + 1), file=self.output)
                         raise ValueError
                     return BitfieldModifier(ModifierTypes.LABEL_PLACEHOLDER, bitfield_name, placeholder_name)
                 else:
-                    print("ERROR: Unknown type of bitfield modifier placeholder '%s' on line '%s'" % (modifier_arr[1], line_num + 1))
+                    print("ERROR: Unknown type of bitfield modifier placeholder '%s' on line '%s'" % (modifier_arr[1], line_num + 1), file=self.output)
                     raise ValueError
 
             bitfield_value = self.read_modifier_value(modifier_arr[1])
             if bitfield_value is None:
-                print("ERROR: Unable to parse bitfield modifier value '%s' on line %s" % (modifier_arr[1], line_num + 1))
+                print("ERROR: Unable to parse bitfield modifier value '%s' on line %s" % (modifier_arr[1], line_num + 1), file=self.output)
                 raise ValueError
 
             return BitfieldModifier(ModifierTypes.MODIFIER, bitfield_name, bitfield_value)
 
         else:
-            print("ERROR: Unable to parse bitfield modifier '%s' on line %s" % (modifier_string, line_num + 1))
+            print("ERROR: Unable to parse bitfield modifier '%s' on line %s" % (modifier_string, line_num + 1), file=self.output)
             raise ValueError
 
     # Validates the value of a bitfield modifier (can only be 1's and 0's). Returns the validated value.
@@ -467,12 +714,11 @@ class AsmGrammarSpec:
                 return None
         return value_string
 
-    # TODO: Detect recursion in spec.
     # Validates the parsed spec for common errors, so they don't crash the assembler later.
     def validate_spec(self):
 
         if "INSTRUCTION" not in self.spec:
-            print("Spec Validation Error: 'INSTRUCTION' instruction definition is not present in spec.")
+            print("Spec Validation Error: 'INSTRUCTION' instruction definition is not present in spec.", file=self.output)
             raise ValueError
 
         for insn_defn_name, insn_defn in self.spec.items():
@@ -480,7 +726,77 @@ class AsmGrammarSpec:
                 for pattern_item in pattern.token_patterns:
                     if pattern_item[0] == TokenTypes.PLACEHOLDER:
                         if pattern_item[1] not in self.spec:
-                            print("Spec Validation Error: Instruction definition '%s' defined on line %s uses placeholder for undefined instruction definition '%s'" % (insn_defn_name, insn_defn.line_num+1, pattern_item[1]))
+                            print("Spec Validation Error: Instruction definition '%s' defined on line %s uses placeholder for undefined instruction definition '%s'" % (insn_defn_name, insn_defn.line_num+1, pattern_item[1]), file=self.output)
                             raise ValueError
 
+        self.validate_no_left_recursion()
+
+        return
+
+    # Checks that no instruction definition is left recursive, i.e. can reach itself through placeholders at the start of
+    # its rows. Every other token consumes at least one character, so recursion anywhere else in a row always ends at
+    # the end of the line, but the parser would recurse forever trying to match a left recursive definition.
+    def validate_no_left_recursion(self):
+
+        # Definitions each definition can start with.
+        leading_defns = {}      # type: Dict[str, List[str]]
+        for insn_defn_name, insn_defn in self.spec.items():
+            leading_defns[insn_defn_name] = []
+            for pattern in insn_defn.spec_patterns:
+                if len(pattern.token_patterns) > 0 and pattern.token_patterns[0][0] == TokenTypes.PLACEHOLDER:
+                    if pattern.token_patterns[0][1] not in leading_defns[insn_defn_name]:
+                        leading_defns[insn_defn_name].append(pattern.token_patterns[0][1])
+
+        # Depth first search for a cycle, keeping the path of definitions from the start of the search.
+        finished = set()
+        for start_name in self.spec.keys():
+            if start_name in finished:
+                continue
+
+            path = [start_name]
+            path_iters = [iter(leading_defns[start_name])]
+            while len(path) > 0:
+                next_name = next(path_iters[-1], None)
+                if next_name is None:
+                    finished.add(path.pop())
+                    path_iters.pop()
+                    continue
+                if next_name in finished:
+                    continue
+                if next_name in path:
+                    cycle = path[path.index(next_name):] + [next_name]
+                    print("Spec Validation Error: Instruction definition '%s' defined on line %s is left recursive, the parser would never stop trying to match it: %s" % (next_name, self.spec[next_name].line_num+1, " -> ".join(cycle)), file=self.output)
+                    raise ValueError
+                path.append(next_name)
+                path_iters.append(iter(leading_defns[next_name]))
+
         return
+
+    # Writes the instruction definitions, as they are used by the parser, to a file in the syntax of the
+    # .ASM_INSTRUCTIONS section of a spec. Used to inspect the result of the spec optimizer.
+    def dump_instruction_definitions(self, output_file):
+
+        with open(output_file, "w+") as out_file:
+            out_file.write(".ASM_INSTRUCTIONS\n")
+            for insn_defn_name, insn_defn in self.spec.items():
+                out_file.write("\n// Defined on line %s\n" % (insn_defn.line_num+1))
+                out_file.write("%s =\n" % insn_defn_name)
+                for pattern in insn_defn.spec_patterns:
+                    row = "| " + "".join(self.format_token(t) for t in pattern.token_patterns)
+                    for b in pattern.bitfield_modifiers:
+                        if b.modifier_type == ModifierTypes.MODIFIER:
+                            row += " :: %s=%s" % (b.bitfield_name, b.modifier_value)
+                        else:
+                            row += " :: %s=%%%s%%" % (b.bitfield_name, b.modifier_value)
+                    out_file.write(row + "\n")
+                out_file.write(";\n")
+
+        return
+
+    # Returns the spec syntax of a token of a token pattern.
+    @staticmethod
+    def format_token(token):
+        token_type, token_value = token
+        if token_type == TokenTypes.PLACEHOLDER:
+            return "%" + token_value + "%"
+        return token_value
@@ -1,32 +1,83 @@
-from yapsy.PluginManager import PluginManager
+from native_int_types import NativeIntType
+from plugin_stats import PluginStats
+from parse_utils import ParseUtils
 from typing import Dict
+import hashlib
+import os.path
+import re
 
 # This module is responsible for loading and validating all plugins, registering their types, and then presenting a
 # simple interface for the rest of the program to be able to use the plugin system to validate ints/labels and emit
 # bitstreams for them.
 
 
-class AsmIntTypes:
+# Holds all int and label types registered by plugins (and by native int type declarations in the spec). All state is
+# held per instance, so that several registries can live in one process, for example to keep assemblers for several
+# architectures loaded at the same time. Once loaded, a registry is only read from, so it can be shared between threads.
+# plugin_places - list of folders in which plugins are searched for
+# plugin_stats - optional PluginStats object. If given, every call to a plugin method registered in this registry is
+#                   timed and recorded in it. Without it, plugin methods are called directly, with no overhead.
+# output - text stream which error messages are printed to. None prints them to the console.
+class IntTypeRegistry:
 
-    defined_types = {}
+    def __init__(self, plugin_places=None, plugin_stats: PluginStats = None, output=None):
+        if plugin_places is None:
+            plugin_places = ["plugins"]
+        self.plugin_places = plugin_places
+        self.plugin_stats = plugin_stats
+        self.output = output
 
-    valid_chars = {}
-    verify_methods = {}
-    emit_methods = {}
-    calc_methods = {}
+        self.defined_types = {}     # type: Dict[str, bool]
+
+        self.valid_chars = {}
+        self.verify_methods = {}
+        self.emit_methods = {}
+        self.calc_methods = {}
+        self.scan_patterns = {}
+
+        self.plugin_hashes = {}     # type: Dict[str, str]
 
-    def __init__(self):
         return
 
+    # Returns a new registry with the same registered types as this one. Types registered in the copy do not affect
+    # this registry. Used by the spec to register its native int types without polluting a shared registry.
+    def copy(self):
+        registry = IntTypeRegistry(list(self.plugin_places), self.plugin_stats, self.output)
+        registry.defined_types = dict(self.defined_types)
+        registry.valid_chars = dict(self.valid_chars)
+        registry.verify_methods = dict(self.verify_methods)
+        registry.emit_methods = dict(self.emit_methods)
+        registry.calc_methods = dict(self.calc_methods)
+        registry.scan_patterns = dict(self.scan_patterns)
+        registry.plugin_hashes = dict(self.plugin_hashes)
+        return registry
+
+    # Returns a hash identifying the registered types and the source code of the loaded plugins. Anything derived from
+    # the registry (for example a cached compiled spec) is only valid for a registry with the same fingerprint.
+    def fingerprint(self):
+        h = hashlib.sha256()
+        for type_name in sorted(self.defined_types.keys()):
+            h.update(type_name.encode("utf-8") + b"\0")
+        for plugin_name in sorted(self.plugin_hashes.keys()):
+            h.update(plugin_name.encode("utf-8") + b"\0" + self.plugin_hashes[plugin_name].encode("utf-8") + b"\0")
+        return h.hexdigest()
+
     # This method is run at the beginning of the generic assembler. It loads all plugins, registers their types, and
-    # makes sure the plugin implements the correct interface for each type.
-    @staticmethod
-    def load_plugins():
+    # makes sure the plugin implements the correct interface for each type. yapsy is only imported here, as importing its
+    # PluginManager is slow, and only needed by runs which load plugins.
+    def load_plugins(self):
+        from yapsy.PluginManager import PluginManager
+
         manager = PluginManager()
-        manager.setPluginPlaces(["plugins"])
+        manager.setPluginPlaces(self.plugin_places)
         manager.collectPlugins()
 
         for plugin in manager.getAllPlugins():
+            plugin_source_path = plugin.path + ".py"
+            if os.path.isfile(plugin_source_path):
+                with open(plugin_source_path, "rb") as plugin_source:
+                    self.plugin_hashes[plugin.name] = hashlib.sha256(plugin_source.read()).hexdigest()
+
             plugin_types = plugin.plugin_object.get_registered_types()  # type: Dict[str, bool]
 
             for p in plugin_types.keys():
@@ -36,72 +87,121 @@ class AsmIntTypes:
                     chars_method = getattr(plugin.plugin_object, chars_method_name, None)
                     if chars_method is None:
                         print("Plugin Error: Method '%s' is missing from plugin file '%s' for type '%s'" % (
-                            chars_method, plugin.path, p))
+                            chars_method, plugin.path, p), file=self.output)
                         raise ValueError
-                    AsmIntTypes.valid_chars[p] = chars_method()
+                    self.valid_chars[p] = chars_method()
+                    self.scan_patterns[p] = self.load_scan_pattern(plugin, p)
 
                     verify_method_name = "verify_" + p
                     verify_method = getattr(plugin.plugin_object, verify_method_name, None)
                     if verify_method is None:
                         print("Plugin Error: Method '%s' is missing from plugin file '%s' for type '%s'" % (
-                            verify_method_name, plugin.path, p))
+                            verify_method_name, plugin.path, p), file=self.output)
                         raise ValueError
-                    AsmIntTypes.verify_methods[p] = verify_method
+                    self.verify_methods[p] = self.instrument(p, "verify", verify_method)
 
                     emit_method_name = "emit_" + p
                     emit_method = getattr(plugin.plugin_object, emit_method_name, None)
                     if emit_method is None:
                         print("Plugin Error: Method '%s' is missing from plugin file '%s' for type '%s'" % (
-                            emit_method_name, plugin.path, p))
+                            emit_method_name, plugin.path, p), file=self.output)
                         raise ValueError
-                    AsmIntTypes.emit_methods[p] = emit_method
+                    self.emit_methods[p] = self.instrument(p, "emit", emit_method)
 
                 elif p.startswith("label"):
                     calc_method_name = "calc_" + p
                     calc_method = getattr(plugin.plugin_object, calc_method_name, None)
                     if calc_method is None:
                         print("Plugin Error: Method '%s' is missing from plugin file '%s' for type '%s'" % (
-                            calc_method_name, plugin.path, p))
+                            calc_method_name, plugin.path, p), file=self.output)
                         raise ValueError
-                    AsmIntTypes.calc_methods[p] = calc_method
+                    self.calc_methods[p] = self.instrument(p, "calc", calc_method)
+                    self.scan_patterns[p] = self.load_scan_pattern(plugin, p)
 
-                AsmIntTypes.defined_types[p] = True
+                self.defined_types[p] = True
 
         return
 
-    # This function lets the rest of the program check if a type is defined in the plugin system.
+    # If instrumentation is enabled, wrap a plugin method so the latency of each call is recorded.
+    def instrument(self, type_name, method_kind, method):
+        if self.plugin_stats is None:
+            return method
+        return self.plugin_stats.wrap(type_name, method_kind, method)
+
+    # Compiles the regex used to scan ints/labels of a type in the assembly source. A plugin can supply its own regex by
+    # implementing an optional 'pattern_<name of data type>' method, which returns a regex string or compiled regex.
+    # Otherwise, ints are scanned as the longest run of characters from the type's character whitelist, and labels are
+    # scanned as alphanumeric identifiers.
+    def load_scan_pattern(self, plugin, p):
+        pattern_method = getattr(plugin.plugin_object, "pattern_" + p, None)
+        if pattern_method is not None:
+            try:
+                return re.compile(pattern_method())
+            except re.error as e:
+                print("Plugin Error: Method 'pattern_%s' in plugin file '%s' returned an invalid regex: %s" % (
+                    p, plugin.path, e), file=self.output)
+                raise ValueError
+
+        if p.startswith("int"):
+            return IntTypeRegistry.chars_to_scan_pattern(self.valid_chars[p])
+
+        return ParseUtils.identifier_regex
+
+    # Builds a regex matching the longest run of characters from a character whitelist.
     @staticmethod
-    def is_defined_type(int_type):
-        if int_type not in AsmIntTypes.defined_types:
+    def chars_to_scan_pattern(valid_chars):
+        return re.compile("[" + "".join(re.escape(c) for c in valid_chars) + "]+")
+
+    # Registers an int type declared in the .INT_TYPES section of the spec. Native types provide the same interface as
+    # plugin types, along with a precompiled regex used to scan the int in the assembly source.
+    def register_native_type(self, native_type: NativeIntType):
+        if native_type.name in self.defined_types:
+            print("Integer error: Native int type '%s' is already defined by a plugin or the spec." % native_type.name, file=self.output)
+            raise ValueError
+
+        self.valid_chars[native_type.name] = native_type.chars()
+        self.verify_methods[native_type.name] = self.instrument(native_type.name, "verify", native_type.verify)
+        self.emit_methods[native_type.name] = self.instrument(native_type.name, "emit", native_type.emit)
+        self.scan_patterns[native_type.name] = native_type.scan_regex
+        self.defined_types[native_type.name] = True
+
+        return
+
+    # This function lets the rest of the program check if a type is defined in the plugin system.
+    def is_defined_type(self, int_type):
+        if int_type not in self.defined_types:
             return False
         return True
 
     # This function lets the rest of the program get a character whitelist for parsing integers of a certain type.
-    @staticmethod
-    def get_valid_chars(int_type):
-        if not AsmIntTypes.is_defined_type(int_type):
-            print("Integer error: Int of type '%s' is not defined in any plugin." % int_type)
+    def get_valid_chars(self, int_type):
+        if not self.is_defined_type(int_type):
+            print("Integer error: Int of type '%s' is not defined in any plugin." % int_type, file=self.output)
             raise ValueError
-        return AsmIntTypes.valid_chars[int_type]
+        return self.valid_chars[int_type]
+
+    # This function lets the rest of the program get the precompiled regex used to scan ints or labels of a certain type.
+    def get_scan_pattern(self, int_type):
+        if not self.is_defined_type(int_type):
+            print("Integer error: Int of type '%s' is not defined in any plugin." % int_type, file=self.output)
+            raise ValueError
+        return self.scan_patterns[int_type]
 
     # This function lets the rest of the program query the plugin system to see if a certain type of interger it has
     # parsed is valid (for example: is in valid format, isn't overflowing, etc...)
-    @staticmethod
-    def validate_integer(int_type, int_string):
-        verify_method = AsmIntTypes.verify_methods[int_type]
+    def validate_integer(self, int_type, int_string):
+        verify_method = self.verify_methods[int_type]
         return verify_method(int_string)
 
     # This function lets the rest of the program use the plugin system to emit the bitstream for a certain type of
     # integer
-    @staticmethod
-    def emit_bits(int_type, int_string):
-        emit_method = AsmIntTypes.emit_methods[int_type]
+    def emit_bits(self, int_type, int_string):
+        emit_method = self.emit_methods[int_type]
         return emit_method(int_string)
 
     # This function lets the rest of the program use the plugin system to calculate and emit the bitstream for a label.
     # As input, it takes the type of the label, the address of the instruction using the label, and the actual memory
     # location associated with the label.
-    @staticmethod
-    def calc_label_bits(label_type, source_address, label_address):
-        calc_method = AsmIntTypes.calc_methods[label_type]
+    def calc_label_bits(self, label_type, source_address, label_address):
+        calc_method = self.calc_methods[label_type]
         return calc_method(source_address, label_address)
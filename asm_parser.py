@@ -1,13 +1,28 @@
-from asm_int_types import AsmIntTypes
+from asm_int_types import IntTypeRegistry
 from asm_grammar_spec import AsmGrammarSpec, AsmInstructionDefinition, TokenTypes, BitfieldModifier, ModifierTypes
 from parse_utils import ParseUtils
+from pipeline_stats import PipelineStats, stage
+from parser_profiler import ParserProfiler
+from adaptive_order import AdaptiveOrdering
+from data_runs import DataStatementShape, DEFAULT_MIN_RUN_LINES, encode_data_run, find_data_statement_shapes
 from enum import Enum
-from typing import List, Dict
+from typing import List, Dict, Optional
+import mmap
+import os
 
 
 # This module is responsible for parsing the input assembly source code. It takes as input the AsmGrammarSpec (the
 # information from the parsed spec file) and the assembly source code, and as output it produces an AST).
 
+# Default number of token pattern rows the parser may try while parsing a single line, before giving up on the line.
+DEFAULT_MAX_LINE_STEPS = 20000
+
+# Default number of instruction definitions the parser may be nested in while parsing a single line.
+DEFAULT_MAX_DEPTH = 100
+
+# Number of definitions shown from each end of the stack of definitions in budget errors.
+STACK_REPORT_ENDS = 6
+
 # This enum describes the different types of matches that the token matcher can produce.
 # NO_MATCH - no match was made at all
 # PARTIAL_MATCH - tokens in token buffer so far partially match expected tokens. Keep parsing
@@ -34,6 +49,12 @@ class TokenMatchType(Enum):
 #                       token pattern which was matched by the parsed to produce this ASTNode
 # address           - pseudo-memory-address of the node in the assembled bitstream. Essential for correctly computing
 #                       relative offsets and memory references of labels during bitstream generation.
+# repeat            - number of times the machine code of the node is repeated, for nodes parsed from .repeat
+#                       directives. The node is only encoded once, at the address of the first copy.
+# data              - raw bytes emitted for the node instead of its bitfields, for nodes parsed from .fill and .incbin
+#                       directives, or from a run of data statements. None for instructions.
+# data_lines        - line numbers of the statements of a run of data statements parsed into a single node (see
+#                       data_runs.py). None for any other node.
 class ASTNode:
 
     def __init__(self, token_type=None, token_value=None, child_nodes=None, bitfield_modifiers=None):
@@ -44,6 +65,9 @@ class ASTNode:
         self.labels = []                    # type: List[str]
         self.node_bitfields = None
         self.address = 0
+        self.repeat = 1
+        self.data = None
+        self.data_lines = None              # type: Optional[List[int]]
         if child_nodes is None:
             self.child_nodes = []                         # type: List[ASTNode]
         else:
@@ -69,20 +93,89 @@ class ASTNode:
             child_node.set_node_address(address)
         return
 
+    # Number of nodes in the tree rooted at this node, including this node.
+    def count_nodes(self):
+        return 1 + sum(child_node.count_nodes() for child_node in self.child_nodes)
+
+
+# Names of the assembler directives, which are handled by the assembler itself instead of being parsed with the spec.
+# Lines starting with any other name beginning with '.' are parsed with the spec as usual.
+# .org ADDRESS              - the following code is placed at the given address, in the current section
+# .section NAME [ADDRESS]   - the following code is placed in the named section. A section continues where it left off
+#                               when switched back to. A new section starts at the given address, or if no address is
+#                               given, where the previous section ended.
+SECTION_DIRECTIVES = [".org", ".section"]
+
+# Directives which emit bulk data without parsing it with the spec, so a large table costs a single line of parsing.
+# .repeat COUNT INSTRUCTION         - the instruction is parsed and encoded once, and its machine code repeated COUNT
+#                                       times
+# .fill SIZE [PATTERN]              - SIZE bytes filled with the bytes of a hex PATTERN, repeated. Defaults to zeros.
+# .incbin PATH [OFFSET [LENGTH]]    - the contents of a binary file, or LENGTH bytes of it starting at OFFSET. The file
+#                                       is memory mapped, and its bytes copied straight into the outputs.
+DATA_DIRECTIVES = [".repeat", ".fill", ".incbin"]
+
+# Directives for separate compilation (see linker.py). They are read during the label pass, as labels must be known
+# before the instructions referring to them are parsed.
+# .extern LABEL[, LABEL...]     - the labels are defined in another unit, and resolved when the units are linked
+# .global LABEL[, LABEL...]     - the labels, defined in this unit, are exported to the other units. Labels which aren't
+#                                   declared .global are local to their unit.
+LINK_DIRECTIVES = [".extern", ".global"]
+
+# Name of the section code is placed in before any .section directive.
+DEFAULT_SECTION = ".text"
+
+
+# An assembler directive parsed from the assembly source code.
+# name - name of the directive, including the leading '.'
+# section - name of the section, for .section directives
+# address - address given to the directive, or None if it has none
+# ast_index - index in the AST of the first instruction following the directive
+# line_num - line number of the directive in the assembly source code
+class Directive:
+
+    def __init__(self, name: str, section: Optional[str], address: Optional[int], ast_index: int, line_num: int):
+        self.name = name
+        self.section = section
+        self.address = address
+        self.ast_index = ast_index
+        self.line_num = line_num
+        return
+
 
 # Singleton object responsible for parsing the input assembly source code
 # spec - AsmGrammarSpec object describing the architecture that will be parsed
 # sigma16_labels - Sigma16 labels are a bit different than regular labels in other assembler languages, and should be
 #                    parsed in a special way. This flag will enable that special parsing.
+# int_type_registry - registry used to scan, validate and emit ints and labels. Defaults to the registry of the spec.
+# stats - optional PipelineStats object, in which the time and memory of each parser pass, and the parse counts, are
+#           recorded.
+# profiler - optional ParserProfiler object, in which every attempt to match a row of an instruction definition is
+#               recorded.
+# adaptive_ordering - optional AdaptiveOrdering object. If given, the rows of instruction definitions are tried in the
+#                       order it learns from the rows which match, instead of in spec order.
+# max_line_steps - number of token pattern rows the parser may try on a single line. Guards against specs which make the
+#                   parser backtrack excessively.
+# max_depth - number of instruction definitions the parser may be nested in on a single line. Guards against runaway
+#               recursion through placeholders.
+# fast_data_runs - parse long runs of data statements in a single step, into a single AST node holding their machine
+#                   code (see data_runs.py). Disabled when a profiler is given, so every line is profiled.
+# allow_incbin - allow .incbin directives, which read binary files. If False, they are reported as errors.
+# output - text stream which error messages are printed to. None prints them to the console.
 #
 # Object fields
 # spec          - reference to AsmGrammarSpec object describing the architecture
 # ast           - output of this module. Is a list of ASTNodes. Each ASTNode in the list is an INSTRUCTION node which
 #                   corresponds to a line of parsed assembly code. It in turns have child nodes which describe the
 #                   parsed line of assembly code.
+# directives    - assembler directives found in the assembly source code, in order. Each one records its position in
+#                   the AST, and is applied by the bitstream generator.
 # labels_map    - dictionary which allows us to look up if a label is on a line of code
 # all_labels    - keeps track of all parsed labels and their line. Can look up label by name
+# extern_labels - labels declared with .extern, and the line they were declared on
+# global_labels - labels declared with .global, and the line they were declared on
+# included_files - paths of the binary files included with .incbin
 # input_file    - lines of the input assembly source code.
+# base_dir      - folder which the paths of .incbin directives are relative to
 # line_num      - number of current line being parsed in the assembly source code
 # line          - contents of the current assembly line being parsed
 # line_pos      - position of the parser at the current line that is being parsed
@@ -98,17 +191,52 @@ class ASTNode:
 # expected_stack        - This is the actual expected stack, which will keep track of what the parser has parsed so far
 #                           and what it expects next. The 'deepest' expected stack for a line will be saved to
 #                           'error_parsed_buffer', and will be displayed to the user in case of a parse error.
+# backtrack_count       - number of token patterns which were tried and failed, rewinding the parser
+# line_steps            - number of token patterns tried on the current line
+# defn_stack            - names of the instruction definitions the parser is currently trying to match, outermost first
+# data_shapes           - rows of the spec which match data statements, which are parsed in runs
+# data_run_caches       - machine code of the operands of data statements parsed so far, for each data statement shape
+# data_run_lines        - number of lines parsed as part of runs of data statements
 class AsmParser:
 
-    def __init__(self, spec: AsmGrammarSpec, sigma16_labels=False):
+    def __init__(self, spec: AsmGrammarSpec, sigma16_labels=False, int_type_registry: IntTypeRegistry = None,
+                 stats: PipelineStats = None, profiler: ParserProfiler = None,
+                 adaptive_ordering: AdaptiveOrdering = None, max_line_steps=DEFAULT_MAX_LINE_STEPS,
+                 max_depth=DEFAULT_MAX_DEPTH, fast_data_runs=True, allow_incbin=True, output=None):
 
         self.spec = spec        # type: AsmGrammarSpec
+        if int_type_registry is None:
+            int_type_registry = spec.int_type_registry
+        self.int_type_registry = int_type_registry  # type: IntTypeRegistry
+        self.sigma16_labels = sigma16_labels
+        self.stats = stats
+        self.profiler = profiler
+        self.adaptive_ordering = adaptive_ordering
+        self.max_line_steps = max_line_steps
+        self.max_depth = max_depth
+        self.allow_incbin = allow_incbin
+        self.output = output
+
+        self.data_shapes = []   # type: List[DataStatementShape]
+        if fast_data_runs and profiler is None:
+            self.data_shapes = find_data_statement_shapes(spec, self.int_type_registry)
+
+        self.reset()
+
+    # Resets all state left over from parsing a listing, so the same parser can be used to parse another listing.
+    def reset(self):
+
         self.ast = []           # type: List[ASTNode]
+        self.directives = []    # type: List[Directive]
 
         self.labels_map = {}    # type: Dict[int, str]
         self.all_labels = {}    # type: Dict[str, int]
+        self.extern_labels = {}     # type: Dict[str, int]
+        self.global_labels = {}     # type: Dict[str, int]
+        self.included_files = []    # type: List[str]
 
         self.input_file = ""
+        self.base_dir = ""
         self.line_num = 0
         self.line = ""
         self.line_pos = 0
@@ -121,7 +249,16 @@ class AsmParser:
         self.error_bad_buffer = ""
         self.expected_stack = []
 
-        self.sigma16_labels = sigma16_labels
+        self.backtrack_count = 0
+        self.line_steps = 0
+        self.defn_stack = []    # type: List[str]
+
+        self.data_run_caches = {}   # type: Dict[int, Dict[str, bytes]]
+        self.data_run_lines = 0
+        # Line before which no run of data statements starts, after a run was found to be too short.
+        self.data_run_end = 0
+
+        return
 
     def get_ast(self):
         return self.ast
@@ -130,11 +267,34 @@ class AsmParser:
     def parse_asm_listing(self, input_file_path: str):
 
         with open(input_file_path, "r") as f:
-            self.input_file = f.readlines()
+            input_file = f.readlines()
 
-        self.parse_labels()
-        self.parse_asm()
-        self.assign_labels()
+        self.parse_asm_lines(input_file, os.path.dirname(input_file_path))
+
+        return
+
+    # Parses assembly code which is already held in memory, as a list of lines. Paths of .incbin directives are relative
+    # to base_dir, which defaults to the working directory.
+    def parse_asm_lines(self, input_file: List[str], base_dir=""):
+
+        self.reset()
+        self.input_file = input_file
+        self.base_dir = base_dir
+
+        with stage(self.stats, "label pass"):
+            self.parse_labels()
+        with stage(self.stats, "parse pass"):
+            self.parse_asm()
+        with stage(self.stats, "label assignment"):
+            self.assign_labels()
+
+        if self.stats is not None:
+            self.stats.add_count("lines", len(self.input_file))
+            self.stats.add_count("instructions", len(self.ast))
+            self.stats.add_count("ast nodes", sum(node.count_nodes() for node in self.ast))
+            self.stats.add_count("labels", len(self.all_labels))
+            self.stats.add_count("backtracks", self.backtrack_count)
+            self.stats.add_count("data run lines", self.data_run_lines)
 
         return
 
@@ -152,9 +312,23 @@ class AsmParser:
                 self.line_num += 1
                 continue
 
-            self.parse_line_labels()
+            words = self.line.split(None, 1)
+            if words[0].lower() in LINK_DIRECTIVES:
+                self.parse_link_directive(words)
+            else:
+                self.parse_line_labels()
             self.line_num += 1
 
+        for label, line_num in self.extern_labels.items():
+            if label in self.all_labels:
+                print("Assembler ERROR: Label '%s' on line %s is also declared .extern on line %s" % (label, self.all_labels[label]+1, line_num+1), file=self.output)
+                raise ValueError
+
+        for label, line_num in self.global_labels.items():
+            if label not in self.all_labels:
+                print("Assembler ERROR: Label '%s' is declared .global on line %s, but is not defined" % (label, line_num+1), file=self.output)
+                raise ValueError
+
         return
 
     # This is the second pass of the parser. It goes across each line of assembly code and parses it.
@@ -170,11 +344,74 @@ class AsmParser:
                 self.line_num += 1
                 continue
 
+            if len(self.data_shapes) > 0 and self.line_num >= self.data_run_end and self.parse_data_run():
+                continue
+
             self.parse_current_line()
             self.line_num += 1
 
         return
 
+    # Parses a run of data statements starting at the current line into a single AST node, and moves past the run.
+    # Returns False if the current line doesn't start a long enough run, so it should be parsed on its own. A run ends
+    # at the first line which isn't a statement of the same shape, or which has a label, as a label has to point to an
+    # AST node of its own.
+    def parse_data_run(self):
+
+        pos = 0
+        if self.line_num in self.labels_map:
+            pos = len(self.labels_map[self.line_num])
+            if not self.sigma16_labels:
+                pos += len(":")
+            pos = ParseUtils.skip_whitespace(self.line, pos)
+
+        shape_index = None
+        operand = None
+        for shape_index, shape in enumerate(self.data_shapes):
+            operand = shape.match(self.line, pos)
+            if operand is not None:
+                break
+        if operand is None:
+            return False
+
+        shape = self.data_shapes[shape_index]
+        operands = [operand]
+        line_nums = [self.line_num]
+        next_line_num = self.line_num + 1
+        while next_line_num < len(self.input_file):
+            line = self.input_file[next_line_num].strip()
+            if len(line) == 0 or line.startswith(";"):
+                next_line_num += 1
+                continue
+            if next_line_num in self.labels_map:
+                break
+            operand = shape.match(line, 0)
+            if operand is None:
+                break
+            operands.append(operand)
+            line_nums.append(next_line_num)
+            next_line_num += 1
+
+        self.data_run_end = next_line_num
+        if len(operands) < DEFAULT_MIN_RUN_LINES:
+            return False
+
+        cache = self.data_run_caches.setdefault(shape_index, {})
+        data = encode_data_run(shape, operands, self.int_type_registry, cache)
+        if data is None:
+            # One of the operands is invalid. Parse the lines one by one, so the parser reports the error.
+            return False
+
+        node = ASTNode(TokenTypes.PLACEHOLDER, shape.defn_name)
+        node.data = data
+        node.data_lines = line_nums
+        node.set_original_line(self.line, self.line_num)
+        self.add_ast_node(node)
+
+        self.data_run_lines += len(line_nums)
+        self.line_num = line_nums[-1] + 1
+        return True
+
     # Helper method to read a character from the current position in the line, and place it in the token buffer.
     # Returns True is read was successful, False if an error occured (for example, invalid char or eol).
     # to_lower - cast the character to lowercase automatically
@@ -212,6 +449,8 @@ class AsmParser:
         self.reset_error_buffer()
         self.reset_token_buffer()
         self.line_pos = 0
+        self.line_steps = 0
+        self.defn_stack = []
 
         # If there is a label on this line, skip over reading it.
         if self.line_num in self.labels_map:
@@ -223,6 +462,9 @@ class AsmParser:
             if self.line_pos == len(self.line):
                 return
 
+        if self.line[self.line_pos] == "." and self.parse_directive():
+            return
+
         instruction_node = self.parse_instruction()  # type: ASTNode
         instruction_node.set_original_line(self.line, self.line_num)
 
@@ -230,6 +472,144 @@ class AsmParser:
 
         return
 
+    # Parses an assembler directive at the current position of the current line, and adds it to the list of directives.
+    # Returns False if the line doesn't start with the name of a directive, so it should be parsed as an instruction.
+    def parse_directive(self):
+
+        words = self.line[self.line_pos:].split()
+        name = words[0].lower()
+        args = words[1:]
+
+        if name in DATA_DIRECTIVES:
+            self.parse_data_directive(name, args)
+            return True
+        if name in LINK_DIRECTIVES:
+            # Already read during the label pass.
+            return True
+        if name not in SECTION_DIRECTIVES:
+            return False
+
+        section = None
+        address = None
+        if name == ".org":
+            if len(args) != 1:
+                print("Assembler ERROR: Expected '.org ADDRESS' on line %s" % (self.line_num+1), file=self.output)
+                raise ValueError
+            address = self.read_directive_address(args[0])
+        elif name == ".section":
+            if len(args) != 1 and len(args) != 2:
+                print("Assembler ERROR: Expected '.section NAME [ADDRESS]' on line %s" % (self.line_num+1), file=self.output)
+                raise ValueError
+            section = args[0]
+            if len(args) == 2:
+                address = self.read_directive_address(args[1])
+
+        self.directives.append(Directive(name, section, address, len(self.ast), self.line_num))
+        return True
+
+    # Parses a directive which emits bulk data, and adds a node holding the data to the AST.
+    def parse_data_directive(self, name, args: List[str]):
+
+        if name == ".repeat":
+            if len(args) < 2:
+                print("Assembler ERROR: Expected '.repeat COUNT INSTRUCTION' on line %s" % (self.line_num+1), file=self.output)
+                raise ValueError
+            count = self.read_directive_int(args[0], "repeat count")
+            # Parse the rest of the line as an instruction, which starts after the count.
+            self.line_pos = ParseUtils.skip_whitespace(self.line, self.line_pos + len(name))
+            self.line_pos = ParseUtils.skip_whitespace(self.line, self.line_pos + len(args[0]))
+            node = self.parse_instruction()
+            node.repeat = count
+        elif name == ".fill":
+            if len(args) != 1 and len(args) != 2:
+                print("Assembler ERROR: Expected '.fill SIZE [PATTERN]' on line %s" % (self.line_num+1), file=self.output)
+                raise ValueError
+            size = self.read_directive_int(args[0], "fill size")
+            pattern = self.read_fill_pattern(args[1]) if len(args) == 2 else b"\x00"
+            node = ASTNode(None, name)
+            node.data = pattern * (size // len(pattern)) + pattern[:size % len(pattern)]
+        else:
+            if not self.allow_incbin:
+                print("Assembler ERROR: .incbin is not allowed, but is used on line %s" % (self.line_num+1), file=self.output)
+                raise ValueError
+            if len(args) < 1 or len(args) > 3:
+                print("Assembler ERROR: Expected '.incbin PATH [OFFSET [LENGTH]]' on line %s" % (self.line_num+1), file=self.output)
+                raise ValueError
+            offset = self.read_directive_int(args[1], "offset") if len(args) > 1 else 0
+            length = self.read_directive_int(args[2], "length") if len(args) > 2 else None
+            node = ASTNode(None, name)
+            node.data = self.read_binary_file(args[0].strip("\"'"), offset, length)
+
+        node.set_original_line(self.line, self.line_num)
+        self.add_ast_node(node)
+        return
+
+    # Reads the labels declared by an .extern or .global directive on the current line, split into the directive and the
+    # rest of the line.
+    def parse_link_directive(self, words: List[str]):
+
+        name = words[0].lower()
+        labels = [label.strip() for label in words[1].split(",")] if len(words) > 1 else []
+        if len(labels) == 0 or any(len(label) == 0 for label in labels):
+            print("Assembler ERROR: Expected '%s LABEL[, LABEL...]' on line %s" % (name, self.line_num+1), file=self.output)
+            raise ValueError
+
+        declared_labels = self.extern_labels if name == ".extern" else self.global_labels
+        for label in labels:
+            declared_labels.setdefault(label, self.line_num)
+        return
+
+    # Reads the pattern of a .fill directive, a hex number whose digits give the bytes of the pattern.
+    def read_fill_pattern(self, pattern_string):
+        hex_digits = pattern_string[2:] if pattern_string.lower().startswith("0x") else pattern_string
+        if len(hex_digits) % 2 != 0:
+            hex_digits = "0" + hex_digits
+        try:
+            pattern = bytes.fromhex(hex_digits)
+        except ValueError:
+            pattern = b""
+        if len(pattern) == 0:
+            print("Assembler ERROR: Invalid fill pattern '%s' on line %s. Expected hex bytes, such as 0xff or 0xdeadbeef" % (pattern_string, self.line_num+1), file=self.output)
+            raise ValueError
+        return pattern
+
+    # Memory maps a binary file included with .incbin, and returns a view of the included bytes. The view keeps the file
+    # mapped until the machine code has been written.
+    def read_binary_file(self, path, offset, length: Optional[int]):
+        path = os.path.join(self.base_dir, path)
+        if not os.path.isfile(path):
+            print("Assembler ERROR: Binary file '%s' included on line %s does not exist" % (path, self.line_num+1), file=self.output)
+            raise ValueError
+        self.included_files.append(path)
+
+        file_size = os.path.getsize(path)
+        if length is None:
+            length = max(file_size - offset, 0)
+        if offset + length > file_size:
+            print("Assembler ERROR: Binary file '%s' included on line %s has %s bytes, which is too few to include %s bytes at offset %s" % (path, self.line_num+1, file_size, length, offset), file=self.output)
+            raise ValueError
+        if length == 0:
+            return b""
+
+        with open(path, "rb") as bin_file:
+            mapped_file = mmap.mmap(bin_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped_file)[offset:offset + length]
+
+    # Reads a non-negative int argument of a directive. Accepts decimal, or hex with a 0x prefix.
+    def read_directive_int(self, int_string, description):
+        try:
+            value = int(int_string, 0)
+        except ValueError:
+            value = -1
+        if value < 0:
+            print("Assembler ERROR: Invalid %s '%s' on line %s" % (description, int_string, self.line_num+1), file=self.output)
+            raise ValueError
+        return value
+
+    # Reads the address argument of a directive.
+    def read_directive_address(self, address_string):
+        return self.read_directive_int(address_string, "address")
+
     # Parses an instruction at the current position of the current line of assembly code. Returns an ASTNode containing
     # the parsed instruction, or displays an error describing why it wasn't able to parse the instruction.
     def parse_instruction(self) -> ASTNode:
@@ -238,10 +618,10 @@ class AsmParser:
         is_match, children, bitfield_modifiers = self.match_defn(instruction_defn, top_level=True)
 
         if not is_match:
-            print("Assembler ERROR: Unable to parse INSTRUCTION on line %s" % (self.line_num+1))
-            print("PARSED: " + self.error_parsed_buffer)
-            print("EXPECTED: " + self.error_expected_buffer)
-            print("INSTEAD GOT: " + self.error_bad_buffer)
+            print("Assembler ERROR: Unable to parse INSTRUCTION on line %s" % (self.line_num+1), file=self.output)
+            print("PARSED: " + self.error_parsed_buffer, file=self.output)
+            print("EXPECTED: " + self.error_expected_buffer, file=self.output)
+            print("INSTEAD GOT: " + self.error_bad_buffer, file=self.output)
             raise ValueError
 
         return ASTNode(TokenTypes.PLACEHOLDER, "INSTRUCTION", children, bitfield_modifiers)
@@ -255,8 +635,19 @@ class AsmParser:
     def match_defn(self, defn: AsmInstructionDefinition, top_level=False):
 
         possible_patterns = defn.spec_patterns
+        profiler = self.profiler
+
+        self.defn_stack.append(defn.name)
+        if len(self.defn_stack) > self.max_depth:
+            self.error_budget_exceeded("nesting depth limit of %s definitions" % self.max_depth)
 
-        for defn_row in range(len(possible_patterns)):
+        rows = None
+        if self.adaptive_ordering is not None:
+            rows = self.adaptive_ordering.orders.get(defn.name)
+        if rows is None:
+            rows = range(len(possible_patterns))
+
+        for defn_row in rows:
             token_pattern = possible_patterns[defn_row].token_patterns
             bitfield_modifiers = possible_patterns[defn_row].bitfield_modifiers
 
@@ -264,6 +655,13 @@ class AsmParser:
             save_token_buffer = self.token_buffer
             save_expected_stack = self.expected_stack.copy()
 
+            self.line_steps += 1
+            if self.line_steps > self.max_line_steps:
+                self.error_budget_exceeded("step budget of %s token patterns" % self.max_line_steps)
+
+            if profiler is not None:
+                profiler.begin_attempt()
+
             pattern_match, children = self.try_match_token_pattern(token_pattern)
 
             if top_level and pattern_match:
@@ -273,17 +671,38 @@ class AsmParser:
                 if not pattern_match:
                     self.error_expected_empty_endline()
 
+            if profiler is not None:
+                profiler.end_attempt(defn, defn_row, pattern_match, self.line_pos - save_line_pos)
+
             if pattern_match:
+                if self.adaptive_ordering is not None:
+                    self.adaptive_ordering.record_hit(defn.name, defn_row)
                 bitfield_modifiers = self.process_int_placeholders(bitfield_modifiers, children)
+                self.defn_stack.pop()
                 return True, children, bitfield_modifiers
             else:
                 self.line_pos = save_line_pos
                 self.token_buffer = save_token_buffer
                 self.expected_stack = save_expected_stack
+                self.backtrack_count += 1
                 continue
 
+        self.defn_stack.pop()
         return False, [], []
 
+    # Aborts parsing of the current line because it exceeded one of the parser's budgets, naming the definitions the
+    # parser was nested in at the time.
+    def error_budget_exceeded(self, budget_description):
+        stack = self.defn_stack
+        if len(stack) > 2 * STACK_REPORT_ENDS + 1:
+            stack = stack[:STACK_REPORT_ENDS] + ["... (%s more)" % (len(stack) - 2 * STACK_REPORT_ENDS)] + \
+                    stack[-STACK_REPORT_ENDS:]
+
+        print("Assembler ERROR: Gave up parsing line %s, exceeded the %s" % (self.line_num+1, budget_description), file=self.output)
+        print("LINE: " + self.line, file=self.output)
+        print("DEFINITIONS: " + " -> ".join(stack), file=self.output)
+        raise ValueError
+
     # Try to match a token pattern from an instruction definition against the characters at the current position. If
     # successful, return any child AST nodes produced by the match.
     def try_match_token_pattern(self, token_pattern):
@@ -308,7 +727,9 @@ class AsmParser:
             self.push_expected(token_type, token_value)
 
             # Different types of match functions will be used depending on the type of token being matched.
-            if token_type == TokenTypes.WHITESPACE:
+            if token_type == TokenTypes.LITERAL:
+                token_match, ast_node = self.try_match_literal_token(token_value)
+            elif token_type == TokenTypes.WHITESPACE:
                 token_match = self.try_match_whitespace_token(token_value)
             elif token_type == TokenTypes.INT_TOKEN:
                 token_match, ast_node = self.try_match_int_token(token_value)
@@ -319,7 +740,7 @@ class AsmParser:
             elif token_type == TokenTypes.PLACEHOLDER:
                 token_match, placeholder_children, bitfield_modifiers = self.try_match_placeholder_token(token_value)
             else:
-                print("ERROR. Unimplemented token type?")
+                print("ERROR. Unimplemented token type?", file=self.output)
                 raise ValueError
 
             if token_match:
@@ -356,19 +777,15 @@ class AsmParser:
 
         return token_match
 
-    # Try to match an int token. Means the parser expects a string of characters from a character whitelist (the whitelist
-    # comes from the plugin system) to be present at the current position.
+    # Try to match an int token. Means the parser expects a string of characters matching the int type's scan regex to
+    # be present at the current position. The regex is derived from the character whitelist of the type, or supplied
+    # by the plugin system. The scanned string is then validated by the plugin system.
     def try_match_int_token(self, token_value):
         token_match = False
         ast_node = ASTNode()
 
-        valid_chars = AsmIntTypes.get_valid_chars(token_value)
-
-        if self.read_line_char(to_lower=False, valid_chars=valid_chars) is not False:
-            while self.read_line_char(to_lower=False, valid_chars=valid_chars):
-                token_match = False
-
-            if AsmIntTypes.validate_integer(token_value, self.token_buffer):
+        if self.scan_token(token_value):
+            if self.int_type_registry.validate_integer(token_value, self.token_buffer):
                 ast_node = ASTNode(TokenTypes.INT_TOKEN, token_value + " " + self.token_buffer, None)
                 token_match = True
 
@@ -379,13 +796,8 @@ class AsmParser:
         token_match = False
         ast_node = ASTNode()
 
-        valid_chars = ParseUtils.valid_identifier_chars
-
-        if self.read_line_char(to_lower=False, valid_chars=valid_chars) is not False:
-            while self.read_line_char(to_lower=False, valid_chars=valid_chars):
-                continue
-
-            if self.token_buffer in self.all_labels:
+        if self.scan_token(token_value):
+            if self.token_buffer in self.all_labels or self.token_buffer in self.extern_labels:
                 ast_node = ASTNode(TokenTypes.LABEL_TOKEN, token_value + " " + self.token_buffer, None)
                 token_match = True
             else:
@@ -395,6 +807,16 @@ class AsmParser:
 
         return token_match, ast_node
 
+    # Matches the scan regex of an int/label type at the current position with a single regex match. If successful, the
+    # matched characters are placed in the token buffer and the position is moved past them.
+    def scan_token(self, token_type_name):
+        m = self.int_type_registry.get_scan_pattern(token_type_name).match(self.line, self.line_pos)
+        if m is None or m.end() == self.line_pos:
+            return False
+        self.token_buffer += m.group()
+        self.line_pos = m.end()
+        return True
+
     # Try to match a raw token. Means the parser expects EXACTLY token_value to be at the current position.
     def try_match_raw_token(self, token_value):
         token_match = False
@@ -416,6 +838,30 @@ class AsmParser:
 
         return token_match, ast_node
 
+    # Try to match a literal token, a run of raw tokens and whitespace merged by the spec optimizer. Matching it is
+    # equivalent to matching each of the raw and whitespace tokens in turn, but compares whole slices of the line at
+    # once instead of reading it character by character. If the match fails, the position is left at the start of the
+    # part of the literal which didn't match.
+    def try_match_literal_token(self, token_value):
+        line = self.line
+        pos = self.line_pos
+
+        for part_num, part in enumerate(token_value.split(" ")):
+            if part_num > 0:
+                if pos >= len(line) or (line[pos] != ' ' and line[pos] != '\t'):
+                    self.line_pos = pos
+                    return False, None
+                pos = ParseUtils.skip_whitespace(line, pos)
+
+            end_pos = pos + len(part)
+            if line[pos:end_pos].lower() != part:
+                self.line_pos = pos
+                return False, None
+            pos = end_pos
+
+        self.line_pos = pos
+        return True, ASTNode(TokenTypes.LITERAL, token_value, None)
+
     # Matches a placeholder token. This is done by looking up the placeholder token, and then trying to recursively
     # match it. Returns any children produced by such a match.
     def try_match_placeholder_token(self, token_value):
@@ -473,16 +919,16 @@ class AsmParser:
                     if ast_node.token_type == TokenTypes.INT_TOKEN and ast_node.token_value.startswith(int_placeholder_name + " "):
                         found_child = True
                         raw_int_string = ast_node.token_value[len(int_placeholder_name + " "):]
-                        int_bit_string = AsmIntTypes.emit_bits(int_placeholder_name, raw_int_string)
+                        int_bit_string = self.int_type_registry.emit_bits(int_placeholder_name, raw_int_string)
 
                         if not self.is_valid_bitstring(int_bit_string):
-                            print("ERROR: Emit of a '%s' with value '%s' returned bitstring '%s', which is invalid. Bitstrings may only contain 1 and 0 characters." % (int_placeholder_name, raw_int_string, int_bit_string))
+                            print("ERROR: Emit of a '%s' with value '%s' returned bitstring '%s', which is invalid. Bitstrings may only contain 1 and 0 characters." % (int_placeholder_name, raw_int_string, int_bit_string), file=self.output)
                             raise ValueError
 
                         bitfield_defn_index = self.spec.bitfield_indexes_map[b.bitfield_name]
                         bitfield_defn = self.spec.bitfields[bitfield_defn_index]
                         if len(int_bit_string) != bitfield_defn.size:
-                            print("ERROR: When parsing a '%s' with value '%s', the plugin returned the bitstream '%s' of length %s. However, the bitfield named '%s' (which this bitstream value is being assigned to) expects a bitstream of length %s" % (int_placeholder_name, raw_int_string, int_bit_string, len(int_bit_string), b.bitfield_name, bitfield_defn.size))
+                            print("ERROR: When parsing a '%s' with value '%s', the plugin returned the bitstream '%s' of length %s. However, the bitfield named '%s' (which this bitstream value is being assigned to) expects a bitstream of length %s" % (int_placeholder_name, raw_int_string, int_bit_string, len(int_bit_string), b.bitfield_name, bitfield_defn.size), file=self.output)
                             raise ValueError
 
                         new_modifier = BitfieldModifier(ModifierTypes.MODIFIER, b.bitfield_name, int_bit_string)
@@ -490,11 +936,11 @@ class AsmParser:
                         break
 
                 if not found_child:
-                    print("ERROR: We have a placeholder bitfield modifier '%s', but none of the child AST nodes are of type INT_TOKEN with a matching name." % int_placeholder_name)
+                    print("ERROR: We have a placeholder bitfield modifier '%s', but none of the child AST nodes are of type INT_TOKEN with a matching name." % int_placeholder_name, file=self.output)
                     raise ValueError
 
             else:
-                print("ASSERT ERROR: Unknown type of bitfield modifier being used?")
+                print("ASSERT ERROR: Unknown type of bitfield modifier being used?", file=self.output)
                 raise ValueError
         return processed_bitfields
 
@@ -517,7 +963,7 @@ class AsmParser:
 
     # Push the next expected token onto the expected stack.
     def push_expected(self, token_type, token_value):
-        if token_type == TokenTypes.RAW_TOKEN:
+        if token_type == TokenTypes.RAW_TOKEN or token_type == TokenTypes.LITERAL:
             self.expected_stack.append("'" + token_value + "'")
         elif token_type == TokenTypes.WHITESPACE:
             self.expected_stack.append("' '")
@@ -587,7 +1033,7 @@ class AsmParser:
 
         if is_label:
             if possible_label in self.all_labels:
-                print("ERROR: Duplicate label '%s' on lines %s and %s" % (possible_label, self.line_num+1, self.all_labels[possible_label]+1))
+                print("ERROR: Duplicate label '%s' on lines %s and %s" % (possible_label, self.line_num+1, self.all_labels[possible_label]+1), file=self.output)
                 raise ValueError
             self.labels_map[self.line_num] = possible_label
             self.all_labels[possible_label] = self.line_num
@@ -0,0 +1,400 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Deque, Dict, List, Optional
+
+from asm_int_types import IntTypeRegistry
+from asm_server import AssemblerService, remove_stale_socket
+
+# This module implements the asyncio front end of the assembler daemon, used when the daemon is started with
+# '--workers'. It accepts many concurrent assemble jobs over the same newline-delimited JSON protocol as asm_server.py,
+# and dispatches the CPU bound parsing and encoding to a pool of worker processes. Each worker process loads the
+# plugins once, and keeps its own AssemblerService, so specs and parsers are reused per architecture across jobs.
+#
+# On top of the asm_server.py protocol, requests can have the following fields:
+#   client  - name used for fair scheduling. Jobs of different clients are dispatched round-robin, so one client
+#               submitting a large burst of jobs can't starve the others. Defaults to one client per connection.
+#   timeout - seconds after which the job is stopped and an error of the 'timeout' stage is returned. A running job is
+#               stopped by killing its worker process, which is replaced by a new one.
+#
+# A request of the form {"cancel": <id>} cancels the job with that id, submitted by the same client. The reply has
+# 'cancelled' set to true if a queued or running job was found. Jobs on one connection run concurrently, so their
+# replies can arrive in a different order than the requests; use 'id' to match them.
+#
+# When more than max_queue jobs are waiting, new jobs are rejected straight away with an error of the 'queue' stage.
+
+DEFAULT_MAX_QUEUE = 1024
+
+# Maximum size of a request line. Requests carry whole listings, so the asyncio default of 64 KiB is far too small.
+MAX_REQUEST_SIZE = 256 * 1024 * 1024
+
+# Assembler service of a worker process, created by init_worker when the process starts.
+worker_service = None  # type: Optional[AssemblerService]
+
+
+# Returns the multiprocessing context worker processes are started with. Workers are started from a fork server where
+# the platform has one, so they don't inherit the threads, sockets or signal handlers of the main process. Elsewhere,
+# such as on Windows, they are started as new interpreters.
+def get_worker_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def init_worker(plugin_places, spec_cache_dir):
+    global worker_service
+
+    int_type_registry = IntTypeRegistry(plugin_places)
+    int_type_registry.load_plugins()
+    worker_service = AssemblerService(int_type_registry, spec_cache_dir=spec_cache_dir)
+
+    # Interrupting the daemon should stop it through the main process, not by killing the workers mid-job.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    return
+
+
+def run_job(request):
+    return worker_service.handle_request(request)
+
+
+def ping_worker():
+    return os.getpid()
+
+
+def error_reply(request, stage, message):
+    reply = {"ok": False, "errors": [{"stage": stage, "message": message}]}
+    if isinstance(request, dict) and "id" in request:
+        reply["id"] = request["id"]
+    return reply
+
+
+# A single assemble job. 'result' is resolved with the reply once the job is done, cancelled, or has timed out.
+class Job:
+
+    def __init__(self, client, request, result: asyncio.Future):
+        self.client = client
+        self.request = request
+        self.result = result
+        self.running = False
+        return
+
+    def get_id(self):
+        if isinstance(self.request, dict):
+            return self.request.get("id")
+        return None
+
+    def finish(self, reply):
+        if not self.result.done():
+            self.result.set_result(reply)
+        return
+
+
+# A worker process, which runs one job at a time. Each worker has a process pool of its own, so a job which times out
+# or is cancelled can be stopped by killing its worker process, without affecting the jobs running on other workers.
+# executor - process pool holding the single worker process
+# pid - process id of the worker process
+# job - job the worker is running, or None if it's idle
+class Worker:
+
+    def __init__(self, executor: ProcessPoolExecutor, pid):
+        self.executor = executor
+        self.pid = pid
+        self.job = None  # type: Optional[Job]
+        return
+
+
+# Schedules jobs onto the worker processes. Waiting jobs are kept in a queue per client, and whenever a worker is free
+# the next job is taken from the clients in round-robin order. A worker which crashes, or which is killed to stop a job
+# which timed out or was cancelled, is replaced by a new worker process.
+# executor_factory - function returning a new process pool with a single worker process
+# max_workers - number of worker processes, which is the number of jobs which can run at the same time
+# max_queue - maximum number of waiting jobs, new jobs are rejected when it is reached
+# default_timeout - timeout in seconds used for jobs which don't specify their own. None for no timeout.
+class JobScheduler:
+
+    def __init__(self, executor_factory, max_workers, max_queue=DEFAULT_MAX_QUEUE, default_timeout=None):
+        self.executor_factory = executor_factory
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.default_timeout = default_timeout
+
+        self.workers = []  # type: List[Worker]
+        self.idle_workers = deque()  # type: Deque[Worker]
+        self.queues = OrderedDict()  # type: Dict[str, Deque[Job]]
+        self.queued_count = 0
+        self.jobs_by_id = {}  # type: Dict[tuple, Job]
+        return
+
+    # Starts all worker processes up front, so the plugins are loaded before the first job arrives instead of delaying
+    # it. Raises if a worker fails to start, for example because a plugin can't be loaded.
+    async def start(self):
+        await asyncio.gather(*[self.start_worker() for _ in range(self.max_workers)])
+        return
+
+    # Starts a new worker process, and adds it to the idle workers once it's running.
+    async def start_worker(self):
+        executor = self.executor_factory()
+        try:
+            pid = await asyncio.get_running_loop().run_in_executor(executor, ping_worker)
+        except BaseException:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+        worker = Worker(executor, pid)
+        self.workers.append(worker)
+        self.idle_workers.append(worker)
+        self.dispatch()
+        return
+
+    # Starts a worker process in place of one which crashed or was killed.
+    def replace_worker(self, worker: Worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+        worker.job = None
+        worker.executor.shutdown(wait=False, cancel_futures=True)
+
+        def worker_started(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is not None:
+                print("Daemon ERROR: Failed to start a worker process: %r" % task.exception())
+
+        asyncio.ensure_future(self.start_worker()).add_done_callback(worker_started)
+        return
+
+    # Stops a running job by killing its worker process, which is then replaced.
+    def stop_running(self, job: Job):
+        for worker in self.workers:
+            if worker.job is job:
+                try:
+                    os.kill(worker.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                self.replace_worker(worker)
+                break
+        return
+
+    # Stops all worker processes.
+    def shutdown(self):
+        for worker in self.workers:
+            worker.executor.shutdown(wait=False, cancel_futures=True)
+        self.workers = []
+        self.idle_workers.clear()
+        return
+
+    # Submits a job, and waits until its reply is ready.
+    async def submit(self, client, request):
+        if self.queued_count >= self.max_queue:
+            return error_reply(request, "queue", "Assembler queue is full, try again later")
+
+        timeout = self.default_timeout
+        if isinstance(request, dict) and "timeout" in request:
+            timeout = request["timeout"]
+            if not isinstance(timeout, (int, float)) or timeout <= 0:
+                return error_reply(request, "request", "Request field 'timeout' must be a positive number")
+
+        job = Job(client, request, asyncio.get_running_loop().create_future())
+        job_id = job.get_id()
+        if job_id is not None:
+            # Jobs are cancelled by id, so ids must be unique among the jobs of a client which haven't finished yet.
+            if not isinstance(job_id, (str, int, float)):
+                return error_reply(request, "request", "Request field 'id' must be a string or a number")
+            if (client, job_id) in self.jobs_by_id:
+                return error_reply(request, "request", "A job with id %s is already in flight" % json.dumps(job_id))
+            self.jobs_by_id[(client, job_id)] = job
+
+        self.queues.setdefault(client, deque()).append(job)
+        self.queued_count += 1
+        self.dispatch()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.result), timeout)
+        except asyncio.TimeoutError:
+            self.stop(job)
+            job.finish(error_reply(request, "timeout", "Job did not finish within %s seconds" % timeout))
+            return job.result.result()
+        finally:
+            if job_id is not None and self.jobs_by_id.get((client, job_id)) is job:
+                del self.jobs_by_id[(client, job_id)]
+
+    # Cancels a queued or running job. A running job is stopped by killing its worker process, and the client gets a
+    # 'cancelled' error reply straight away.
+    def cancel(self, client, job_id):
+        if not isinstance(job_id, (str, int, float)):
+            return False
+        job = self.jobs_by_id.get((client, job_id))
+        if job is None or job.result.done():
+            return False
+
+        self.stop(job)
+        job.finish(error_reply(job.request, "cancelled", "Job was cancelled"))
+        return True
+
+    # Removes a job from its queue, or stops it if it's already running.
+    def stop(self, job: Job):
+        if job.running:
+            self.stop_running(job)
+            return
+
+        queue = self.queues.get(job.client)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            self.queued_count -= 1
+            if len(queue) == 0:
+                del self.queues[job.client]
+        return
+
+    # Starts queued jobs while there are idle workers, taking one job from each client in turn.
+    def dispatch(self):
+        loop = asyncio.get_running_loop()
+
+        while len(self.idle_workers) > 0 and self.queued_count > 0:
+            client, queue = self.queues.popitem(last=False)
+            job = queue.popleft()
+            self.queued_count -= 1
+            if len(queue) > 0:
+                self.queues[client] = queue
+
+            worker = self.idle_workers.popleft()
+            try:
+                work = loop.run_in_executor(worker.executor, run_job, job.request)
+            except BrokenProcessPool:
+                # The worker died while it was idle. Put the job back at the head of the queue, for the next worker.
+                self.replace_worker(worker)
+                self.queues.setdefault(client, deque()).appendleft(job)
+                self.queues.move_to_end(client, last=False)
+                self.queued_count += 1
+                continue
+
+            worker.job = job
+            job.running = True
+            work.add_done_callback(lambda w, j=job, wk=worker: self.job_done(wk, j, w))
+
+        return
+
+    def job_done(self, worker: Worker, job: Job, work: asyncio.Future):
+        # The worker was killed and replaced if the job was stopped, so it's only reused if it's still running this job.
+        if worker.job is job:
+            if not work.cancelled() and isinstance(work.exception(), BrokenProcessPool):
+                self.replace_worker(worker)
+            else:
+                worker.job = None
+                self.idle_workers.append(worker)
+
+        if work.cancelled():
+            job.finish(error_reply(job.request, "cancelled", "Job was cancelled"))
+        elif work.exception() is not None:
+            job.finish(error_reply(job.request, "worker", "Worker failed: %r" % work.exception()))
+        else:
+            job.finish(work.result())
+
+        self.dispatch()
+        return
+
+
+# Asyncio server accepting connections on a Unix socket, and submitting their requests to the scheduler.
+class AsyncAssemblerServer:
+
+    def __init__(self, scheduler: JobScheduler):
+        self.scheduler = scheduler
+        self.connection_count = 0
+        return
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connection_count += 1
+        default_client = "connection-%s" % self.connection_count
+        tasks = set()
+
+        async def handle_line(line):
+            try:
+                request = json.loads(line.decode("utf-8"))
+            except ValueError as e:
+                reply = error_reply(None, "request", "Invalid JSON: %s" % e)
+            else:
+                client = default_client
+                if isinstance(request, dict) and isinstance(request.get("client"), str):
+                    client = request["client"]
+
+                if isinstance(request, dict) and "cancel" in request:
+                    cancelled = self.scheduler.cancel(client, request["cancel"])
+                    reply = {"id": request["cancel"], "ok": True, "cancelled": cancelled}
+                else:
+                    reply = await self.scheduler.submit(client, request)
+
+            writer.write(json.dumps(reply).encode("utf-8") + b"\n")
+            await writer.drain()
+
+        try:
+            while True:
+                line = await reader.readline()
+                if len(line) == 0:
+                    break
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+
+                task = asyncio.ensure_future(handle_line(line))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if len(tasks) > 0:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+        return
+
+
+async def serve_async(socket_path, scheduler: JobScheduler):
+
+    await scheduler.start()
+
+    server = AsyncAssemblerServer(scheduler)
+    unix_server = await asyncio.start_unix_server(server.handle_connection, path=socket_path,
+                                                   limit=MAX_REQUEST_SIZE)
+
+    loop = asyncio.get_running_loop()
+    stop = loop.create_future()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        loop.add_signal_handler(signum, lambda: stop.done() or stop.set_result(None))
+
+    print("Assembler daemon listening on '%s' with %s workers" % (socket_path, scheduler.max_workers))
+
+    try:
+        async with unix_server:
+            await stop
+    finally:
+        scheduler.shutdown()
+
+    return
+
+
+# Starts the asyncio daemon on the given Unix socket path, with a pool of worker processes, and serves requests until
+# interrupted or terminated.
+# workers - number of worker processes. 0 uses one worker per CPU.
+def serve(socket_path, workers=0, max_queue=DEFAULT_MAX_QUEUE, default_timeout=None, plugin_places=None,
+          spec_cache_dir=None):
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    remove_stale_socket(socket_path)
+
+    # Workers don't inherit the event loop's threads, sockets or signal handlers, see get_worker_context.
+    def executor_factory():
+        return ProcessPoolExecutor(max_workers=1, mp_context=get_worker_context(),
+                                   initializer=init_worker, initargs=(plugin_places, spec_cache_dir))
+
+    scheduler = JobScheduler(executor_factory, workers, max_queue=max_queue, default_timeout=default_timeout)
+
+    try:
+        asyncio.run(serve_async(socket_path, scheduler))
+    finally:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+    return
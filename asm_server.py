@@ -0,0 +1,269 @@
+import base64
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import stat
+import sys
+from typing import Dict, Tuple
+
+from asm_grammar_spec import AsmGrammarSpec
+from asm_int_types import IntTypeRegistry
+from assembler import Assembler
+from bitstream_gen import DEFAULT_IMAGEBASE
+from obj_writer import ObjectWriter
+from output_writers import get_text_output
+from template_registry import TemplateRegistry
+
+# This module implements the persistent assembler daemon. The daemon loads the plugins once, keeps every spec it has
+# read in memory, and accepts assemble requests over a local Unix socket. This way the cost of interpreter startup,
+# imports, plugin discovery and spec parsing is paid once, instead of once per assembled file.
+#
+# The protocol is newline-delimited JSON. Each request is a single line containing a JSON object:
+#
+#   spec            - path of the spec file (REQUIRED)
+#   source          - assembly source code text (REQUIRED)
+#   imagebase       - memory address the code will be loaded at. Defaults to 0x1000.
+#   sigma16_labels  - parse labels as Sigma16 labels. Defaults to false.
+#   outputs         - list of requested outputs: "bin", "sigma16", "ihex", "srec", "c_array", "object". Defaults to
+#                       ["bin"].
+#   template_path   - path of the template object file. Required if the "object" output is requested.
+#   id              - optional value which is copied into the reply, to match replies to requests.
+#
+# Requests can't include binary files with .incbin, so a client can't make the daemon read files on its behalf. Such
+# requests fail with an error of the 'parse' stage.
+#
+# Each reply is a single line containing a JSON object. If assembly succeeded, 'ok' is true and 'outputs' holds the
+# requested outputs ("bin" and "object" are base64 encoded, the other formats are text). If assembly failed, 'ok' is false, and
+# 'errors' holds a list of errors, each with the 'stage' which failed, the error 'message', and the 'line' of the
+# assembly source code which caused the error (if known).
+
+OUTPUT_TYPES = ["bin", "sigma16", "ihex", "srec", "c_array", "object"]
+
+
+# Raised when a request is malformed. Reported to the client as an error of the 'request' stage.
+class RequestError(Exception):
+    pass
+
+
+# Holds the loaded plugins, specs and object templates, and assembles requests. Specs are loaded the first time they are
+# used, and are reloaded if the spec file changes. Templates are held in a TemplateRegistry.
+# int_type_registry - registry holding the loaded plugins, shared by all specs
+# spec_cache_dir - optional folder for the compiled spec cache
+class AssemblerService:
+
+    def __init__(self, int_type_registry: IntTypeRegistry, spec_cache_dir=None):
+        self.int_type_registry = int_type_registry
+        self.spec_cache_dir = spec_cache_dir
+        self.specs = {}  # type: Dict[str, Tuple[float, AsmGrammarSpec]]
+        self.assemblers = {}  # type: Dict[Tuple[str, bool], Assembler]
+        self.template_registry = TemplateRegistry()
+        return
+
+    # Returns the spec read from a spec file, loading it if it isn't loaded yet or if the file changed since it was loaded.
+    # Errors found while loading the spec are printed to output, or to the console if it's None.
+    def get_spec(self, spec_path, output=None) -> AsmGrammarSpec:
+        spec_path = os.path.abspath(spec_path)
+        mtime = os.path.getmtime(spec_path)
+
+        if spec_path in self.specs and self.specs[spec_path][0] == mtime:
+            return self.specs[spec_path][1]
+
+        asm_grammar = AsmGrammarSpec(self.int_type_registry, output=output)
+        asm_grammar.read_spec(spec_path, cache_dir=self.spec_cache_dir)
+        self.specs[spec_path] = (mtime, asm_grammar)
+
+        return asm_grammar
+
+    # Returns an assembler for the spec read from a spec file. Assemblers are reused between requests for the same spec,
+    # as they reset their parser before assembling each listing. A new assembler is created if the spec was reloaded.
+    # The assemblers reject .incbin, as the source code comes from clients.
+    def get_assembler(self, spec_path, sigma16_labels, output=None) -> Assembler:
+        asm_grammar = self.get_spec(spec_path, output)
+        key = (os.path.abspath(spec_path), sigma16_labels)
+        assembler = self.assemblers.get(key)
+        if assembler is None or assembler.spec is not asm_grammar:
+            assembler = Assembler(asm_grammar, sigma16_labels=sigma16_labels, allow_incbin=False)
+            self.assemblers[key] = assembler
+        return assembler
+
+    # Handles a single decoded request, and returns the reply. Never raises for errors in the request or in the
+    # assembled code, those are reported in the reply instead.
+    def handle_request(self, request) -> dict:
+        reply = self.assemble(request)
+        if reply["ok"]:
+            reply["outputs"] = self.encode_outputs(reply["outputs"])
+        return reply
+
+    # Assembles a single decoded request, and returns the reply with the raw outputs (bytes for "bin" and "object",
+    # text for "sigma16"). Error messages printed while handling the request are written to a buffer of the request, and
+    # become the message of the reported error. Unexpected exceptions, for example from a buggy plugin, are reported the same way, so the
+    # client always gets a reply.
+    def assemble(self, request) -> dict:
+        reply = {}
+        if isinstance(request, dict) and "id" in request:
+            reply["id"] = request["id"]
+
+        stage = "request"
+        captured_output = io.StringIO()
+
+        try:
+            spec_path, source, imagebase, sigma16_labels, outputs, template_path = self.read_request(request)
+
+            stage = "spec"
+            assembler = self.get_assembler(spec_path, sigma16_labels, captured_output)
+
+            stage = "assemble"
+            result = assembler.assemble_lines(source.splitlines(keepends=True), imagebase=imagebase)
+            if not result.ok:
+                reply["ok"] = False
+                reply["errors"] = [d.to_dict() for d in result.diagnostics]
+                return reply
+
+            stage = "output"
+            # Directives may have moved the first byte of machine code away from the imagebase.
+            address = result.segments[0][0] if len(result.segments) > 0 else imagebase
+            reply["address"] = address
+            reply["outputs"] = self.build_outputs(result.machine_code, outputs, template_path, address,
+                                                  captured_output)
+
+        except (ValueError, KeyError, IndexError, OSError, RequestError) as e:
+            reply["ok"] = False
+            reply["errors"] = [{"stage": stage, "message": Assembler.get_error_message(captured_output, e)}]
+            return reply
+        except Exception as e:
+            reply["ok"] = False
+            reply["errors"] = [{"stage": stage, "message": "Unexpected %s: %s" % (type(e).__name__, e)}]
+            return reply
+
+        reply["ok"] = True
+        return reply
+
+    # Checks the request for required fields and correct types, and fills in defaults for optional fields.
+    @staticmethod
+    def read_request(request):
+        if not isinstance(request, dict):
+            raise RequestError("Request must be a JSON object")
+
+        for key in ["spec", "source"]:
+            if not isinstance(request.get(key), str):
+                raise RequestError("Request field '%s' is required and must be a string" % key)
+
+        imagebase = request.get("imagebase", DEFAULT_IMAGEBASE)
+        if not isinstance(imagebase, int):
+            raise RequestError("Request field 'imagebase' must be an int")
+
+        outputs = request.get("outputs", ["bin"])
+        if not isinstance(outputs, list) or any(o not in OUTPUT_TYPES for o in outputs):
+            raise RequestError("Request field 'outputs' must be a list of: %s" % ", ".join(OUTPUT_TYPES))
+
+        template_path = request.get("template_path")
+        if "object" in outputs and not isinstance(template_path, str):
+            raise RequestError("Request field 'template_path' is required if the 'object' output is requested")
+
+        return request["spec"], request["source"], imagebase, bool(request.get("sigma16_labels", False)), \
+            outputs, template_path
+
+    # Builds each requested output from the assembled machine code. Errors are printed to output, or to the console if
+    # it's None.
+    def build_outputs(self, raw_bytes, outputs, template_path, imagebase=DEFAULT_IMAGEBASE, output=None):
+        obj_writer = ObjectWriter(raw_bytes, self.template_registry, output)
+        result = {}
+
+        for output_type in outputs:
+            if output_type == "bin":
+                result["bin"] = raw_bytes
+            elif output_type == "object":
+                result["object"] = obj_writer.get_object(template_path)
+            else:
+                result[output_type] = get_text_output(output_type, raw_bytes, imagebase, output=output)
+
+        return result
+
+    # Base64 encodes the binary outputs, so they can be sent in a JSON reply.
+    @staticmethod
+    def encode_outputs(outputs):
+        result = {}
+        for output, data in outputs.items():
+            if not isinstance(data, str):
+                data = base64.b64encode(data).decode("ascii")
+            result[output] = data
+        return result
+
+
+# Handles a single client connection. A client can send any number of requests over one connection, and gets one reply
+# line for each request line, in order.
+class AssemblerRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if len(line) == 0:
+                continue
+
+            try:
+                request = json.loads(line.decode("utf-8"))
+            except ValueError as e:
+                reply = {"ok": False, "errors": [{"stage": "request", "message": "Invalid JSON: %s" % e}]}
+            else:
+                reply = self.server.service.handle_request(request)
+
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+        return
+
+
+class AssemblerServer(socketserver.UnixStreamServer):
+
+    def __init__(self, socket_path, service: AssemblerService):
+        self.service = service
+        super().__init__(socket_path, AssemblerRequestHandler)
+        return
+
+
+# Removes the socket file left behind by a daemon which didn't shut down cleanly, so a new daemon can listen on the same
+# path. Anything which isn't a socket, or a socket which a daemon is still listening on, is left alone and reported.
+def remove_stale_socket(socket_path):
+    if not os.path.lexists(socket_path):
+        return
+
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+        print("Daemon ERROR: '%s' already exists and is not a socket" % socket_path)
+        raise ValueError
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        os.unlink(socket_path)
+        return
+    finally:
+        client.close()
+
+    print("Daemon ERROR: Another daemon is already listening on '%s'" % socket_path)
+    raise ValueError
+
+
+# Starts the daemon on the given Unix socket path, and serves requests until interrupted or terminated.
+def serve(socket_path, service: AssemblerService):
+
+    remove_stale_socket(socket_path)
+
+    server = AssemblerServer(socket_path, service)
+    print("Assembler daemon listening on '%s'" % socket_path)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+    return
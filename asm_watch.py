@@ -0,0 +1,528 @@
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from bitstring import BitArray
+
+from asm_grammar_spec import AsmGrammarSpec
+from asm_parser import AsmParser, DEFAULT_SECTION
+from bitstream_gen import BitstreamGenerator, DEFAULT_BYTE_BITSIZE, flatten_segments
+from obj_writer import ObjectWriter
+from output_writers import write_outputs, get_segments_span
+from relocatable import Fixup, make_relocatable, patch_bits
+
+# This module implements watch mode, used when main.py is started with '--watch'. The listing is assembled once, and
+# then reassembled every time it is saved, with the spec and plugins kept loaded. Instead of running the whole pipeline
+# again, the state of the last assembly is kept in memory, and each save only redoes the work the edit affects:
+#
+#   - The new listing is compared line by line with the previous one. Only lines between the unchanged lines at the
+#       start and at the end of the listing are parsed again, and lines whose text was already parsed (such as moved
+#       lines) are taken from the parse cache.
+#   - Each parsed line is encoded on its own, with its label references left as fixups (see relocatable.py), so lines
+#       never need to be encoded again when labels move.
+#   - Addresses are laid out again from the first changed line, and only until the layout lines up with the previous
+#       layout again, which is right after the edit when instruction sizes didn't change.
+#   - Only the fixups of lines which moved, or which refer to labels which moved, are recomputed.
+#   - If the machine code still covers the same addresses, the bin output is patched in place. Any other outputs, or
+#       any change of layout, are written again in full.
+#
+# The label pass is run over the whole listing on every save, as it is a cheap text scan. When labels are added or
+# removed, cached lines mentioning them are parsed again, as label tokens only match known labels. Lines which include
+# binary files with .incbin are read again on every save, as the files may have changed.
+
+# Number of seconds between checks for changes of the listing.
+WATCH_INTERVAL = 0.1
+
+
+# The parse of a single line of assembly code, and its machine code. Shared by all lines with the same text.
+# label - label defined on the line, or None
+# directives - (name, section, address) of each .org or .section directive on the line
+# has_node - whether the line holds an instruction or data, as opposed to only labels, directives or comments
+# data - machine code of the line, with label references encoded as if every label was at the address of the line
+# bit_length - number of bits of an instruction, which the bitstream generator packs together with the bits of the
+#               instructions around it. None for data and repeated instructions, which always take up whole bytes.
+# fixups - label references in the machine code
+# volatile - the line includes a binary file, so it's never cached
+class ParsedLine:
+
+    def __init__(self, label: Optional[str], directives: List[tuple], has_node: bool, data, bit_length: Optional[int],
+                 fixups: List[Fixup], volatile: bool):
+        self.label = label
+        self.directives = directives
+        self.has_node = has_node
+        self.data = data
+        self.bit_length = bit_length
+        self.fixups = fixups
+        self.volatile = volatile
+        return
+
+    # Whether the instruction doesn't take up a whole number of bytes, so its bits shift the bits of the instructions
+    # after it.
+    def is_unaligned(self) -> bool:
+        return self.bit_length is not None and self.bit_length % DEFAULT_BYTE_BITSIZE != 0
+
+
+# Keeps the state of the last assembly of a listing, and reassembles it incrementally.
+# spec - spec the listing is parsed with
+# asm_path - path of the listing
+# imagebase - memory address the code will be loaded at
+# outputs - output formats of output_writers.py, and the file each one is saved to
+# template_in_path, template_out_path - object template, and the object file saved from it
+#
+# Object fields, with one item per line of the listing
+# lines - text of each line
+# parsed - ParsedLine of each line
+# states - layout state before each line, plus one after the last line. A state is a tuple of the current address,
+#           whether it follows from the imagebase, the current section, the address each other section left off at, the
+#           labels waiting for the next instruction, and the address of the last instruction.
+# addresses - address of each line
+# relatives - whether the address of each line follows from the imagebase, or was set by a directive
+# datas - machine code of each line, with label references resolved
+class WatchSession:
+
+    def __init__(self, spec: AsmGrammarSpec, asm_path, imagebase, sigma16_labels=False, outputs: Dict[str, str] = None,
+                 template_in_path=None, template_out_path=None):
+        self.spec = spec
+        self.int_type_registry = spec.int_type_registry
+        self.asm_path = asm_path
+        self.imagebase = imagebase
+        self.outputs = outputs if outputs is not None else {}
+        self.template_in_path = template_in_path
+        self.template_out_path = template_out_path
+
+        # Runs of data statements span many lines, so they are parsed line by line here.
+        self.parser = AsmParser(spec, sigma16_labels=sigma16_labels, fast_data_runs=False)
+        self.parse_cache = {}   # type: Dict[str, ParsedLine]
+
+        self.lines = []         # type: List[str]
+        self.parsed = []        # type: List[ParsedLine]
+        self.states = [(imagebase, True, DEFAULT_SECTION, {}, (), None)]
+        self.addresses = []     # type: List[int]
+        self.relatives = []     # type: List[bool]
+        self.datas = []         # type: List[bytes]
+
+        # labels - address of each label
+        # label_names - names of all labels, including .extern labels, which decide how lines are parsed
+        # fixup_lines - lines with label references
+        # volatile_lines - lines including binary files
+        # unaligned_lines - number of lines whose instruction doesn't take up a whole number of bytes
+        self.labels = {}        # type: Dict[str, int]
+        self.label_names = set()
+        self.fixup_lines = []   # type: List[int]
+        self.volatile_lines = []    # type: List[int]
+        self.unaligned_lines = 0
+
+        # Address and size of the machine code in the bin output, or None if the outputs aren't up to date.
+        self.bin_span = None    # type: Optional[Tuple[int, int]]
+        return
+
+    # Parses and encodes a line of the listing held by the parser, after its label pass.
+    # label_names - names of all labels of the listing
+    def parse_line(self, line_num, label_names) -> ParsedLine:
+        parser = self.parser
+        parser.line_num = line_num
+        parser.line = parser.input_file[line_num].strip()
+        label = parser.labels_map.get(line_num)
+
+        if len(parser.line) == 0 or parser.line.startswith(";"):
+            return ParsedLine(label, [], False, b"", None, [], False)
+
+        ast_start = len(parser.ast)
+        directives_start = len(parser.directives)
+        included_start = len(parser.included_files)
+        parser.parse_current_line()
+
+        nodes = parser.ast[ast_start:]
+        directives = [(d.name, d.section, d.address) for d in parser.directives[directives_start:]]
+        volatile = len(parser.included_files) > included_start
+        if len(nodes) == 0:
+            return ParsedLine(label, directives, False, b"", None, [], volatile)
+
+        # Every label is treated as defined elsewhere, so all label references are left as fixups.
+        bits_gen = BitstreamGenerator(self.spec, nodes, imagebase=0, extern_labels=label_names)
+        image = make_relocatable(bits_gen, bits_gen.get_segments())
+        # Data included with .incbin is memory mapped, so it's copied out before the binary file changes.
+        data = b"".join(bytes(s.data) for s in image.segments)
+        bit_length = None
+        if len(nodes) == 1 and nodes[0].data is None and nodes[0].repeat == 1:
+            bit_length = bits_gen.bitfields_to_bitarray(nodes[0].node_bitfields).length
+        return ParsedLine(label, directives, True, data, bit_length, image.fixups, volatile)
+
+    # Returns the machine code of a line at the given address, with its label references resolved.
+    def resolve_line(self, line: ParsedLine, line_num, address, labels: Dict[str, int]) -> bytes:
+        data = bytearray(line.data)
+        for fixup in line.fixups:
+            if fixup.label_name not in labels:
+                print("Watch ERROR: Unknown label '%s' on line %s" % (fixup.label_name, line_num+1))
+                raise ValueError
+            label_bits = self.int_type_registry.calc_label_bits(fixup.label_type, address + fixup.source_offset,
+                                                                labels[fixup.label_name])
+            if len(label_bits) != fixup.bit_length:
+                print("Watch ERROR: Label type '%s' returned %s bits for label '%s' on line %s, but the instruction has room for %s bits" % (fixup.label_type, len(label_bits), fixup.label_name, line_num+1, fixup.bit_length))
+                raise ValueError
+            patch_bits(data, fixup.bit_offset, label_bits)
+        return bytes(data)
+
+    # Reassembles the listing after it changed to the given lines, and updates the outputs. Returns a one line summary
+    # of the work done. Raises ValueError if the listing has errors, in which case the previous state is kept.
+    def update(self, lines: List[str]) -> str:
+        start_time = time.perf_counter()
+        parser = self.parser
+
+        parser.reset()
+        parser.input_file = lines
+        parser.base_dir = os.path.dirname(self.asm_path)
+        parser.parse_labels()
+
+        label_names = set(parser.all_labels) | set(parser.extern_labels)
+        changed_names = label_names ^ self.label_names
+        self.evict_lines(changed_names)
+
+        try:
+            summary = self.reassemble(lines, label_names, changed_names)
+        except ValueError:
+            # Lines parsed for the failed listing may depend on labels which aren't in the last assembled listing.
+            self.evict_lines(changed_names)
+            raise
+
+        return "Reassembled in %s ms: %s" % (self.get_elapsed_ms(start_time), summary)
+
+    # Drops cached lines which mention any of the given labels.
+    def evict_lines(self, label_names):
+        if len(label_names) > 0:
+            self.parse_cache = {text: p for text, p in self.parse_cache.items()
+                                if not any(name in text for name in label_names)}
+        return
+
+    # Reassembles the listing held by the parser after its label pass, as described at the top of this module, and
+    # updates the outputs. Returns a summary of the work done.
+    # label_names - names of all labels of the listing
+    # changed_names - labels added or removed since the last assembled listing
+    def reassemble(self, lines: List[str], label_names, changed_names) -> str:
+        label_lines = self.parser.all_labels
+        old_lines = self.lines
+        old_parsed = self.parsed
+
+        # Lines [first, mid_end) replace the old lines [first, old_mid_end), all other lines are unchanged.
+        limit = min(len(old_lines), len(lines))
+        first = 0
+        while first < limit and old_lines[first] == lines[first]:
+            first += 1
+        suffix = 0
+        while suffix < limit - first and old_lines[len(old_lines) - 1 - suffix] == lines[len(lines) - 1 - suffix]:
+            suffix += 1
+        mid_end = len(lines) - suffix
+        old_mid_end = len(old_lines) - suffix
+        delta = len(lines) - len(old_lines)
+
+        # Index of each unchanged line in the old listing.
+        def get_old_index(i):
+            return i if i < first else i - delta
+
+        parsed = old_parsed[:first] + [None] * (mid_end - first) + old_parsed[old_mid_end:]
+
+        # Unchanged lines which must be parsed again: lines with binary files, and lines which mention added or removed
+        # labels.
+        volatile_lines = [i if i < first else i + delta for i in self.volatile_lines if i < first or i >= old_mid_end]
+        reparse = list(volatile_lines)
+        if len(changed_names) > 0:
+            reparse += [i for i in range(len(lines)) if (i < first or i >= mid_end) and not parsed[i].volatile and
+                        self.parse_cache.get(lines[i]) is not parsed[i]]
+
+        changed = list(range(first, mid_end))
+        parsed_count = 0
+        unaligned_lines = self.unaligned_lines - sum(p.is_unaligned() for p in old_parsed[first:old_mid_end])
+        for i in changed:
+            line = self.parse_cache.get(lines[i])
+            if line is None:
+                line = self.parse_line(i, label_names)
+                parsed_count += 1
+                if not line.volatile:
+                    self.parse_cache[lines[i]] = line
+            parsed[i] = line
+            unaligned_lines += line.is_unaligned()
+        for i in reparse:
+            line = self.parse_line(i, label_names)
+            parsed_count += 1
+            if not line.volatile:
+                self.parse_cache[lines[i]] = line
+            old = parsed[i]
+            if line.volatile and old.volatile and line.directives == old.directives and line.data == old.data:
+                continue
+            unaligned_lines += line.is_unaligned() - old.is_unaligned()
+            parsed[i] = line
+            changed.append(i)
+
+        if len(changed) == 0 and old_mid_end == first:
+            return "no changes"
+
+        first_changed = min(changed + [first])
+        last_changed = max(changed + [first - 1])
+
+        # Labels waiting for the next instruction move with it, so the layout restarts at the first of them.
+        restart = first_changed
+        restart_labels = self.states[restart][4]
+        if len(restart_labels) > 0:
+            restart = label_lines[restart_labels[0]]
+        address, relative, section, section_addresses, pending_labels, last_node = self.states[restart]
+
+        new_states = []
+        new_addresses = []
+        new_relatives = []
+        new_datas = []
+        placed_labels = {}
+        # Line at which the layout lined up with the previous layout, if it did.
+        converged = None
+        for i in range(restart, len(lines)):
+            state = (address, relative, section, section_addresses, pending_labels, last_node)
+            if i >= mid_end and i > last_changed and self.states[i - delta] == state:
+                converged = i
+                break
+            new_states.append(state)
+
+            line = parsed[i]
+            for name, directive_section, directive_address in line.directives:
+                if name == ".section":
+                    section_addresses = dict(section_addresses)
+                    section_addresses[section] = (address, relative)
+                    section = directive_section
+                    if directive_address is None:
+                        address, relative = section_addresses.get(section, (address, relative))
+                if directive_address is not None:
+                    address = directive_address
+                    relative = False
+            if line.label is not None:
+                pending_labels = pending_labels + (line.label,)
+
+            new_addresses.append(address)
+            new_relatives.append(relative)
+            unchanged = i < first or i >= mid_end
+            if unchanged and line is old_parsed[get_old_index(i)] and self.addresses[get_old_index(i)] == address:
+                new_datas.append(self.datas[get_old_index(i)])
+            elif len(line.fixups) == 0:
+                new_datas.append(line.data)
+            else:
+                new_datas.append(None)
+
+            if line.has_node:
+                for label in pending_labels:
+                    placed_labels[label] = address
+                pending_labels = ()
+                last_node = address
+                address += len(line.data)
+
+        if converged is None:
+            new_states.append((address, relative, section, section_addresses, pending_labels, last_node))
+            # Labels after the last instruction point to the last instruction, same as in the parser.
+            for label in pending_labels:
+                placed_labels[label] = last_node if last_node is not None else self.imagebase
+            pending_labels = ()
+            converged = len(lines)
+            old_converged = len(old_lines)
+            states = self.states[:restart] + new_states
+        else:
+            old_converged = converged - delta
+            states = self.states[:restart] + new_states + self.states[old_converged:]
+
+        # Labels before the restart, and after the layout lined up again, are where they were. So are labels still
+        # waiting for an instruction when the layout lined up again, as the same instruction follows them.
+        labels = {}
+        for label, label_line in label_lines.items():
+            if (label_line < restart and label not in restart_labels) or label_line >= converged or \
+                    label in pending_labels:
+                labels[label] = self.labels[label]
+        labels.update(placed_labels)
+        moved_labels = {label for label in set(labels) | set(self.labels) if labels.get(label) != self.labels.get(label)}
+
+        addresses = self.addresses[:restart] + new_addresses + self.addresses[old_converged:]
+        relatives = self.relatives[:restart] + new_relatives + self.relatives[old_converged:]
+        datas = self.datas[:restart] + new_datas + self.datas[old_converged:]
+        fixup_lines = [i for i in self.fixup_lines if i < restart] + \
+                      [i for i in range(restart, converged) if len(parsed[i].fixups) > 0] + \
+                      [i + delta for i in self.fixup_lines if i >= old_converged]
+
+        # Resolve the fixups of lines which moved, or which refer to labels which moved.
+        resolved = []
+        for i in fixup_lines:
+            if datas[i] is None or (len(moved_labels) > 0 and
+                                    any(f.label_name in moved_labels for f in parsed[i].fixups)):
+                datas[i] = self.resolve_line(parsed[i], i, addresses[i], labels)
+                resolved.append(i)
+
+        # Without directives, the changed lines take up the same addresses as before if they end at the same address.
+        same_layout = self.states[old_converged][0] == address and \
+            not any(len(p.directives) > 0 for p in old_parsed[restart:old_converged]) and \
+            not any(len(p.directives) > 0 for p in parsed[restart:converged])
+
+        # Nothing can fail from here on, so the new state is kept.
+        self.lines = lines
+        self.label_names = label_names
+        self.parsed = parsed
+        self.states = states
+        self.addresses = addresses
+        self.relatives = relatives
+        self.datas = datas
+        self.labels = labels
+        self.fixup_lines = fixup_lines
+        self.unaligned_lines = unaligned_lines
+        self.volatile_lines = sorted(volatile_lines + [i for i in range(first, mid_end) if parsed[i].volatile])
+        if len(self.parse_cache) > 2 * len(lines) + 1024:
+            self.prune_parse_cache()
+
+        written = self.write_outputs(restart, converged, resolved, same_layout)
+
+        return "parsed %s lines, laid out %s lines, resolved %s fixups, %s" % (
+            parsed_count, converged - restart, len(resolved), written)
+
+    # Drops cached lines which are no longer in the listing.
+    def prune_parse_cache(self):
+        self.parse_cache = {text: p for text, p in zip(self.lines, self.parsed) if not p.volatile}
+        return
+
+    @staticmethod
+    def get_elapsed_ms(start_time):
+        return "%.1f" % ((time.perf_counter() - start_time) * 1000)
+
+    # Returns the machine code as (address, bytes) segments sorted by address.
+    def get_segments(self) -> List[Tuple[int, bytes]]:
+        if self.unaligned_lines > 0:
+            return self.get_packed_segments()
+
+        segments = []
+        segment_address = None
+        segment_end = None
+        segment_parts = []
+        for address, data in zip(self.addresses, self.datas):
+            if len(data) == 0:
+                continue
+            if address != segment_end:
+                if len(segment_parts) > 0:
+                    segments.append((segment_address, b"".join(segment_parts)))
+                segment_address = address
+                segment_parts = []
+            segment_parts.append(data)
+            segment_end = address + len(data)
+        if len(segment_parts) > 0:
+            segments.append((segment_address, b"".join(segment_parts)))
+
+        return BitstreamGenerator.sort_segments(segments)
+
+    # Returns the machine code as segments, with the bits of instructions which follow each other in memory packed
+    # together the same way as BitstreamGenerator.encode. Only needed when some instruction isn't a whole number of
+    # bytes.
+    def get_packed_segments(self) -> List[Tuple[int, bytes]]:
+        segments = []
+        bitstream = None
+        segment_address = None
+        segment_end = None
+        segment_relative = True
+
+        def end_segment():
+            if bitstream is not None and bitstream.length > 0:
+                segments.append((segment_address, bitstream.tobytes()))
+
+        for line, address, relative, data in zip(self.parsed, self.addresses, self.relatives, self.datas):
+            if not line.has_node:
+                continue
+
+            if line.bit_length is None:
+                end_segment()
+                bitstream = None
+                segment_end = None
+                segments.append((address, data))
+                continue
+
+            if address != segment_end or relative != segment_relative:
+                end_segment()
+                bitstream = BitArray()
+                segment_address = address
+                segment_end = address
+                segment_relative = relative
+
+            bitstream.append(BitArray(bytes=data, length=line.bit_length))
+            segment_end += len(data)
+        end_segment()
+
+        return BitstreamGenerator.sort_segments(segments)
+
+    # Writes the outputs after an update. If in_place is set, the lines [restart, converged) take up the same addresses
+    # as before, so the bin output is patched in place with them and the resolved lines. The bin output is written again
+    # in full if any patch would fall outside the machine code it holds. Returns a description of what was written.
+    def write_outputs(self, restart, converged, resolved: List[int], in_place) -> str:
+        bin_path = self.outputs.get("bin")
+        patches = None
+        if in_place and self.unaligned_lines == 0 and bin_path is not None and self.bin_span is not None and os.path.isfile(bin_path) and \
+                os.path.getsize(bin_path) == self.bin_span[1]:
+            # The patched region starts at the first line with machine code, as the lines before it may be at an
+            # address outside the machine code, such as a comment before the first .org directive.
+            patches = []
+            first_code = next((i for i in range(restart, converged) if len(self.datas[i]) > 0), None)
+            if first_code is not None:
+                patches.append((self.addresses[first_code], b"".join(self.datas[first_code:converged])))
+            patches += [(self.addresses[i], self.datas[i]) for i in resolved if not restart <= i < converged]
+
+            span_address, span_size = self.bin_span
+            if not all(span_address <= address and address + len(data) <= span_address + span_size
+                       for address, data in patches):
+                patches = None
+
+        if patches is not None:
+            # If patching fails part way, the bin output no longer matches its span, so it's written in full next time.
+            bin_span = self.bin_span
+            self.bin_span = None
+            patched = 0
+            with open(bin_path, "r+b") as bin_file:
+                for address, data in patches:
+                    bin_file.seek(address - bin_span[0])
+                    bin_file.write(data)
+                    patched += len(data)
+            self.bin_span = bin_span
+            outputs = {name: path for name, path in self.outputs.items() if name != "bin"}
+            if len(outputs) == 0 and self.template_out_path is None:
+                return "patched %s bytes in place" % patched
+        else:
+            outputs = self.outputs
+
+        self.bin_span = None
+        segments = self.get_segments()
+        if len(outputs) > 0:
+            write_outputs(segments, outputs, imagebase=self.imagebase)
+        if self.template_out_path and self.template_in_path:
+            ObjectWriter(flatten_segments(segments)).write_object(self.template_in_path, self.template_out_path)
+        self.bin_span = get_segments_span(segments, self.imagebase)
+
+        return "wrote %s bytes" % sum(len(data) for address, data in segments)
+
+
+# Assembles the listing of a watch session, and then reassembles it whenever it changes, until interrupted. Errors in
+# the listing are reported, and the outputs are left as they were until the errors are fixed.
+def watch(session: WatchSession, interval=WATCH_INTERVAL):
+    print("Watching '%s' for changes, press Ctrl+C to stop" % session.asm_path)
+    last_change = None
+
+    try:
+        while True:
+            # Editors which save by replacing the file leave it missing for a moment, so it's read on the next check.
+            try:
+                stat = os.stat(session.asm_path)
+                change = (stat.st_mtime_ns, stat.st_size)
+                if change != last_change:
+                    with open(session.asm_path, "r") as asm_file:
+                        lines = asm_file.readlines()
+            except OSError:
+                change = last_change
+
+            if change != last_change:
+                last_change = change
+                try:
+                    print(session.update(lines))
+                except ValueError:
+                    print("Watch ERROR: Listing has errors, outputs are left unchanged until they are fixed")
+                except OSError as e:
+                    print("Watch ERROR: Unable to write the outputs: %s" % e)
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Stopped watching '%s'" % session.asm_path)
+
+    return
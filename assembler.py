@@ -0,0 +1,189 @@
+import io
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from asm_grammar_spec import AsmGrammarSpec
+from asm_int_types import IntTypeRegistry
+from asm_parser import AsmParser
+from bitstream_gen import BitstreamGenerator, DEFAULT_IMAGEBASE, flatten_segments
+import pipeline_stats
+from pipeline_stats import PipelineStats
+
+# This module implements the embeddable API of the generic assembler. An Assembler is built once from a spec, and can
+# then assemble any number of listings held in memory. Unlike main.py, it never prints to the console: the error
+# messages the rest of the pipeline prints are written to a buffer of the call instead of to stdout, and returned as
+# diagnostics. Assembling never writes files, and by default never reads them either: .incbin directives are rejected,
+# unless the assembler is built with allow_incbin=True.
+#
+#   assembler = Assembler.from_spec_file("test/test_x86_spec.txt")
+#   machine_code = assembler.assemble("mov eax, ebx\n", imagebase=0x400000)
+#
+#   result = assembler.assemble_lines(listing_lines)
+#   if not result.ok:
+#       for d in result.diagnostics:
+#           print(d)
+
+
+# An error found while building an assembler or assembling a listing.
+# stage - part of the pipeline which failed: 'spec', 'parse' or 'encode'
+# message - error message, as printed by the pipeline
+# line - 1-based line number of the listing which caused the error. None if it's not known.
+class Diagnostic:
+
+    def __init__(self, stage: str, message: str, line: Optional[int] = None):
+        self.stage = stage
+        self.message = message
+        self.line = line
+        return
+
+    def __str__(self):
+        if self.line is not None:
+            return "%s error on line %s: %s" % (self.stage, self.line, self.message)
+        return "%s error: %s" % (self.stage, self.message)
+
+    def to_dict(self):
+        result = {"stage": self.stage, "message": self.message}
+        if self.line is not None:
+            result["line"] = self.line
+        return result
+
+
+# Raised by Assembler when a spec can't be read, or by Assembler.assemble when a listing can't be assembled. Subclasses
+# ValueError, which is what the rest of the pipeline raises, so existing error handling keeps working.
+class AssemblerError(ValueError):
+
+    def __init__(self, diagnostics: List[Diagnostic]):
+        self.diagnostics = diagnostics
+        super().__init__("\n".join(str(d) for d in diagnostics))
+        return
+
+
+# Machine code generated for a single line of the listing.
+# line - 1-based line number in the listing
+# source - source code of the line
+# address - memory address of the line's machine code
+# size - size of the line's machine code in bytes
+class AssembledLine:
+
+    def __init__(self, line: int, source: str, address: int, size: int):
+        self.line = line
+        self.source = source
+        self.address = address
+        self.size = size
+        return
+
+
+# Result of assembling a listing. If 'ok' is False, 'machine_code' is None and 'diagnostics' lists the errors.
+# 'segments' holds the machine code as (address, bytes) tuples, 'machine_code' the same code laid out contiguously from
+# the lowest address, with any gaps left by '.org' and '.section' directives filled with zeros.
+class AssemblyResult:
+
+    def __init__(self, imagebase: int):
+        self.ok = False
+        self.imagebase = imagebase
+        self.machine_code = None         # type: Optional[bytes]
+        self.segments = []               # type: List[Tuple[int, bytes]]
+        self.lines = []                  # type: List[AssembledLine]
+        self.labels = {}                 # type: Dict[str, int]
+        self.diagnostics = []            # type: List[Diagnostic]
+        return
+
+
+# Assembles listings held in memory, for the architecture described by a spec. The parser state is reset for every
+# listing, so one instance can be reused for any number of listings. Instances are not thread safe, but separate
+# instances can be used from separate threads, even if they share a spec or an int type registry.
+# spec - spec of the architecture
+# sigma16_labels - parse labels as Sigma16 labels
+# stats - optional PipelineStats object, in which the time and memory of each stage of every assembled listing, and the
+#           parse counts, are recorded
+# allow_incbin - allow .incbin directives, which read binary files relative to the working directory. If False, the
+#                   default, they are reported as parse errors.
+class Assembler:
+
+    def __init__(self, spec: AsmGrammarSpec, sigma16_labels=False, stats: PipelineStats = None, allow_incbin=False):
+        self.spec = spec
+        self.stats = stats
+        self.parser = AsmParser(spec, sigma16_labels=sigma16_labels, stats=stats, allow_incbin=allow_incbin)
+        return
+
+    # Builds an assembler from a spec file. Loads the plugins, unless an already loaded registry is given.
+    @classmethod
+    def from_spec_file(cls, spec_path, int_type_registry: IntTypeRegistry = None, sigma16_labels=False, cache_dir=None,
+                       stats: PipelineStats = None, allow_incbin=False):
+        return cls.build(lambda spec: spec.read_spec(spec_path, cache_dir=cache_dir), int_type_registry, sigma16_labels,
+                         stats, allow_incbin)
+
+    # Builds an assembler from the text of a spec. Loads the plugins, unless an already loaded registry is given.
+    @classmethod
+    def from_spec_text(cls, spec_text: str, int_type_registry: IntTypeRegistry = None, sigma16_labels=False,
+                       cache_dir=None, stats: PipelineStats = None, allow_incbin=False):
+        return cls.build(lambda spec: spec.read_spec_text(spec_text, cache_dir=cache_dir), int_type_registry,
+                         sigma16_labels, stats, allow_incbin)
+
+    @classmethod
+    def build(cls, read_spec, int_type_registry, sigma16_labels, stats, allow_incbin):
+        captured_output = io.StringIO()
+        try:
+            if int_type_registry is None:
+                with pipeline_stats.stage(stats, "plugin load"):
+                    int_type_registry = IntTypeRegistry(output=captured_output)
+                    int_type_registry.load_plugins()
+            with pipeline_stats.stage(stats, "spec read"):
+                spec = AsmGrammarSpec(int_type_registry, output=captured_output)
+                read_spec(spec)
+        except (ValueError, KeyError, IndexError, OSError) as e:
+            raise AssemblerError([Diagnostic("spec", cls.get_error_message(captured_output, e))])
+
+        return cls(spec, sigma16_labels=sigma16_labels, stats=stats, allow_incbin=allow_incbin)
+
+    # Assembles source code, and returns the machine code. Raises AssemblerError if the code can't be assembled.
+    def assemble(self, source: str, imagebase=DEFAULT_IMAGEBASE) -> bytes:
+        result = self.assemble_lines(source.splitlines(keepends=True), imagebase=imagebase)
+        if not result.ok:
+            raise AssemblerError(result.diagnostics)
+        return result.machine_code
+
+    # Assembles the lines of a listing, and returns the result with the address and size of each line. Never raises for
+    # errors in the listing, those are returned as diagnostics instead.
+    def assemble_lines(self, lines: Iterable[str], imagebase=DEFAULT_IMAGEBASE) -> AssemblyResult:
+        result = AssemblyResult(imagebase)
+        stage = "parse"
+        captured_output = io.StringIO()
+
+        try:
+            self.parser.output = captured_output
+            self.parser.parse_asm_lines(list(lines))
+
+            stage = "encode"
+            bits_gen = BitstreamGenerator(self.spec, self.parser.ast, imagebase=imagebase, stats=self.stats,
+                                          directives=self.parser.directives, output=captured_output)
+            result.segments = bits_gen.get_segments()
+            result.machine_code = flatten_segments(result.segments)
+
+        except (ValueError, KeyError, IndexError) as e:
+            line = self.parser.line_num + 1 if stage == "parse" else None
+            result.diagnostics.append(Diagnostic(stage, self.get_error_message(captured_output, e), line))
+            return result
+
+        for ast_node in self.parser.ast:
+            if ast_node.data_lines is not None:
+                # A run of data statements, each with the same size.
+                size = len(ast_node.data) // len(ast_node.data_lines)
+                for idx, line_num in enumerate(ast_node.data_lines):
+                    result.lines.append(AssembledLine(line_num + 1, self.parser.input_file[line_num].strip(),
+                                                      ast_node.address + idx * size, size))
+            else:
+                result.lines.append(AssembledLine(ast_node.original_line_num + 1, ast_node.original_line,
+                                                  ast_node.address, bits_gen.get_node_size(ast_node)))
+            for lbl in ast_node.labels:
+                result.labels[lbl] = ast_node.address
+
+        result.ok = True
+        return result
+
+    # The pipeline prints its error messages before raising, so the captured output is the most useful message.
+    @staticmethod
+    def get_error_message(captured_output: io.StringIO, e: Exception) -> str:
+        message = captured_output.getvalue().strip()
+        if len(message) == 0:
+            message = str(e) if len(str(e)) > 0 else type(e).__name__
+        return message
@@ -38,7 +38,8 @@ def pretty_print_ast_node(ast_node: ASTNode, indentation: int):
     if ast_node.token_type == TokenTypes.WHITESPACE:
         return
 
-    elif ast_node.token_type == TokenTypes.RAW_TOKEN or ast_node.token_type == TokenTypes.INT_TOKEN:
+    elif ast_node.token_type == TokenTypes.RAW_TOKEN or ast_node.token_type == TokenTypes.INT_TOKEN or \
+            ast_node.token_type == TokenTypes.LITERAL:
         row_str = indent_by(indentation) + "'" + ast_node.token_value + "'"
         row_str += padding(len(row_str))
         row_str += print_bitfield_modifiers(ast_node)
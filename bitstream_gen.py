@@ -1,10 +1,10 @@
 from asm_grammar_spec import AsmGrammarSpec, TokenTypes, ModifierTypes, BitfieldModifier
-from asm_parser import ASTNode
-from asm_int_types import AsmIntTypes
+from asm_parser import ASTNode, Directive, DEFAULT_SECTION
+from asm_int_types import IntTypeRegistry
+from pipeline_stats import PipelineStats, stage
 
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
-from tabulate import tabulate
 from bitstring import BitArray
 
 
@@ -31,6 +31,21 @@ class Bitfield:
         self.present = True
 
 
+# Lays out segments of machine code, given as (address, bytes) tuples, in a single contiguous buffer starting at the
+# address of the first segment. Gaps between segments are filled with zeros.
+def flatten_segments(segments: List[Tuple[int, bytes]]) -> bytes:
+    if len(segments) == 0:
+        return b""
+    if len(segments) == 1:
+        return bytes(segments[0][1])
+
+    start_address = segments[0][0]
+    buffer = bytearray(segments[-1][0] + len(segments[-1][1]) - start_address)
+    for address, data in segments:
+        buffer[address - start_address:address - start_address + len(data)] = data
+    return bytes(buffer)
+
+
 # Singleton class responsible for generating the bitstream from the spec and the AST.
 class BitstreamGenerator:
 
@@ -38,67 +53,242 @@ class BitstreamGenerator:
     # ast - list of ASTNodes, where each ASTNode corresponds to parsed line of assembly code
     # imagebase - memory address at which the generated machine code is expected to be loaded. Used for calculating
     #               label addresses/offsets correctly.
-    def __init__(self, spec: AsmGrammarSpec, ast: List[ASTNode], imagebase=DEFAULT_IMAGEBASE):
+    # int_type_registry - registry used to calculate label bits. Defaults to the registry of the spec.
+    # stats - optional PipelineStats object, in which the time and memory of each pass, and the number of bytes emitted,
+    #           are recorded.
+    # directives - .org and .section directives found by the parser, which move the following instructions to other
+    #               addresses. Without directives, all instructions are laid out contiguously starting at imagebase.
+    # extern_labels - labels defined in other units, declared with .extern. References to them are encoded as if the
+    #                   label was at the referencing instruction, and fixed up when the units are linked (see linker.py).
+    # output - text stream which error messages are printed to. None prints them to the console.
+    def __init__(self, spec: AsmGrammarSpec, ast: List[ASTNode], imagebase=DEFAULT_IMAGEBASE,
+                 int_type_registry: IntTypeRegistry = None, stats: PipelineStats = None,
+                 directives: List[Directive] = None, extern_labels=None, output=None):
         self.spec = spec
+        if int_type_registry is None:
+            int_type_registry = spec.int_type_registry
+        self.int_type_registry = int_type_registry
         self.ast = ast
         self.imagebase = imagebase
+        self.stats = stats
+        self.directives = directives if directives is not None else []   # type: List[Directive]
+        self.extern_labels = extern_labels if extern_labels is not None else {}
+        self.output = output
+
+        # Kept while generating the bitstream, so a relocatable image can be built from it (see relocatable.py).
+        # node_relative - for each node, whether its address follows from the imagebase rather than a directive
+        # segment_relative - for each segment, by address, whether its address follows from the imagebase
+        # node_positions - for each encoded node, the address of its segment and its bit offset in the segment
+        # label_references - (node index, modifier, label type, label name) of each label reference
+        # label_placeholders - (modifiers, index, placeholder) of each label placeholder replaced by the label fixup pass
+        self.node_relative = []         # type: List[bool]
+        self.segment_relative = {}      # type: Dict[int, bool]
+        self.node_positions = {}        # type: Dict[int, Tuple[int, int]]
+        self.label_references = []      # type: List[Tuple[int, BitfieldModifier, str, str]]
+        self.label_placeholders = []    # type: List[Tuple[List[BitfieldModifier], int, BitfieldModifier]]
         return
 
-    # Calculate the bitstream, and return an array of bytes containing the bitstream. Works in 2 passes.
-    # 1st pass (1st loop) - Calculate bitstream for each instruction, and assign it a memory address. If the instruction
-    #                       has an associated label, associate that label with the instruction's memory address. This lets
-    #                       us later look up this address as the destination of the label
-    # 2nd pass (2nd loop) - Update placeholder values for labels  in the bitstream with actual values of correct bits pointing to correct
-    #                       memory addresses/offset for references to said labels. The correct bits are calculated by a plugin
-    # 3rd loop            - Build final bitstream which contains updated label values.
+    # Calculate the bitstream, and return an array of bytes containing the bitstream. If directives placed code at
+    # distant addresses, the bytes cover everything from the lowest to the highest address, with the gaps filled with
+    # zeros. Use get_segments to get only the addresses which hold code.
     def get_bytes(self):
+        return flatten_segments(self.get_segments())
+
+    # Calculate the bitstream, and return it as a list of (address, bytes) segments, sorted by address. Each segment is
+    # a contiguous run of code, though segments may directly follow each other. The bytes of a segment holding data
+    # included with .incbin are a view of the memory mapped file. Works in 3 passes.
+    # 1st pass (layout)      - Calculate bitstream for each instruction, and assign it a memory address. If the
+    #                           instruction has an associated label, associate that label with the instruction's memory
+    #                           address. This lets us later look up this address as the destination of the label
+    # 2nd pass (label fixup) - Update placeholder values for labels in the bitstream with actual values of correct bits
+    #                           pointing to correct memory addresses/offset for references to said labels. The correct
+    #                           bits are calculated by a plugin
+    # 3rd pass (encoding)    - Build final bitstream which contains updated label values.
+    def get_segments(self) -> List[Tuple[int, bytes]]:
+
+        with stage(self.stats, "layout"):
+            labels_to_addresses_map = self.layout()
+        with stage(self.stats, "label fixup"):
+            self.fixup_labels(labels_to_addresses_map)
+        with stage(self.stats, "encoding"):
+            segments = self.encode()
+
+        if self.stats is not None:
+            self.stats.add_count("bytes emitted", sum(len(data) for address, data in segments))
+
+        return segments
+
+    # Assigns a memory address to each instruction, and returns the address of each label. Labels are shared by all
+    # sections, so code in one section can refer to labels in any other.
+    def layout(self) -> Dict[str, int]:
 
-        bitstream = BitArray()
         current_address = self.imagebase
+        # Whether the current address follows from the imagebase, or was set by a directive.
+        relative = True
         labels_to_addresses_map = {}
 
-        for ast_node in self.ast:
+        # Address each section left off at, while another section is current.
+        section = DEFAULT_SECTION
+        section_addresses = {}  # type: Dict[str, Tuple[int, bool]]
+        directive_index = 0
+        self.node_relative = []
+
+        for ast_index, ast_node in enumerate(self.ast):
+            while directive_index < len(self.directives) and self.directives[directive_index].ast_index <= ast_index:
+                directive = self.directives[directive_index]
+                if directive.name == ".section":
+                    section_addresses[section] = (current_address, relative)
+                    section = directive.section
+                    if directive.address is None:
+                        current_address, relative = section_addresses.get(section, (current_address, relative))
+                if directive.address is not None:
+                    current_address = directive.address
+                    relative = False
+                directive_index += 1
+
+            self.node_relative.append(relative)
             ast_node.set_node_bitfields(self.compute_node_bitfields(ast_node))
             ast_node.set_node_address(current_address)
             for lbl in ast_node.labels:
                 labels_to_addresses_map[lbl] = ast_node.address
-            # TODO: What happens with addressing in non-standard word sizes?
-            bit_length = self.bitfields_to_bitarray(ast_node.node_bitfields).length
-            byte_length = int(bit_length / DEFAULT_BYTE_BITSIZE)
-            if bit_length % DEFAULT_BYTE_BITSIZE != 0:
-                byte_length += 1
-            current_address += byte_length
+            current_address += self.get_node_size(ast_node)
+
+        return labels_to_addresses_map
+
+    # Returns the number of bytes of machine code of a node, including all of its repeats.
+    def get_node_size(self, ast_node: ASTNode) -> int:
+        if ast_node.data is not None:
+            return len(ast_node.data)
+
+        # TODO: What happens with addressing in non-standard word sizes?
+        bit_length = self.bitfields_to_bitarray(ast_node.node_bitfields).length
+        byte_length = int(bit_length / DEFAULT_BYTE_BITSIZE)
+        if bit_length % DEFAULT_BYTE_BITSIZE != 0:
+            byte_length += 1
+        return byte_length * ast_node.repeat
+
+    # Replaces the label placeholders of each instruction with the bits of the label's address/offset. The placeholders
+    # replaced by an earlier pass are put back first, so the bitstream can be generated any number of times, and the
+    # label references are found again on every pass.
+    def fixup_labels(self, labels_to_addresses_map: Dict[str, int]):
+
+        for modifiers, idx, placeholder in self.label_placeholders:
+            modifiers[idx] = placeholder
+        self.label_placeholders = []
+
+        self.label_references = []
+        for ast_index, ast_node in enumerate(self.ast):
+            references = []
+            self.update_label_placeholders(ast_node, labels_to_addresses_map, references)
+            self.label_references.extend((ast_index, modifier, label_type, label_name)
+                                         for modifier, label_type, label_name in references)
 
-        for ast_node in self.ast:
-            self.update_label_placeholders(ast_node, labels_to_addresses_map)
+        return
+
+    # Builds the final bitstream from the bitfields of each instruction. Instructions which follow each other in memory
+    # are encoded into the same segment. Data and repeated instructions get segments of their own, so their bytes are
+    # never copied into a bitstream. Returns the segments sorted by address.
+    def encode(self) -> List[Tuple[int, bytes]]:
+
+        segments = []
+        bitstream = None
+        segment_address = 0
+        segment_end = None
+        segment_relative = True
+        self.segment_relative = {}
+        self.node_positions = {}
+
+        def end_segment():
+            if bitstream is not None and bitstream.length > 0:
+                segments.append((segment_address, bitstream.tobytes()))
+                self.segment_relative[segment_address] = segment_relative
+
+        for ast_index, ast_node in enumerate(self.ast):
+            relative = self.node_relative[ast_index]
+
+            if ast_node.data is not None:
+                end_segment()
+                bitstream = None
+                segment_end = None
+                segments.append((ast_node.address, ast_node.data))
+                self.segment_relative[ast_node.address] = relative
+                continue
 
-        for ast_node in self.ast:
             ast_node.set_node_bitfields(self.compute_node_bitfields(ast_node))
             node_bitarray = self.bitfields_to_bitarray(ast_node.node_bitfields)
+
+            if ast_node.repeat != 1:
+                end_segment()
+                bitstream = None
+                segment_end = None
+                segments.append((ast_node.address, node_bitarray.tobytes() * ast_node.repeat))
+                self.segment_relative[ast_node.address] = relative
+                self.node_positions[ast_index] = (ast_node.address, 0)
+                continue
+
+            # Code placed by a directive never shares a segment with code placed relative to the imagebase, as they
+            # move apart when the image is rebased.
+            if ast_node.address != segment_end or relative != segment_relative:
+                end_segment()
+                bitstream = BitArray()
+                segment_address = ast_node.address
+                segment_end = ast_node.address
+                segment_relative = relative
+
+            self.node_positions[ast_index] = (segment_address, bitstream.length)
             bitstream.append(node_bitarray)
+            segment_end += (node_bitarray.length + DEFAULT_BYTE_BITSIZE - 1) // DEFAULT_BYTE_BITSIZE
+
+        end_segment()
 
-        return bitstream.tobytes()
+        return self.sort_segments(segments, output=self.output)
+
+    # Sorts segments by address, dropping empty ones. Raises an error if any of them overlap, printing it to output.
+    @staticmethod
+    def sort_segments(segments: List[Tuple[int, bytes]], output=None) -> List[Tuple[int, bytes]]:
+
+        result = []
+        for address, data in sorted(segments, key=lambda segment: segment[0]):
+            if len(data) == 0:
+                continue
+            if len(result) > 0:
+                last_address, last_data = result[-1]
+                last_end = last_address + len(last_data)
+                if address < last_end:
+                    print("Bitstream Generation ERROR: Code at address 0x%x overlaps code at addresses 0x%x-0x%x" % (address, last_address, last_end - 1), file=output)
+                    raise ValueError
+            result.append((address, data))
+
+        return result
 
     # Pretty prints debug info showing for each parsed instruction, what the set bitfields are for that instruction, and
     # what bytes are generated by the bytes of that instruction. Even shows the original instruction's source code.
     # Triggers an actual build of the real bitstream.
     def print_debug_bitstream(self):
+        from tabulate import tabulate
 
         self.get_bytes()
 
         for ast_node in self.ast:
             if len(ast_node.original_line) > 0:
-                print(ast_node.original_line)
+                print(ast_node.original_line, file=self.output)
+
+            if ast_node.data is not None:
+                print("Data: %s bytes" % len(ast_node.data), file=self.output)
+                print("", file=self.output)
+                continue
 
             headers, values = self.get_debug_str_lines(ast_node.node_bitfields)
-            print(tabulate(values, headers=headers))
+            print(tabulate(values, headers=headers), file=self.output)
 
             bitarray = self.bitfields_to_bitarray(ast_node.node_bitfields)
             bytes_padded = self.bytes_to_string(bitarray.tobytes())
-            print("Bytes (padded): ")
-            print(bytes_padded)
+            print("Bytes (padded): ", file=self.output)
+            print(bytes_padded, file=self.output)
+            if ast_node.repeat != 1:
+                print("Repeated %s times" % ast_node.repeat, file=self.output)
 
-            print("")
+            print("", file=self.output)
 
         return
 
@@ -129,13 +319,13 @@ class BitstreamGenerator:
                 idx = self.get_bitfield_index(b.bitfield_name)
                 bitfields[idx].set_value(b.modifier_value)
             elif b.modifier_type == ModifierTypes.INT_PLACEHOLDER:
-                print("ERROR: There should be no unprocessed bitfield modifiers of type INT_PLACEHOLDER by this point")
+                print("ERROR: There should be no unprocessed bitfield modifiers of type INT_PLACEHOLDER by this point", file=self.output)
                 raise ValueError
             elif b.modifier_type == ModifierTypes.LABEL_PLACEHOLDER:
                 idx = self.get_bitfield_index(b.bitfield_name)
                 bitfields[idx].set_value("0" * bitfields[idx].size)
             else:
-                print("ERROR: Unknown type of bitfield modifier?")
+                print("ERROR: Unknown type of bitfield modifier?", file=self.output)
                 raise ValueError
 
         for child_node in ast_node.child_nodes:
@@ -146,7 +336,7 @@ class BitstreamGenerator:
     # Get the index of a bitfield in the bitfields list. Looks up the bitfield by name.
     def get_bitfield_index(self, bitfield_name):
         if bitfield_name not in self.spec.bitfield_indexes_map:
-            print("Bitstream Generation ERROR: Unknown bitfield named '%s'" % bitfield_name)
+            print("Bitstream Generation ERROR: Unknown bitfield named '%s'" % bitfield_name, file=self.output)
             raise ValueError
 
         return self.spec.bitfield_indexes_map[bitfield_name]
@@ -186,7 +376,9 @@ class BitstreamGenerator:
 
     # Walks across all bitfield modifiers. If it's a label placeholder, look up the address of the label, then use
     # a plugin to emit the correct bits to express the address/offset of the label reference.
-    def update_label_placeholders(self, ast_node: ASTNode, labels_to_addresses_map: Dict[str, int]):
+    # If a references list is given, a (modifier, label type, label name) tuple is added to it for each label reference.
+    def update_label_placeholders(self, ast_node: ASTNode, labels_to_addresses_map: Dict[str, int],
+                                  references: list = None):
 
         for idx, b in enumerate(ast_node.bitfield_modifiers):
             if b.modifier_type == ModifierTypes.LABEL_PLACEHOLDER:
@@ -200,22 +392,54 @@ class BitstreamGenerator:
                         found_child = True
                         label_name = child_node.token_value[len(label_placeholder_value + " "):]
 
-                        if label_name not in labels_to_addresses_map:
-                            print("Bitstream Generation ERROR: Unknown label in bitfield '%s' modifier" % label_name)
+                        if label_name in labels_to_addresses_map:
+                            label_address = labels_to_addresses_map[label_name]
+                        elif label_name in self.extern_labels:
+                            label_address = current_address
+                        else:
+                            print("Bitstream Generation ERROR: Unknown label in bitfield '%s' modifier" % label_name, file=self.output)
                             raise ValueError
-
-                        label_address = labels_to_addresses_map[label_name]
                         break
 
                 if not found_child:
-                    print("Bitstream Generation ERROR: We have a placeholder bitfield modifier '%s', but none of the child AST nodes are of type LABEL_TOKEN with a matching name." % label_placeholder_value)
+                    print("Bitstream Generation ERROR: We have a placeholder bitfield modifier '%s', but none of the child AST nodes are of type LABEL_TOKEN with a matching name." % label_placeholder_value, file=self.output)
                     raise ValueError
 
-                label_bits = AsmIntTypes.calc_label_bits(label_placeholder_value, current_address, label_address)
+                label_bits = self.int_type_registry.calc_label_bits(label_placeholder_value, current_address, label_address)
 
+                self.label_placeholders.append((ast_node.bitfield_modifiers, idx, b))
                 ast_node.bitfield_modifiers[idx] = BitfieldModifier(ModifierTypes.MODIFIER, b.bitfield_name, label_bits)
+                if references is not None:
+                    references.append((ast_node.bitfield_modifiers[idx], label_placeholder_value, label_name))
 
         for child_node in ast_node.child_nodes:
-            self.update_label_placeholders(child_node, labels_to_addresses_map)
+            self.update_label_placeholders(child_node, labels_to_addresses_map, references)
 
         return
+
+    # Returns the modifier which sets a bitfield of an instruction last, and therefore decides its value. Walks the
+    # nodes in the same order as set_bitfields.
+    def get_last_modifier(self, ast_node: ASTNode, bitfield_name) -> BitfieldModifier:
+        last_modifier = None
+        for b in ast_node.bitfield_modifiers:
+            if b.bitfield_name == bitfield_name:
+                last_modifier = b
+        for child_node in ast_node.child_nodes:
+            child_modifier = self.get_last_modifier(child_node, bitfield_name)
+            if child_modifier is not None:
+                last_modifier = child_modifier
+        return last_modifier
+
+    # Returns the bit offset and length of a bitfield in the bitstream of an encoded instruction.
+    def get_bitfield_position(self, ast_node: ASTNode, bitfield_name) -> Tuple[int, int]:
+        offset = 0
+        for b in ast_node.node_bitfields:
+            if not b.present:
+                continue
+            length = BitArray('0b' + b.value).length
+            if b.name == bitfield_name:
+                return offset, length
+            offset += length
+
+        print("Bitstream Generation ERROR: Bitfield '%s' is not present in the instruction" % bitfield_name, file=self.output)
+        raise ValueError
@@ -0,0 +1,184 @@
+import re
+from typing import Dict, List, Optional
+
+from bitstring import BitArray
+
+from asm_grammar_spec import AsmGrammarSpec, ModifierTypes, TokenTypes
+from asm_int_types import IntTypeRegistry
+from spec_analysis import RowConflicts
+
+# This module implements the fast path for runs of data statements. Generated listings often hold thousands of
+# consecutive lines such as 'data $00ff' or 'db 0ffh', each of which the parser would otherwise match against the spec
+# and turn into a tree of AST nodes, only for the bitstream generator to turn each tree back into a few bytes.
+#
+# Before parsing, the spec is searched for data statement shapes: rows which consist of a keyword, whitespace and a
+# single int, and which set no bitfields other than constants and that int. Such a row must be reachable from
+# INSTRUCTION either directly, or through a placeholder which is the only token of an INSTRUCTION row. Static analysis
+# (see spec_analysis.py) must prove that no row the parser tries before it can match the same input, so that whenever a
+# line matches the shape, the parser would have matched it with that row too.
+#
+# The parser then matches runs of lines against a shape with a single compiled regex per line, validates and emits each
+# distinct operand once through the int type's plugin, and joins the bytes of the whole run into a single data node.
+# The machine code is byte-identical to parsing each line on its own.
+
+# Name of the definition every line of assembly code is parsed as.
+ROOT_DEFINITION = "INSTRUCTION"
+
+# Minimum number of consecutive data statements which are parsed as a run. Shorter runs are parsed line by line.
+DEFAULT_MIN_RUN_LINES = 16
+
+
+# A row of the spec which matches data statements.
+# defn_name - name of the definition the row is in
+# keyword - text the statement starts with, lowercase
+# int_type - type of the int operand
+# template - bits of the statement in bitfield order. Each item is either a string of constant bits, or None where the
+#               bits of the operand go.
+# int_size - size of the bitfields the operand is emitted into
+# scan_pattern - regex the parser scans the operand with
+class DataStatementShape:
+
+    def __init__(self, defn_name, keyword: str, int_type: str, template: List[Optional[str]], int_size: int,
+                 scan_pattern):
+        self.defn_name = defn_name
+        self.keyword = keyword
+        self.int_type = int_type
+        self.template = template
+        self.int_size = int_size
+        self.scan_pattern = scan_pattern
+        self.statement_regex = re.compile(r"(?ai:%s)[ \t]+(%s)[ \t]*(?:;.*)?\Z" % (re.escape(keyword),
+                                                                                  scan_pattern.pattern), re.DOTALL)
+        return
+
+    # Returns the operand of the statement at the given position of a line, or None if the line doesn't hold a
+    # statement of this shape. The operand must be exactly what the parser would scan for the int type.
+    def match(self, line: str, pos: int) -> Optional[str]:
+        m = self.statement_regex.match(line, pos)
+        if m is None:
+            return None
+        scanned = self.scan_pattern.match(line, m.start(1))
+        if scanned is None or scanned.end() != m.end(1):
+            return None
+        return m.group(1)
+
+    # Returns the machine code of a statement with the given int bits.
+    def encode(self, int_bits: str) -> bytes:
+        bits = "".join(int_bits if part is None else part for part in self.template)
+        return int(bits, 2).to_bytes(len(bits) // 8, "big")
+
+
+# Returns the keyword and int type of a row made of a keyword, whitespace and an int, or None for any other row.
+def get_statement_tokens(token_patterns):
+    if len(token_patterns) == 3 and token_patterns[0][0] == TokenTypes.RAW_TOKEN and \
+            token_patterns[1][0] == TokenTypes.WHITESPACE and token_patterns[2][0] == TokenTypes.INT_TOKEN:
+        return token_patterns[0][1], token_patterns[2][1]
+
+    if len(token_patterns) == 2 and token_patterns[0][0] == TokenTypes.LITERAL and \
+            token_patterns[0][1].endswith(" ") and token_patterns[1][0] == TokenTypes.INT_TOKEN:
+        return token_patterns[0][1][:-1], token_patterns[1][1]
+
+    return None
+
+
+# Returns the bit template of a statement whose matched rows set the given bitfield modifiers, outermost row first, and
+# the size of the bitfields the int is emitted into. Returns None if the modifiers set anything other than constants and
+# the int, or if the statement isn't a whole number of bytes.
+def get_statement_template(spec: AsmGrammarSpec, modifier_lists, int_type):
+    fields = [None] * len(spec.bitfields)       # type: List[Optional[tuple]]
+    for modifiers in modifier_lists:
+        for b in modifiers:
+            if b.bitfield_name not in spec.bitfield_indexes_map:
+                return None
+            idx = spec.bitfield_indexes_map[b.bitfield_name]
+            if b.modifier_type == ModifierTypes.MODIFIER:
+                fields[idx] = (BitArray("0b" + b.modifier_value).bin,)
+            elif b.modifier_type == ModifierTypes.INT_PLACEHOLDER and b.modifier_value == int_type:
+                fields[idx] = (None,)
+            else:
+                return None
+
+    int_sizes = {spec.bitfields[idx].size for idx, field in enumerate(fields) if field == (None,)}
+    if len(int_sizes) != 1:
+        return None
+    int_size = int_sizes.pop()
+
+    template = [field[0] for field in fields if field is not None]
+    if sum(int_size if part is None else len(part) for part in template) % 8 != 0:
+        return None
+
+    return template, int_size
+
+
+# Searches the spec for the data statement shapes described at the top of this module.
+def find_data_statement_shapes(spec: AsmGrammarSpec, int_type_registry: IntTypeRegistry) -> List[DataStatementShape]:
+    if ROOT_DEFINITION not in spec.spec:
+        return []
+
+    row_conflicts = RowConflicts(spec)
+    shapes = []
+
+    # Rows which the parser may try before the given row can match the same input.
+    def has_earlier_conflicts(defn_name, row):
+        return any(other < row for other in row_conflicts.get_conflicts(defn_name)[row])
+
+    def add_shape(defn_name, pattern, outer_modifiers):
+        statement = get_statement_tokens(pattern.token_patterns)
+        if statement is None:
+            return
+        keyword, int_type = statement
+        # The parser compares keywords against lowercased input, so keywords with other characters never match.
+        if len(keyword) == 0 or not keyword.isascii() or keyword != keyword.lower() or " " in keyword or \
+                keyword.startswith("."):
+            return
+        if not int_type_registry.is_defined_type(int_type):
+            return
+
+        template = get_statement_template(spec, outer_modifiers + [pattern.bitfield_modifiers], int_type)
+        if template is None:
+            return
+        try:
+            shapes.append(DataStatementShape(defn_name, keyword, int_type, template[0], template[1],
+                                             int_type_registry.get_scan_pattern(int_type)))
+        except re.error:
+            # The scan regex of the plugin can't be embedded in the regex of the statement.
+            return
+        return
+
+    for row, pattern in enumerate(spec.spec[ROOT_DEFINITION].spec_patterns):
+        if has_earlier_conflicts(ROOT_DEFINITION, row):
+            continue
+
+        tokens = pattern.token_patterns
+        if len(tokens) == 1 and tokens[0][0] == TokenTypes.PLACEHOLDER and tokens[0][1] in spec.spec:
+            # Int placeholders are only resolved against ints of the row they are in, so the outer row may only set
+            # constants.
+            if any(b.modifier_type != ModifierTypes.MODIFIER for b in pattern.bitfield_modifiers):
+                continue
+            defn_name = tokens[0][1]
+            for sub_row, sub_pattern in enumerate(spec.spec[defn_name].spec_patterns):
+                if not has_earlier_conflicts(defn_name, sub_row):
+                    add_shape(defn_name, sub_pattern, [pattern.bitfield_modifiers])
+        else:
+            add_shape(ROOT_DEFINITION, pattern, [])
+
+    return shapes
+
+
+# Encodes the operands of a run of data statements. Each distinct operand is validated and emitted by the int type's
+# plugin once. Returns the machine code of the run, or None if an operand is rejected, so the run is parsed line by line
+# and the parser reports the error.
+# cache - bytes of operands encoded so far, shared between the runs of a listing
+def encode_data_run(shape: DataStatementShape, operands: List[str], int_type_registry: IntTypeRegistry,
+                    cache: Dict[str, bytes]) -> Optional[bytes]:
+    for operand in set(operands):
+        if operand in cache:
+            continue
+        if not int_type_registry.validate_integer(shape.int_type, operand):
+            return None
+
+        int_bits = int_type_registry.emit_bits(shape.int_type, operand)
+        if len(int_bits) != shape.int_size or any(c != "0" and c != "1" for c in int_bits):
+            return None
+        cache[operand] = shape.encode(int_bits)
+
+    return b"".join(map(cache.__getitem__, operands))
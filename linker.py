@@ -0,0 +1,247 @@
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from asm_grammar_spec import AsmGrammarSpec
+from asm_int_types import IntTypeRegistry
+from asm_parser import AsmParser
+from bitstream_gen import BitstreamGenerator
+from relocatable import RelocatableImage, RelocatableSegment, Fixup, make_relocatable
+
+# This module implements separate compilation, used when main.py is given one or more '--unit FILE' flags. Each unit is
+# an assembly listing which is parsed and encoded on its own, into a relocatable image (see relocatable.py). Labels
+# declared with '.global' are exported to the other units, which import them by declaring them with '.extern'. All other
+# labels are local to their unit, so several units can use the same local label names. The link step then lays out the
+# relative code of the units one after another, in the order they were given, merges their labels, and turns references
+# to imported labels into ordinary fixups. The linked image is placed at the final imagebase the same way as with
+# '--rebase'.
+#
+# Units which need assembling are spread across a pool of worker processes. With a unit cache, each assembled unit is
+# saved under a key derived from its source code, the spec and the plugins, so after an edit only the changed units are
+# assembled again. A cached unit which includes binary files with .incbin is only used while those files are unchanged.
+
+# Version of the units saved in the unit cache. Must be increased whenever the relocatable image format or the way units
+# are assembled changes, so that stale cache files are ignored.
+UNIT_CACHE_FORMAT_VERSION = 2
+
+# Imagebase units are assembled at. Only the offsets of the relative code from the imagebase are kept in the image.
+UNIT_IMAGEBASE = 0
+
+# Unit assembler of a worker process, created by init_unit_worker when the process starts.
+worker_unit_assembler = None  # type: Optional["UnitAssembler"]
+
+
+# Assembles units with a single spec, and keeps them in the unit cache.
+# int_type_registry - registry holding the loaded plugins
+# spec_path - path of the spec file. The spec is only read once a unit needs to be assembled.
+# spec_cache_dir, optimize_spec - used when reading the spec, same as AsmGrammarSpec.read_spec
+# sigma16_labels, fast_data_runs - used when parsing each unit, same as AsmParser
+# unit_cache_dir - optional folder of the unit cache
+class UnitAssembler:
+
+    def __init__(self, int_type_registry: IntTypeRegistry, spec_path, spec_cache_dir=None, optimize_spec=False,
+                 sigma16_labels=False, fast_data_runs=True, unit_cache_dir=None):
+        self.int_type_registry = int_type_registry
+        self.spec_path = spec_path
+        self.spec_cache_dir = spec_cache_dir
+        self.optimize_spec = optimize_spec
+        self.sigma16_labels = sigma16_labels
+        self.fast_data_runs = fast_data_runs
+        self.unit_cache_dir = unit_cache_dir
+
+        with open(spec_path, "r") as spec_file:
+            self.spec_text = spec_file.read()
+        self.spec_key = AsmGrammarSpec(int_type_registry).get_cache_key(self.spec_text, optimize_spec)
+
+        self.spec = None    # type: Optional[AsmGrammarSpec]
+        self.parser = None  # type: Optional[AsmParser]
+        return
+
+    # Returns the arguments of init_unit_worker, which creates the same unit assembler in a worker process.
+    def get_worker_args(self):
+        return (self.spec_path, self.spec_cache_dir, self.optimize_spec, self.sigma16_labels, self.fast_data_runs,
+                self.unit_cache_dir)
+
+    # Reads the spec and creates the parser, the first time a unit is assembled.
+    def load_spec(self):
+        if self.spec is not None:
+            return
+
+        self.spec = AsmGrammarSpec(self.int_type_registry)
+        self.spec.read_spec_text(self.spec_text, cache_dir=self.spec_cache_dir, optimize=self.optimize_spec)
+        self.parser = AsmParser(self.spec, sigma16_labels=self.sigma16_labels, fast_data_runs=self.fast_data_runs)
+        return
+
+    # Returns the path of a unit in the unit cache, or None if there is no unit cache. The key is derived from the source
+    # code of the unit, the spec, the plugins and the parser options.
+    def get_cache_path(self, asm_path) -> Optional[str]:
+        if self.unit_cache_dir is None:
+            return None
+
+        with open(asm_path, "rb") as asm_file:
+            source = asm_file.read()
+
+        h = hashlib.sha256()
+        h.update(str(UNIT_CACHE_FORMAT_VERSION).encode("utf-8") + b"\0")
+        h.update(self.spec_key.encode("utf-8") + b"\0")
+        h.update((b"sigma16_labels" if self.sigma16_labels else b"labels") + b"\0")
+        # Paths of .incbin directives are relative to the folder of the unit.
+        h.update(os.path.dirname(os.path.abspath(asm_path)).encode("utf-8") + b"\0")
+        h.update(source)
+        return os.path.join(self.unit_cache_dir, h.hexdigest() + ".unit")
+
+    # Loads a unit from the unit cache. Returns None if the unit isn't cached, or if a binary file it includes changed.
+    def load_cached(self, asm_path) -> Optional[RelocatableImage]:
+        cache_path = self.get_cache_path(asm_path)
+        if cache_path is None or not os.path.isfile(cache_path) or not os.path.isfile(cache_path + ".deps"):
+            return None
+
+        try:
+            with open(cache_path + ".deps", "r") as deps_file:
+                deps = json.load(deps_file)
+            for path, size, mtime in deps:
+                if not os.path.isfile(path) or os.path.getsize(path) != size or os.stat(path).st_mtime_ns != mtime:
+                    return None
+            return RelocatableImage.read(cache_path)
+        except (OSError, ValueError):
+            return None
+
+    # Saves an assembled unit to the unit cache, along with the size and modification time of each binary file it
+    # includes. Each file is written to a temporary file first and then moved in place, so concurrent runs never see a
+    # partial file. The unit cache is optional, so if the unit can't be saved a warning is printed and the run carries
+    # on, and the unit is assembled again by the next run.
+    def save_cached(self, asm_path, image: RelocatableImage, included_files: List[str]):
+        cache_path = self.get_cache_path(asm_path)
+        if cache_path is None:
+            return
+
+        def write_deps(deps_path):
+            deps = [[path, os.path.getsize(path), os.stat(path).st_mtime_ns] for path in included_files]
+            with open(deps_path, "w+") as deps_file:
+                json.dump(deps, deps_file)
+
+        temp_path = None
+        try:
+            os.makedirs(self.unit_cache_dir, exist_ok=True)
+            for path, write in [(cache_path, image.write), (cache_path + ".deps", write_deps)]:
+                fd, temp_path = tempfile.mkstemp(dir=self.unit_cache_dir, suffix=".tmp")
+                os.close(fd)
+                write(temp_path)
+                os.replace(temp_path, path)
+                temp_path = None
+        except Exception as e:
+            if temp_path is not None and os.path.exists(temp_path):
+                os.unlink(temp_path)
+            print("Linker WARNING: Unable to save unit '%s' to the unit cache: %s" % (asm_path, e))
+
+        return
+
+    # Parses and encodes a unit into a relocatable image, and saves it to the unit cache.
+    def assemble(self, asm_path) -> RelocatableImage:
+        self.load_spec()
+
+        try:
+            self.parser.parse_asm_listing(asm_path)
+            bits_gen = BitstreamGenerator(self.spec, self.parser.ast, imagebase=UNIT_IMAGEBASE,
+                                          directives=self.parser.directives, extern_labels=self.parser.extern_labels)
+            image = make_relocatable(bits_gen, bits_gen.get_segments(), sorted(self.parser.global_labels))
+        except ValueError:
+            print("Linker ERROR: Failed to assemble unit '%s'" % asm_path)
+            raise
+
+        self.save_cached(asm_path, image, self.parser.included_files)
+        return image
+
+
+def init_unit_worker(spec_path, spec_cache_dir, optimize_spec, sigma16_labels, fast_data_runs, unit_cache_dir):
+    global worker_unit_assembler
+
+    int_type_registry = IntTypeRegistry()
+    int_type_registry.load_plugins()
+    worker_unit_assembler = UnitAssembler(int_type_registry, spec_path, spec_cache_dir, optimize_spec,
+                                          sigma16_labels, fast_data_runs, unit_cache_dir)
+    return
+
+
+# Assembles a unit in a worker process. Data included with .incbin is memory mapped, so it's copied out before the image
+# is sent back to the main process.
+def run_unit(asm_path) -> RelocatableImage:
+    image = worker_unit_assembler.assemble(asm_path)
+    for segment in image.segments:
+        segment.data = bytes(segment.data)
+    return image
+
+
+# Returns the relocatable image of each unit, loaded from the unit cache or assembled.
+# workers - number of worker processes. 1 assembles all units in the main process, 0 uses one worker per CPU.
+def assemble_units(unit_assembler: UnitAssembler, unit_paths: List[str], workers=1) -> List[RelocatableImage]:
+    images = [unit_assembler.load_cached(path) for path in unit_paths]
+    pending = [idx for idx, image in enumerate(images) if image is None]
+    if len(pending) < len(unit_paths):
+        print("Loaded %s of %s units from the unit cache" % (len(unit_paths) - len(pending), len(unit_paths)))
+
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if workers == 1 or len(pending) <= 1:
+        for idx in pending:
+            images[idx] = unit_assembler.assemble(unit_paths[idx])
+    else:
+        from asm_scheduler import get_worker_context
+
+        executor = ProcessPoolExecutor(max_workers=min(workers, len(pending)), mp_context=get_worker_context(),
+                                       initializer=init_unit_worker, initargs=unit_assembler.get_worker_args())
+        with executor:
+            for idx, image in zip(pending, executor.map(run_unit, [unit_paths[idx] for idx in pending])):
+                images[idx] = image
+
+    return images
+
+
+# Links the relocatable images of units into a single relocatable image. The relative code of each unit follows the
+# relative code of the unit before it, absolute code stays where it is. Every exported label must be exported by exactly
+# one unit, and every imported label by some unit. References to a label defined in the same unit always resolve to
+# that definition. Local labels are kept in the linked image as 'N:LABEL', where N is the index of their unit, so they
+# can't clash with each other or with exported labels.
+def link_units(images: List[RelocatableImage], unit_names: List[str]) -> RelocatableImage:
+    segments = []
+    labels = {}
+    label_units = {}
+    fixups = []
+
+    offset = 0
+    for unit_index, (image, unit_name) in enumerate(zip(images, unit_names)):
+        first_segment = len(segments)
+        for s in image.segments:
+            segments.append(RelocatableSegment(s.address + offset if s.relative else s.address, s.relative, s.data))
+
+        exports = set(image.exports)
+        local_names = {}
+        for name, (address, relative) in image.labels.items():
+            if name in exports:
+                if name in label_units:
+                    print("Linker ERROR: Label '%s' is exported by both unit '%s' and unit '%s'" % (name, label_units[name], unit_name))
+                    raise ValueError
+                label_units[name] = unit_name
+                linked_name = name
+            else:
+                linked_name = "%s:%s" % (unit_index, name)
+                local_names[name] = linked_name
+            labels[linked_name] = (address + offset if relative else address, relative)
+
+        for f in image.fixups:
+            fixups.append(Fixup(f.segment + first_segment, f.bit_offset, f.bit_length, f.source_offset, f.label_type,
+                                local_names.get(f.label_name, f.label_name)))
+
+        offset += image.get_relative_size()
+
+    for image, unit_name in zip(images, unit_names):
+        for name in image.get_imports():
+            if name not in label_units:
+                print("Linker ERROR: Label '%s' used in unit '%s' is not exported with .global by any unit" % (name, unit_name))
+                raise ValueError
+
+    return RelocatableImage(UNIT_IMAGEBASE, segments, labels, fixups)
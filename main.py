@@ -1,9 +1,22 @@
+import sys
+import startup_report
+
+# The startup report must be installed before any other module is imported, so their import time is recorded.
+if "--startup-report" in sys.argv:
+    startup_report.install()
+
 from asm_grammar_spec import AsmGrammarSpec
-from asm_parser import AsmParser
-from bitstream_gen import BitstreamGenerator
+from asm_parser import AsmParser, DEFAULT_MAX_LINE_STEPS, DEFAULT_MAX_DEPTH
+from bitstream_gen import BitstreamGenerator, flatten_segments
 from ast_utils import pretty_print_ast
-from asm_int_types import AsmIntTypes
+from asm_int_types import IntTypeRegistry
 from obj_writer import ObjectWriter
+from output_writers import write_outputs
+from plugin_stats import PluginStats
+from pipeline_stats import PipelineStats, stage
+from parser_profiler import ParserProfiler
+from adaptive_order import AdaptiveOrdering
+from relocatable import RelocatableImage, make_relocatable, get_rebased_path
 from optparse import OptionParser
 
 # This module is the main entrypoint of the program, responsible for handling command line flags and orchestrating
@@ -13,17 +26,17 @@ from optparse import OptionParser
 # check the assembled machine code, to make sure that it matches the expected output.
 ENABLE_DISASSEMBLER = True
 
-if ENABLE_DISASSEMBLER:
-    from capstone import *
-
 
 # This function is responsible for disassembling the assembled machine code and checking it against expected output.
 def check_disassembly(raw_bytes, opts):
 
     if ENABLE_DISASSEMBLER and (opts.print_disasm or opts.disasm_path):
-        disassembler = Cs(CS_ARCH_X86, CS_MODE_32)
+        # Capstone is only imported when disassembly is requested, as importing it slows down every other run.
+        import capstone
+
+        disassembler = capstone.Cs(capstone.CS_ARCH_X86, capstone.CS_MODE_32)
         if opts.disasm_arch == "arm":
-            disassembler = Cs(CS_ARCH_ARM, CS_MODE_ARM + CS_MODE_BIG_ENDIAN)
+            disassembler = capstone.Cs(capstone.CS_ARCH_ARM, capstone.CS_MODE_ARM + capstone.CS_MODE_BIG_ENDIAN)
 
         disassembly_str = ""
         for (address, size, mnemonic, op_str) in disassembler.disasm_lite(raw_bytes, opts.imagebase):
@@ -95,6 +108,18 @@ def load_args():
     parser.add_option("--write-sigma16", dest="sigma16_path",
                       help="""Specifies file where assembled sigma16 bytecode should be saved. """, metavar="FILE")
 
+    parser.add_option("--write-ihex", dest="ihex_path",
+                      help="Specifies file where assembled machine code should be saved as Intel HEX records, at the \
+                      addresses given by --imagebase.", metavar="FILE")
+
+    parser.add_option("--write-srec", dest="srec_path",
+                      help="Specifies file where assembled machine code should be saved as Motorola S-records, at the \
+                      addresses given by --imagebase.", metavar="FILE")
+
+    parser.add_option("--write-c-array", dest="c_array_path",
+                      help="Specifies C header file where assembled machine code should be saved as a byte array.",
+                      metavar="FILE")
+
     parser.add_option("--write-object", dest="template_out_path",
                       help="Specifies output path of object file. Object file is generated by inserting assembled \
                                 machine code into a template object file. Template object file that machine code will \
@@ -107,14 +132,152 @@ def load_args():
                                 bin_templates folder \
                            ", metavar="FILE")
 
+    parser.add_option("--write-reloc", dest="reloc_path",
+                      help="Specifies file where assembled machine code should be saved as a relocatable image, which \
+                      --rebase can place at any imagebase without assembling the listing again.", metavar="FILE")
+
+    parser.add_option("--rebase", dest="rebase_path",
+                      help="Instead of assembling a listing, write the outputs of a relocatable image saved with \
+                      --write-reloc, placed at the imagebases given by --rebase-to.", metavar="FILE")
+
+    parser.add_option("--rebase-to", dest="rebase_to",
+                      help="Comma separated list of imagebases to place the image given by --rebase at. Defaults to \
+                      --imagebase. When more than one imagebase is given, the imagebase is added to the name of each \
+                      output file.", metavar="BASE[,BASE...]")
+
+    parser.add_option("--unit", dest="unit_paths", action="append", default=[],
+                      help="Assemble an assembly listing as a separate unit, and link it with the other units given \
+                      with --unit. May be given any number of times, instead of --asm-file.", metavar="FILE")
+
+    parser.add_option("--unit-cache", dest="unit_cache_dir",
+                      help="Folder in which assembled units are cached. Units whose source code, spec and plugins are \
+                      unchanged are loaded from the cache instead of being assembled again.", metavar="DIR")
+
+    parser.add_option("--watch",
+                      action="store_true", dest="watch", default=False,
+                      help="Keep running, and reassemble the listing whenever it is saved. Only the edited lines are \
+                      parsed again, and the outputs are patched in place where possible.")
+
+    parser.add_option("--spec-cache", dest="spec_cache_dir",
+                      help="Folder in which compiled specs are cached. If the spec was already compiled with the same \
+                      plugins, the compiled spec is loaded from the cache instead of parsing the spec file again.",
+                      metavar="DIR")
+
+    parser.add_option("--optimize-spec",
+                      action="store_true", dest="optimize_spec", default=False,
+                      help="Run the spec optimizer, which inlines single row definitions, removes unreachable \
+                      definitions and merges raw tokens into literals. Parse errors are then reported in terms of the \
+                      optimized definitions, and can differ from those of the spec as written.")
+
+    parser.add_option("--dump-optimized-spec", dest="dump_spec_path",
+                      help="Save the instruction definitions used by the parser, after optimization with \
+                      --optimize-spec, to a file.",
+                      metavar="FILE")
+
+    parser.add_option("--serve", dest="serve_path",
+                      help="Run as a daemon which keeps plugins and specs loaded, and assembles requests received over \
+                      the given Unix socket. Use asm_client.py to send requests to the daemon.", metavar="SOCKET")
+
+    parser.add_option("--batch", dest="batch_path",
+                      help="Assemble every entry of a batch manifest, instead of a single assembly file. Results and \
+                      errors of each entry are saved to the file given by --batch-summary.", metavar="FILE")
+
+    parser.add_option("--batch-summary", dest="batch_summary_path", default="batch_summary.json",
+                      help="Specifies file where the summary of a --batch run should be saved.", metavar="FILE")
+
+    parser.add_option("--workers",
+                      type=int, dest="workers", default=None,
+                      help="Number of worker processes of the daemon started with --serve, of a --batch run, or \
+                      assembling the units given with --unit. If set, jobs are spread across a pool of worker \
+                      processes. 0 starts one worker per CPU.")
+
+    parser.add_option("--max-queue",
+                      type=int, dest="max_queue", default=None,
+                      help="Maximum number of jobs waiting in the queue of a daemon started with --workers. Further \
+                      jobs are rejected until the queue drains. Defaults to 1024.")
+
+    parser.add_option("--job-timeout",
+                      type=float, dest="job_timeout", default=None,
+                      help="Default timeout in seconds of jobs of a daemon started with --workers.")
+
+    parser.add_option("--stats",
+                      action="store_true", dest="stats", default=False,
+                      help="Print wall time, CPU time and peak memory of each stage of the assembler pipeline, along \
+                      with counts of lines, instructions, AST nodes, backtracks and bytes emitted.")
+
+    parser.add_option("--stats-json", dest="stats_path",
+                      help="Save the stats collected by --stats to a JSON file.", metavar="FILE")
+
+    parser.add_option("--profile-parser",
+                      action="store_true", dest="profile_parser", default=False,
+                      help="Print how often each row of each spec definition was tried and rejected by the parser, \
+                      and the time wasted on rejected rows.")
+
+    parser.add_option("--suggest-order", dest="suggest_order_path",
+                      help="Save the parser profile of each spec definition to a JSON file, along with a suggested \
+                      order of its rows, most frequently matched first.", metavar="FILE")
+
+    parser.add_option("--max-parse-steps",
+                      type=int, dest="max_line_steps", default=DEFAULT_MAX_LINE_STEPS,
+                      help="Give up on a line if the parser tries more than this many token patterns while parsing it. \
+                      Default is %s." % DEFAULT_MAX_LINE_STEPS, metavar="STEPS")
+
+    parser.add_option("--max-parse-depth",
+                      type=int, dest="max_depth", default=DEFAULT_MAX_DEPTH,
+                      help="Give up on a line if the parser is nested in more than this many instruction definitions \
+                      while parsing it. Default is %s." % DEFAULT_MAX_DEPTH, metavar="DEPTH")
+
+    parser.add_option("--no-fast-data-runs",
+                      action="store_false", dest="fast_data_runs", default=True,
+                      help="Parse every data statement on its own, instead of parsing long runs of data statements in \
+                      a single step.")
+
+    parser.add_option("--adaptive-order", dest="adaptive_order_path",
+                      help="Try the rows of spec definitions most frequently matched first, where it can't change \
+                      which row matches. Hit counts are loaded from and saved to the given profile file.",
+                      metavar="PROFILE")
+
+    parser.add_option("--startup-report",
+                      action="store_true", dest="startup_report", default=False,
+                      help="Print the import time of each module and the duration of each phase of the run.")
+
+    parser.add_option("--plugin-stats",
+                      action="store_true", dest="plugin_stats", default=False,
+                      help="Print call counts and latencies of each plugin method at the end of the run.")
+
+    parser.add_option("--plugin-stats-json", dest="plugin_stats_path",
+                      help="Save call counts and latencies of each plugin method to a JSON file.", metavar="FILE")
+
     (opts, args) = parser.parse_args()
 
     error_str = ""
 
-    if opts.spec_path is None:
+    if opts.spec_path is None and opts.serve_path is None and opts.batch_path is None and opts.rebase_path is None:
         error_str += "ERROR: --spec-file is required\n"
-    if opts.asm_path is None:
+    if opts.asm_path is None and opts.serve_path is None and opts.batch_path is None and opts.rebase_path is None \
+            and len(opts.unit_paths) == 0:
         error_str += "ERROR: --asm-file is required\n"
+    if opts.asm_path is not None and len(opts.unit_paths) > 0:
+        error_str += "ERROR: --asm-file can't be combined with --unit\n"
+
+    opts.rebase_bases = [opts.imagebase]
+    if opts.rebase_to is not None:
+        if opts.rebase_path is None and len(opts.unit_paths) == 0:
+            error_str += "ERROR: If --rebase-to is set, --rebase or --unit must also be set\n"
+        try:
+            opts.rebase_bases = [int(base.strip(), 0) for base in opts.rebase_to.split(",")]
+        except ValueError:
+            error_str += "ERROR: --rebase-to must be a comma separated list of imagebases\n"
+
+    if opts.rebase_path and (opts.print_disasm or opts.disasm_path or opts.reloc_path):
+        error_str += "ERROR: --rebase can't be combined with --print-disasm, --check-disasm or --write-reloc\n"
+    if opts.watch and (opts.rebase_path or len(opts.unit_paths) > 0 or opts.reloc_path or opts.print_disasm or
+                       opts.disasm_path or opts.print_ast or opts.print_bitstream):
+        error_str += "ERROR: --watch can't be combined with --rebase, --unit, --write-reloc, --print-disasm, " \
+                     "--check-disasm, --print-ast or --print-bitstream\n"
+    if len(opts.unit_paths) > 0 and (opts.print_disasm or opts.disasm_path or opts.print_ast or opts.print_bitstream):
+        error_str += "ERROR: --unit can't be combined with --print-disasm, --check-disasm, --print-ast or " \
+                     "--print-bitstream\n"
 
     if opts.print_disasm and opts.disasm_arch is None:
         error_str += "ERROR: If --print-disasm is set, --disasm-arch must also be set\n"
@@ -144,6 +307,79 @@ def load_args():
     return opts
 
 
+# Returns the output formats requested on the command line, and the file each one should be saved to.
+def get_output_paths(opts):
+    outputs = {}
+    for format_name, output_path in [("bin", opts.bin_path), ("sigma16", opts.sigma16_path),
+                                     ("ihex", opts.ihex_path), ("srec", opts.srec_path),
+                                     ("c_array", opts.c_array_path)]:
+        if output_path:
+            outputs[format_name] = output_path
+
+    if len(outputs) == 0 and not opts.template_out_path and not opts.reloc_path:
+        outputs["bin"] = "default.out"
+
+    return outputs
+
+
+# Writes the outputs of a relocatable image saved with --write-reloc, placed at each imagebase given by --rebase-to. The
+# spec and listing aren't read at all, only the plugins are loaded to recompute the bits of label references.
+def rebase_image(opts):
+    int_type_registry = IntTypeRegistry()
+    int_type_registry.load_plugins()
+
+    image = RelocatableImage.read(opts.rebase_path)
+    print("Read relocatable image ok")
+
+    write_image_outputs(image, int_type_registry, opts)
+    return
+
+
+# Assembles the units given with --unit, links them, and writes the outputs of the linked image.
+def link_listing(opts):
+    int_type_registry = IntTypeRegistry()
+    int_type_registry.load_plugins()
+
+    # Only imported when used, so it doesn't slow down the start of a normal run.
+    import linker
+    unit_assembler = linker.UnitAssembler(int_type_registry, opts.spec_path, spec_cache_dir=opts.spec_cache_dir,
+                                          optimize_spec=opts.optimize_spec, sigma16_labels=opts.sigma16_labels,
+                                          fast_data_runs=opts.fast_data_runs, unit_cache_dir=opts.unit_cache_dir)
+    workers = opts.workers if opts.workers is not None else 1
+    images = linker.assemble_units(unit_assembler, opts.unit_paths, workers=workers)
+    print("Assembled %s units ok" % len(images))
+
+    image = linker.link_units(images, opts.unit_paths)
+    print("Linked %s units ok" % len(images))
+
+    if opts.reloc_path:
+        image.write(opts.reloc_path)
+    write_image_outputs(image, int_type_registry, opts)
+    return
+
+
+# Writes the outputs of a relocatable image placed at each imagebase given by --rebase-to.
+def write_image_outputs(image: RelocatableImage, int_type_registry: IntTypeRegistry, opts):
+    outputs = get_output_paths(opts)
+    for imagebase in opts.rebase_bases:
+        segments = image.rebase(imagebase, int_type_registry)
+
+        base_outputs = outputs
+        template_out_path = opts.template_out_path
+        if len(opts.rebase_bases) > 1:
+            base_outputs = {format_name: get_rebased_path(path, imagebase) for format_name, path in outputs.items()}
+            if template_out_path:
+                template_out_path = get_rebased_path(template_out_path, imagebase)
+
+        if len(base_outputs) > 0:
+            write_outputs(segments, base_outputs, imagebase=imagebase)
+        if template_out_path and opts.template_in_path:
+            ObjectWriter(flatten_segments(segments)).write_object(opts.template_in_path, template_out_path)
+        print("Placed image at 0x%x ok" % imagebase)
+
+    return
+
+
 # Main entrypoint of the program, responsible for calling all the other modules of the program depending on the
 # commandline parameters.
 def main():
@@ -152,18 +388,82 @@ def main():
     if opts is None:
         return
 
-    bin_path = None
-    if not opts.bin_path and not opts.sigma16_path and not opts.template_out_path:
-        bin_path = "default.out"
+    # The daemon and batch modules are only imported when used, so they don't slow down the start of a normal run.
+    if opts.serve_path and opts.workers is not None:
+        import asm_scheduler
+        max_queue = opts.max_queue if opts.max_queue is not None else asm_scheduler.DEFAULT_MAX_QUEUE
+        asm_scheduler.serve(opts.serve_path, workers=opts.workers, max_queue=max_queue,
+                            default_timeout=opts.job_timeout, spec_cache_dir=opts.spec_cache_dir)
+        return
 
-    AsmIntTypes.load_plugins()
+    if opts.serve_path:
+        import asm_server
+        int_type_registry = IntTypeRegistry()
+        int_type_registry.load_plugins()
+        asm_server.serve(opts.serve_path, asm_server.AssemblerService(int_type_registry,
+                                                                      spec_cache_dir=opts.spec_cache_dir))
+        return
 
-    asm_grammar = AsmGrammarSpec()
-    asm_grammar.read_spec(opts.spec_path)
+    if opts.batch_path:
+        import asm_batch
+        workers = opts.workers if opts.workers is not None else 1
+        summary = asm_batch.run_batch(opts.batch_path, workers=workers, spec_cache_dir=opts.spec_cache_dir)
+        asm_batch.write_summary(summary, opts.batch_summary_path)
+        print("Assembled %s of %s batch entries ok, %s failed. Summary saved to '%s'" % (
+            summary["ok"], summary["total"], summary["failed"], opts.batch_summary_path))
+        return 1 if summary["failed"] > 0 else 0
+
+    if opts.rebase_path:
+        rebase_image(opts)
+        return
+
+    if len(opts.unit_paths) > 0:
+        link_listing(opts)
+        return
+
+    plugin_stats = None
+    if opts.plugin_stats or opts.plugin_stats_path:
+        plugin_stats = PluginStats()
+
+    stats = None
+    if opts.stats or opts.stats_path:
+        stats = PipelineStats()
+
+    with startup_report.phase("load plugins"), stage(stats, "plugin load"):
+        int_type_registry = IntTypeRegistry(plugin_stats=plugin_stats)
+        int_type_registry.load_plugins()
+
+    with startup_report.phase("read spec"), stage(stats, "spec read"):
+        asm_grammar = AsmGrammarSpec(int_type_registry)
+        asm_grammar.read_spec(opts.spec_path, cache_dir=opts.spec_cache_dir, optimize=opts.optimize_spec)
     print("Read ASM grammar spec ok")
 
-    asm_parser = AsmParser(asm_grammar, sigma16_labels=opts.sigma16_labels)
-    asm_parser.parse_asm_listing(opts.asm_path)
+    if opts.dump_spec_path:
+        asm_grammar.dump_instruction_definitions(opts.dump_spec_path)
+
+    if opts.watch:
+        import asm_watch
+        session = asm_watch.WatchSession(asm_grammar, opts.asm_path, opts.imagebase,
+                                         sigma16_labels=opts.sigma16_labels, outputs=get_output_paths(opts),
+                                         template_in_path=opts.template_in_path,
+                                         template_out_path=opts.template_out_path)
+        asm_watch.watch(session)
+        return
+
+    profiler = None
+    if opts.profile_parser or opts.suggest_order_path:
+        profiler = ParserProfiler(asm_grammar)
+
+    adaptive_ordering = None
+    if opts.adaptive_order_path:
+        adaptive_ordering = AdaptiveOrdering(asm_grammar)
+        adaptive_ordering.load_profile(opts.adaptive_order_path)
+
+    with startup_report.phase("parse"):
+        asm_parser = AsmParser(asm_grammar, sigma16_labels=opts.sigma16_labels, stats=stats, profiler=profiler,
+                               adaptive_ordering=adaptive_ordering, max_line_steps=opts.max_line_steps,
+                               max_depth=opts.max_depth, fast_data_runs=opts.fast_data_runs and not opts.print_ast)
+        asm_parser.parse_asm_listing(opts.asm_path)
     print("Parsed ASM listing ok")
 
     if opts.print_ast:
@@ -171,28 +471,65 @@ def main():
         pretty_print_ast(asm_parser.ast)
         print("\n\n")
 
-    bits_gen = BitstreamGenerator(asm_grammar, asm_parser.ast, imagebase=opts.imagebase)
+    bits_gen = BitstreamGenerator(asm_grammar, asm_parser.ast, imagebase=opts.imagebase, stats=stats,
+                                  directives=asm_parser.directives)
     if opts.print_bitstream:
         bits_gen.print_debug_bitstream()
         print("\n\n")
 
-    raw_bytes = bits_gen.get_bytes()
+    with startup_report.phase("encode"):
+        segments = bits_gen.get_segments()
+
+    # Outputs without addresses need the machine code in a single buffer, with any gaps between sections filled in.
+    raw_bytes = None
+    if opts.print_disasm or opts.disasm_path or (opts.template_out_path and opts.template_in_path):
+        raw_bytes = flatten_segments(segments)
 
-    check_disassembly(raw_bytes, opts)
+    if opts.print_disasm or opts.disasm_path:
+        with stage(stats, "disassembly check"):
+            check_disassembly(raw_bytes, opts)
 
-    obj_writer = ObjectWriter(raw_bytes)
+    with startup_report.phase("write outputs"):
+        # All requested formats are written in a single pass over the machine code.
+        outputs = get_output_paths(opts)
+        if len(outputs) > 0:
+            with stage(stats, "write outputs"):
+                write_outputs(segments, outputs, imagebase=opts.imagebase)
 
-    if opts.bin_path:
-        obj_writer.write_bin(opts.bin_path)
-    if bin_path:
-        obj_writer.write_bin(bin_path)
-    if opts.sigma16_path:
-        obj_writer.write_sigma16_data(opts.sigma16_path)
-    if opts.template_out_path and opts.template_in_path:
-        obj_writer.write_object(opts.template_in_path, opts.template_out_path)
+        if opts.template_out_path and opts.template_in_path:
+            with stage(stats, "write object"):
+                ObjectWriter(raw_bytes).write_object(opts.template_in_path, opts.template_out_path)
+
+        if opts.reloc_path:
+            with stage(stats, "write reloc"):
+                make_relocatable(bits_gen, segments).write(opts.reloc_path)
+
+    if opts.plugin_stats:
+        print("\n\n")
+        plugin_stats.print_report()
+    if opts.plugin_stats_path:
+        plugin_stats.write_json(opts.plugin_stats_path)
+
+    if opts.profile_parser:
+        print("\n\n")
+        profiler.print_report()
+    if opts.suggest_order_path:
+        profiler.write_json(opts.suggest_order_path)
+    if adaptive_ordering is not None:
+        adaptive_ordering.save_profile(opts.adaptive_order_path)
+
+    if opts.stats:
+        print("\n\n")
+        stats.print_report()
+    if opts.stats_path:
+        stats.write_json(opts.stats_path)
+
+    if opts.startup_report:
+        print("\n\n")
+        startup_report.print_report()
 
     return
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import re
+from typing import Dict, List, Optional
+
+# This module implements the native int types which can be declared in the .INT_TYPES section of the spec file. Most
+# int types are simply "N bit signed/unsigned int, in this byte order, written in these literal forms". Instead of
+# having a plugin for each of them, the spec can declare such types directly, and they are compiled into a regex which
+# verifies the literal and a direct int-to-bits encoder. Plugins are still used for more exotic encodings.
+
+# Literal forms which a native int type can accept. Each form is a regex, and the base used to convert the digits
+# captured by the regex into an int. The %s in the regex is replaced with the number of digits the type accepts.
+# decimal    - decimal number with optional minus sign, e.g. -12
+# hex_suffix - hex number starting with 0 and ending with h, e.g. 0ffh
+# hex_dollar - hex number prefixed with $, e.g. $00ff
+# hex_prefix - hex number prefixed with 0x, e.g. 0xff
+# binary_prefix - binary number prefixed with 0b, e.g. 0b1010
+LITERAL_FORMS = {
+    "decimal": (r"(-?[0-9]+)", 10),
+    "hex_suffix": (r"0([0-9a-fA-F]%s)h", 16),
+    "hex_dollar": (r"\$([0-9a-fA-F]%s)", 16),
+    "hex_prefix": (r"0[xX]([0-9a-fA-F]%s)", 16),
+    "binary_prefix": (r"0[bB]([01]%s)", 2),
+}
+
+# Characters which can appear in each literal form. Used to build the default character whitelist of a type.
+LITERAL_FORM_CHARS = {
+    "decimal": "-0123456789",
+    "hex_suffix": "0123456789abcdefABCDEFh",
+    "hex_dollar": "$0123456789abcdefABCDEF",
+    "hex_prefix": "0123456789abcdefABCDEFxX",
+    "binary_prefix": "01bB",
+}
+
+SIGNEDNESS_VALUES = ["signed", "unsigned", "any"]
+BYTE_ORDER_VALUES = ["big", "little"]
+
+
+# An int type declared in the .INT_TYPES section of the spec. Exposes the same chars/verify/emit interface as an int type
+# implemented by a plugin, so the rest of the assembler can use both kinds of types interchangeably.
+# name - name of the type, must begin with int_
+# size - size of the emitted bitstream in bits
+# signedness - 'signed' accepts -2^(size-1)..2^(size-1)-1, 'unsigned' accepts 0..2^size-1, and 'any' accepts both
+#               ranges, which is how the builtin plugin types behave.
+# byte_order - 'big' or 'little'. Little endian types must have a size divisible by 8.
+# formats - list of literal forms from LITERAL_FORMS accepted by this type
+# prefix - optional string which must come before the number, e.g. '#' for ARM immediates
+# chars - character whitelist used when scanning the int in the assembly source. Derived from formats and prefix if
+#           not given.
+# digits - exact number of digits of hex and binary literals, e.g. 4 for '$00ff'. Any number of digits if not given.
+#           Decimal literals always accept any number of digits.
+class NativeIntType:
+
+    def __init__(self, name: str, size: int, signedness: str, byte_order: str, formats: List[str],
+                 prefix: str = "", chars: Optional[str] = None, digits: Optional[int] = None):
+
+        if not name.startswith("int_"):
+            raise ValueError("Name of native int type '%s' must begin with 'int_'" % name)
+        if size <= 0:
+            raise ValueError("Size of native int type '%s' must be larger than 0" % name)
+        if signedness not in SIGNEDNESS_VALUES:
+            raise ValueError("Unknown signedness '%s' of native int type '%s'. Possible values are: %s" % (
+                signedness, name, ", ".join(SIGNEDNESS_VALUES)))
+        if byte_order not in BYTE_ORDER_VALUES:
+            raise ValueError("Unknown byte order '%s' of native int type '%s'. Possible values are: %s" % (
+                byte_order, name, ", ".join(BYTE_ORDER_VALUES)))
+        if byte_order == "little" and size % 8 != 0:
+            raise ValueError("Little endian native int type '%s' must have a size divisible by 8" % name)
+        if len(formats) == 0:
+            raise ValueError("Native int type '%s' must accept at least one literal format" % name)
+        for f in formats:
+            if f not in LITERAL_FORMS:
+                raise ValueError("Unknown literal format '%s' of native int type '%s'. Possible values are: %s" % (
+                    f, name, ", ".join(LITERAL_FORMS.keys())))
+        if digits is not None and digits <= 0:
+            raise ValueError("Number of digits of native int type '%s' must be larger than 0" % name)
+
+        self.name = name
+        self.size = size
+        self.signedness = signedness
+        self.byte_order = byte_order
+        self.formats = formats
+        self.prefix = prefix
+        self.digits = digits
+
+        if chars is None:
+            chars = prefix + "".join(LITERAL_FORM_CHARS[f] for f in formats)
+        self.valid_chars_map = {}  # type: Dict[str, bool]
+        for c in chars:
+            self.valid_chars_map[c] = True
+
+        if signedness == "signed":
+            self.min_value = -(1 << (size - 1))
+            self.max_value = (1 << (size - 1)) - 1
+        elif signedness == "unsigned":
+            self.min_value = 0
+            self.max_value = (1 << size) - 1
+        else:
+            self.min_value = -(1 << (size - 1))
+            self.max_value = (1 << size) - 1
+
+        # One named group per literal form, so after a match we know which base to convert the digits with.
+        alternatives = []
+        for idx, f in enumerate(formats):
+            form_regex, form_base = LITERAL_FORMS[f]
+            if f != "decimal":
+                form_regex = form_regex % ("+" if digits is None else "{%s}" % digits)
+            alternatives.append("(?P<f%s>%s)" % (idx, form_regex))
+        self.literal_regex = re.compile(re.escape(prefix) + "(?:" + "|".join(alternatives) + ")")
+
+        # The scanner consumes the longest run of whitelisted characters, the same as for plugin types. The literal
+        # is then checked against literal_regex by verify().
+        self.scan_regex = re.compile("[" + "".join(re.escape(c) for c in self.valid_chars_map.keys()) + "]+")
+
+        return
+
+    # Convert the string representation of the int to an int. Returns None if the string is not a valid literal.
+    def parse_int(self, int_string: str) -> Optional[int]:
+        m = self.literal_regex.fullmatch(int_string)
+        if m is None:
+            return None
+        form_idx = int(m.lastgroup[1:])
+        form_base = LITERAL_FORMS[self.formats[form_idx]][1]
+        return int(m.group(m.lastindex + 1), form_base)
+
+    def chars(self):
+        return self.valid_chars_map
+
+    def verify(self, int_string):
+        parsed_int = self.parse_int(int_string)
+        if parsed_int is None:
+            return False
+        return self.min_value <= parsed_int <= self.max_value
+
+    def emit(self, int_string):
+        parsed_int = self.parse_int(int_string)
+        return self.encode(parsed_int)
+
+    # Encode an int into the bitstream of this type, applying two's complement and the byte order of the type.
+    def encode(self, value: int) -> str:
+        value &= (1 << self.size) - 1
+        if self.byte_order == "little":
+            value = int.from_bytes(value.to_bytes(self.size // 8, "little"), "big")
+        return format(value, "0%sb" % self.size)
@@ -1,5 +1,8 @@
 import os.path
 
+from output_writers import get_text_output, write_outputs
+from template_registry import ObjectTemplate, TemplateRegistry, read_template
+
 # Helper module for outputting the bitstream in various formats, or to embed it inside an object template. The object
 # templates are located in bin_templates. Each template has a code cave of NOPs into which machine code can be injected.
 # There is a .info file which must be present next to each template object file. The first line of the .info file
@@ -7,116 +10,105 @@ import os.path
 # Machine code blobs larger than the size should not be injected.
 
 
+# raw_bytes - assembled machine code
+# template_registry - optional TemplateRegistry holding templates loaded in memory
+# output - text stream which error messages are printed to. None prints them to the console.
 class ObjectWriter:
 
-    def __init__(self, raw_bytes):
+    def __init__(self, raw_bytes, template_registry: TemplateRegistry = None, output=None):
         self.raw_bytes = raw_bytes
+        self.template_registry = template_registry
+        self.output = output
         return
 
     # Write the raw binary blob to a file.
     def write_bin(self, output_file):
-        with open(output_file, "wb+") as out_file:
-            out_file.write(self.raw_bytes)
+        write_outputs([(0, self.raw_bytes)], {"bin": output_file}, output=self.output)
 
         return
 
     # Write the machine code as textual Sigma16 data, which can be loaded and executed in a Sigma16 simulator.
     def write_sigma16_data(self, output_file):
-
-        if len(self.raw_bytes) % 2 != 0:
-            print("Sigma16 writer error: Sigma16 has 16 bit words, so the buffer length should be divisible by 2. Instead it has a length of %s" % (len(self.raw_bytes)))
-
-        text_buffer = ""
-        current_offset = 0
-
-        while current_offset < len(self.raw_bytes):
-            first_byte = str("{:02x}").format(self.raw_bytes[current_offset])
-            second_byte = str("{:02x}").format(self.raw_bytes[current_offset + 1])
-
-            line = "    data $" + first_byte + second_byte + "\n"
-            text_buffer += line
-            current_offset += 2
-
-        with open(output_file, "w+") as out_file:
-            out_file.write(text_buffer)
+        write_outputs([(0, self.raw_bytes)], {"sigma16": output_file}, output=self.output)
 
         return
 
+    # Returns the machine code as textual Sigma16 data.
+    def get_sigma16_data(self):
+        return get_text_output("sigma16", self.raw_bytes, output=self.output)
+
     # Write machine code into a template object file which gives the user an executable binary they can run to test their
-    # assembled code. Template files are located in bin_templates folder, and have a .info file next to them.
+    # assembled code. Template files are located in bin_templates folder, and have a .info file next to them. Templates
+    # held by the template registry are written straight from memory. Otherwise, the template is copied to the output
+    # file by the OS, and only the code cave is then patched in place through a memory map, so the cost of writing the
+    # object depends on the size of the machine code rather than of the template.
     def write_object(self, template_file, output_file):
 
-        if not os.path.isfile(template_file):
-            print("Object Writer Error: Binary template file at %s does not exist." % template_file)
-            raise ValueError
-
-        info_file_path = template_file + ".info"
-        if not os.path.isfile(info_file_path):
-            print("Object Writer Error: Info file for binary template %s does not exist." % info_file_path)
-            raise ValueError
-
-        offset, size = self.read_template_info(info_file_path)
-
-        if len(self.raw_bytes) > size:
-            print("Object Writer Error: Size of assembled code (%s) is larger than available space in binary template" % (len(self.raw_bytes)))
-            raise ValueError
-
-        with open(template_file, "rb") as bin_file:
-            binary_buffer = bin_file.read()
-
-        binary_buffer = self.overwrite_bytes(binary_buffer, self.raw_bytes, offset)
-
-        with open(output_file, "wb+") as out_file:
-            out_file.write(binary_buffer)
+        template = self.get_template(template_file, read_data=False)
+        offset = template.offset
+
+        if template.data is not None:
+            data = memoryview(template.data)
+            end_offset = max(min(offset + len(self.raw_bytes), len(data)), offset)
+            with open(output_file, "wb+") as out_file:
+                if end_offset > offset:
+                    out_file.write(data[:offset])
+                    out_file.write(self.raw_bytes[:end_offset - offset])
+                    out_file.write(data[end_offset:])
+                else:
+                    out_file.write(data)
+            return
+
+        # Only needed when writing objects, so not imported up front.
+        import mmap
+        import shutil
+
+        if not (os.path.isfile(output_file) and os.path.samefile(template_file, output_file)):
+            shutil.copyfile(template_file, output_file)
+
+        with open(output_file, "r+b") as out_file:
+            file_size = os.fstat(out_file.fileno()).st_size
+            end_offset = min(offset + len(self.raw_bytes), file_size)
+            if end_offset <= offset:
+                return
+
+            with mmap.mmap(out_file.fileno(), 0) as out_map:
+                out_map[offset:end_offset] = self.raw_bytes[:end_offset - offset]
+                out_map.flush()
 
         return
 
-    # Reads .info file of an object template file. First line will specify offset of code cave where assembled machine
-    # code should be injected, second line will specify size of code cave. Size of machine code should not exceed size
-    # of code cave.
-    def read_template_info(self, info_file_path):
-        with open(info_file_path, "r") as info_file:
-            lines = info_file.readlines()
+    # Returns the bytes of the template object file with the machine code inserted into it.
+    def get_object(self, template_file):
 
-        if len(lines) != 2:
-            print("Object Writer Error: Info file %s should only have two lines. First line should be offset where binary blob will be inserted. Second line should be maximum size of binary blob." % info_file_path)
-            raise ValueError
+        template = self.get_template(template_file, read_data=True)
 
-        lines = [l.strip() for l in lines]
+        return self.overwrite_bytes(template.data, self.raw_bytes, template.offset)
 
-        try:
-            if lines[0].startswith("0x"):
-                offset = int(lines[0], 16)
-            else:
-                offset = int(lines[0], 10)
-        except ValueError:
-            print("Object Writer Error: Unable to parse offset int %s in info file %s" % (lines[0], info_file_path))
-            raise ValueError
+    # Returns a template object file, from the template registry if there is one. Checks that the machine code fits in
+    # the code cave of the template.
+    # read_data - read the bytes of the template, if it isn't in the registry
+    def get_template(self, template_file, read_data) -> ObjectTemplate:
 
-        try:
-            if lines[1].startswith("0x"):
-                size = int(lines[1], 16)
-            else:
-                size = int(lines[1], 10)
-        except ValueError:
-            print("Object Writer Error: Unable to parse size int %s in info file %s" % (lines[1], info_file_path))
+        if self.template_registry is not None:
+            template = self.template_registry.get_template(template_file, output=self.output)
+        else:
+            template = read_template(template_file, read_data, output=self.output)
+
+        if len(self.raw_bytes) > template.size:
+            print("Object Writer Error: Size of assembled code (%s) is larger than available space in binary template" % (len(self.raw_bytes)), file=self.output)
             raise ValueError
 
-        return offset, size
+        return template
 
-    # Overwrite bytes in a buffer at a certain offset with new_bytes.
+    # Overwrite bytes in a buffer at a certain offset with new_bytes. Bytes which would fall past the end of the buffer
+    # are dropped, so the buffer keeps its size.
     def overwrite_bytes(self, original_buffer, new_bytes, offset):
 
-        bin_size = len(new_bytes)
-        current_offset = 0
-
-        new_buffer = bytearray()
+        new_buffer = bytearray(original_buffer)
 
-        while current_offset < len(original_buffer):
-            if offset <= current_offset < offset + bin_size:
-                new_buffer.append(new_bytes[current_offset - offset])
-            else:
-                new_buffer.append(original_buffer[current_offset])
-            current_offset += 1
+        end_offset = min(offset + len(new_bytes), len(new_buffer))
+        if end_offset > offset:
+            new_buffer[offset:end_offset] = new_bytes[:end_offset - offset]
 
         return new_buffer
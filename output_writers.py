@@ -0,0 +1,367 @@
+import io
+import os
+import re
+from typing import Dict, Iterable, List, Tuple
+
+# This module implements the output formats of the assembled machine code. Each format is a writer which consumes the
+# machine code in chunks, formats it and writes it through a buffered file, so no format needs the whole output in
+# memory, and formatting takes linear time. Several formats can be written in a single pass over the machine code with
+# write_outputs.
+#
+# The machine code is given as (address, bytes) segments, so code placed at distant addresses by '.org' and '.section'
+# directives is written without filling the gaps in between in memory. Formats with addresses (ihex, srec) skip the
+# gaps, the raw bin format seeks over them, which leaves a sparse file on filesystems which support them, and the other
+# formats fill them with zeros.
+#
+# The formats are looked up by name in OUTPUT_FORMATS. New formats can be added with register_output_format, by
+# subclassing OutputWriter (or RecordWriter for line based text formats).
+#
+#   bin     - raw machine code
+#   sigma16 - Sigma16 'data' statements, one per 16 bit word
+#   ihex    - Intel HEX records, with 32 bit addresses
+#   srec    - Motorola S-records, with the shortest address size which fits every address
+#   c_array - C header declaring the machine code as a byte array
+
+# Size of the chunks the machine code is split into when writing outputs.
+CHUNK_SIZE = 64 * 1024
+
+
+# Base class of the output formats.
+# out_file - file object the output is written to. Text formats are given a text file, binary formats a binary file.
+# imagebase - memory address of the first byte of machine code
+# size - number of bytes from the first to the last byte of machine code, gaps included, if known in advance
+# name - name of the output, based on the name of the output file. Used by formats which name the code.
+class OutputWriter:
+
+    # Whether the format is written to a binary file.
+    binary = False
+
+    # Text stream which error messages are printed to. None prints them to the console. Set by write_outputs and
+    # get_text_output.
+    output = None
+
+    def __init__(self, out_file, imagebase=0, size=None, name="machine_code"):
+        self.out_file = out_file
+        self.imagebase = imagebase
+        self.size = size
+        self.name = name
+        self.address = imagebase
+        return
+
+    # Called before the first chunk is written.
+    def begin(self):
+        return
+
+    # Writes a chunk of machine code, which follows the chunks already written.
+    def write(self, chunk):
+        self.address += len(chunk)
+        return
+
+    # Returns the address the next chunk is written at.
+    def get_position(self):
+        return self.address
+
+    # Moves on to a higher address, skipping a gap in the machine code. By default the gap is filled with zeros.
+    def seek(self, address):
+        while self.get_position() < address:
+            self.write(bytes(min(CHUNK_SIZE, address - self.get_position())))
+        return
+
+    # Called after the last chunk was written.
+    def end(self):
+        return
+
+
+# Writes the raw machine code.
+class BinWriter(OutputWriter):
+
+    binary = True
+
+    def write(self, chunk):
+        self.out_file.write(chunk)
+        self.address += len(chunk)
+        return
+
+    # Gaps are left as holes in the file, which take up no disk space on filesystems with sparse files.
+    def seek(self, address):
+        self.out_file.seek(address - self.imagebase)
+        self.address = address
+        return
+
+
+# Base class of text formats made of one record per fixed number of bytes. Bytes are buffered until a whole record can
+# be written, and the records of each chunk are formatted together.
+class RecordWriter(OutputWriter):
+
+    # Number of bytes of machine code in each record.
+    bytes_per_record = 16
+
+    def __init__(self, out_file, imagebase=0, size=None, name="machine_code"):
+        super().__init__(out_file, imagebase, size, name)
+        self.pending = bytearray()
+        return
+
+    def write(self, chunk):
+        self.pending += chunk
+        record_bytes = len(self.pending) - len(self.pending) % self.bytes_per_record
+        if record_bytes > 0:
+            self.out_file.write(self.format_records(self.address, bytes(self.pending[:record_bytes])))
+            self.address += record_bytes
+            del self.pending[:record_bytes]
+        return
+
+    def get_position(self):
+        return self.address + len(self.pending)
+
+    def end(self):
+        self.flush()
+        return
+
+    # Writes the bytes which don't fill a whole record yet.
+    def flush(self):
+        if len(self.pending) > 0:
+            self.out_file.write(self.format_records(self.address, bytes(self.pending)))
+            self.address += len(self.pending)
+            self.pending.clear()
+        return
+
+    # Returns the text of the records holding the given bytes, starting at the given address. Only the last call may be
+    # given a number of bytes which isn't a multiple of bytes_per_record.
+    def format_records(self, address, data: bytes) -> str:
+        return "".join(self.format_record(address + offset, data[offset:offset + self.bytes_per_record])
+                       for offset in range(0, len(data), self.bytes_per_record))
+
+    def format_record(self, address, data: bytes) -> str:
+        raise NotImplementedError
+
+
+# Writes Sigma16 'data' statements, which can be loaded and executed in a Sigma16 simulator.
+class Sigma16Writer(RecordWriter):
+
+    bytes_per_record = 2
+
+    def format_records(self, address, data: bytes) -> str:
+        if len(data) % 2 != 0:
+            print("Sigma16 writer error: Sigma16 has 16 bit words, so the buffer length should be divisible by 2. Instead it has a length of %s" % (address + len(data) - self.imagebase), file=self.output)
+            raise ValueError
+
+        hex_data = data.hex()
+        return "".join("    data $" + hex_data[i:i + 4] + "\n" for i in range(0, len(hex_data), 4))
+
+
+# Returns the checksum byte shared by Intel HEX and S-records: the two's or one's complement of the sum of the bytes.
+def get_record_checksum(record: bytes, ones_complement=False) -> int:
+    if ones_complement:
+        return ~sum(record) & 0xFF
+    return -sum(record) & 0xFF
+
+
+# Writes Intel HEX records. Extended linear address records are written whenever the upper 16 bits of the address
+# change, and data records never cross a 64 KiB boundary.
+class IntelHexWriter(RecordWriter):
+
+    def __init__(self, out_file, imagebase=0, size=None, name="machine_code"):
+        super().__init__(out_file, imagebase, size, name)
+        self.upper_address = None
+        return
+
+    def format_records(self, address, data: bytes) -> str:
+        if address + len(data) > 0x100000000:
+            print("Intel HEX writer error: Address 0x%x does not fit in 32 bits." % (address + len(data) - 1), file=self.output)
+            raise ValueError
+
+        records = []
+        offset = 0
+        while offset < len(data):
+            record_address = address + offset
+            if record_address >> 16 != self.upper_address:
+                self.upper_address = record_address >> 16
+                records.append(self.format_hex_record(0, 4, self.upper_address.to_bytes(2, "big")))
+
+            length = min(self.bytes_per_record, len(data) - offset, 0x10000 - (record_address & 0xFFFF))
+            records.append(self.format_hex_record(record_address & 0xFFFF, 0, data[offset:offset + length]))
+            offset += length
+
+        return "".join(records)
+
+    def seek(self, address):
+        self.flush()
+        self.address = address
+        return
+
+    @staticmethod
+    def format_hex_record(address, record_type, data: bytes) -> str:
+        record = bytes([len(data)]) + address.to_bytes(2, "big") + bytes([record_type]) + data
+        return ":" + (record + bytes([get_record_checksum(record)])).hex().upper() + "\n"
+
+    def end(self):
+        super().end()
+        self.out_file.write(":00000001FF\n")
+        return
+
+
+# Writes Motorola S-records: a header record, data records, a record count and a termination record holding the
+# imagebase as the start address. S1, S2 or S3 data records are used, depending on the highest address.
+class SRecordWriter(RecordWriter):
+
+    # Data record type, termination record type and address size in bytes, for each address size.
+    RECORD_TYPES = [(1, 9, 2), (2, 8, 3), (3, 7, 4)]
+
+    def __init__(self, out_file, imagebase=0, size=None, name="machine_code"):
+        super().__init__(out_file, imagebase, size, name)
+        self.record_count = 0
+
+        # If the size isn't known, use 32 bit addresses so any address fits.
+        last_address = imagebase + size - 1 if size is not None else 0xFFFFFFFF
+        for data_type, end_type, address_size in self.RECORD_TYPES:
+            if last_address < 1 << (8 * address_size):
+                break
+        self.data_type, self.end_type, self.address_size = data_type, end_type, address_size
+        return
+
+    def begin(self):
+        self.out_file.write(self.format_s_record(0, 0, 2, self.name.encode("ascii", "replace")[:250]))
+        return
+
+    def format_records(self, address, data: bytes) -> str:
+        if address + len(data) > 1 << (8 * self.address_size):
+            print("S-record writer error: Address 0x%x does not fit in 32 bits." % (address + len(data) - 1), file=self.output)
+            raise ValueError
+        self.record_count += (len(data) + self.bytes_per_record - 1) // self.bytes_per_record
+        return super().format_records(address, data)
+
+    def seek(self, address):
+        self.flush()
+        self.address = address
+        return
+
+    def format_record(self, address, data: bytes) -> str:
+        return self.format_s_record(self.data_type, address, self.address_size, data)
+
+    @staticmethod
+    def format_s_record(record_type, address, address_size, data: bytes) -> str:
+        record = bytes([address_size + len(data) + 1]) + address.to_bytes(address_size, "big") + data
+        return "S%s%s\n" % (record_type, (record + bytes([get_record_checksum(record, True)])).hex().upper())
+
+    def end(self):
+        super().end()
+        if self.record_count <= 0xFFFF:
+            self.out_file.write(self.format_s_record(5, self.record_count, 2, b""))
+        else:
+            self.out_file.write(self.format_s_record(6, self.record_count, 3, b""))
+        self.out_file.write(self.format_s_record(self.end_type, self.imagebase, self.address_size, b""))
+        return
+
+
+# Writes a C header declaring the machine code as a byte array, along with its length and load address.
+class CArrayWriter(RecordWriter):
+
+    bytes_per_record = 12
+
+    def begin(self):
+        self.out_file.write("#include <stdint.h>\n\n")
+        self.out_file.write("#define %s_ADDRESS 0x%x\n\n" % (self.name.upper(), self.imagebase))
+        self.out_file.write("static const uint8_t %s[] = {\n" % self.name)
+        return
+
+    def format_record(self, address, data: bytes) -> str:
+        return "    " + " ".join("0x%02x," % b for b in data) + "\n"
+
+    def end(self):
+        super().end()
+        self.out_file.write("};\n\n")
+        self.out_file.write("static const unsigned int %s_len = %s;\n" % (self.name, self.address - self.imagebase))
+        return
+
+
+# Output formats, by name.
+OUTPUT_FORMATS = {
+    "bin": BinWriter,
+    "sigma16": Sigma16Writer,
+    "ihex": IntelHexWriter,
+    "srec": SRecordWriter,
+    "c_array": CArrayWriter,
+}
+
+
+def register_output_format(format_name, writer_class):
+    OUTPUT_FORMATS[format_name] = writer_class
+    return
+
+
+# Returns a C identifier based on the name of an output file.
+def get_output_name(output_file) -> str:
+    name = re.sub(r"[^0-9A-Za-z_]", "_", os.path.splitext(os.path.basename(output_file))[0])
+    if len(name) == 0 or name[0].isdigit():
+        name = "_" + name
+    return name
+
+
+# Splits machine code into chunks, without copying it.
+def iter_chunks(raw_bytes, chunk_size=CHUNK_SIZE) -> Iterable[memoryview]:
+    view = memoryview(raw_bytes)
+    for offset in range(0, len(view), chunk_size):
+        yield view[offset:offset + chunk_size]
+
+
+# Returns the address of the first byte and the number of bytes up to the last byte of a list of segments.
+def get_segments_span(segments: List[Tuple[int, bytes]], imagebase=0) -> Tuple[int, int]:
+    if len(segments) == 0:
+        return imagebase, 0
+    return segments[0][0], segments[-1][0] + len(segments[-1][1]) - segments[0][0]
+
+
+# Writes segments of machine code through several writers, in a single pass over it.
+def write_segments(writers: List[OutputWriter], segments: List[Tuple[int, bytes]]):
+    for writer in writers:
+        writer.begin()
+    for address, data in segments:
+        for writer in writers:
+            if writer.get_position() != address:
+                writer.seek(address)
+        for chunk in iter_chunks(data):
+            for writer in writers:
+                writer.write(chunk)
+    for writer in writers:
+        writer.end()
+    return
+
+
+# Writes machine code in several formats, in a single pass over it.
+# segments - the machine code, as (address, bytes) tuples sorted by address
+# outputs - maps format names to the files they're written to
+# imagebase - memory address the outputs start at if there is no machine code
+# output - text stream which error messages are printed to. None prints them to the console.
+def write_outputs(segments: List[Tuple[int, bytes]], outputs: Dict[str, str], imagebase=0, output=None):
+    for format_name in outputs.keys():
+        if format_name not in OUTPUT_FORMATS:
+            print("Output writer error: Unknown output format '%s'. Known formats are: %s" % (format_name, ", ".join(OUTPUT_FORMATS.keys())), file=output)
+            raise ValueError
+
+    start_address, size = get_segments_span(segments, imagebase)
+    out_files = []
+    writers = []
+    try:
+        for format_name, output_file in outputs.items():
+            writer_class = OUTPUT_FORMATS[format_name]
+            out_file = open(output_file, "wb+" if writer_class.binary else "w+")
+            out_files.append(out_file)
+            writer = writer_class(out_file, start_address, size, get_output_name(output_file))
+            writer.output = output
+            writers.append(writer)
+
+        write_segments(writers, segments)
+    finally:
+        for out_file in out_files:
+            out_file.close()
+
+    return
+
+
+# Returns the output of a text format as a string.
+def get_text_output(format_name, raw_bytes, imagebase=0, name="machine_code", output=None) -> str:
+    text_buffer = io.StringIO()
+    writer = OUTPUT_FORMATS[format_name](text_buffer, imagebase, len(raw_bytes), name)
+    writer.output = output
+    write_segments([writer], [(imagebase, raw_bytes)])
+    return text_buffer.getvalue()
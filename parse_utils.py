@@ -1,4 +1,5 @@
 from typing import Tuple
+import re
 
 # Static class containing helper methods useful for parsing.
 
@@ -10,6 +11,8 @@ class ParseUtils:
     for c in valid_identifier_chars:
         valid_identifier_chars_map[c] = True
 
+    identifier_regex = re.compile("[" + valid_identifier_chars + "]+")
+
     valid_number_chars = "1234567890"
     valid_number_chars_map = {}
     for c in valid_number_chars:
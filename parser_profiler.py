@@ -0,0 +1,176 @@
+import time
+from typing import Dict, List, Tuple
+
+from asm_grammar_spec import AsmGrammarSpec, AsmInstructionDefinition
+
+# This module implements the parser profiler, enabled with '--profile-parser' or '--suggest-order'. The parser matches
+# an instruction definition by trying its token patterns (rows) in order, until one of them matches. Every row which is
+# tried and rejected is wasted work, so the cost of a spec depends heavily on the order of its rows. The profiler counts,
+# for each row of each definition, how often it was tried, how often it matched, how many characters the parser had
+# consumed before the row was rejected, and the time spent trying it.
+#
+# From the hit counts, the profiler can suggest an order for the rows of each definition, with the most frequently
+# matched rows first. The parser uses the first row that matches, so a suggested order is only safe to apply if no two
+# reordered rows can match the same input (for example 'mov %REG%, int_32' and 'mov %REG%, %REG%' are safe to swap,
+# but two rows where one matches a prefix of the other are not).
+
+# Number of definitions and rows listed in the report.
+REPORT_TOP = 15
+
+
+# Profile of a single row of an instruction definition.
+# attempts - number of times the row was tried
+# successes - number of times the row matched
+# failed_chars - total number of characters consumed by failed attempts before they were rejected
+# total_ns - time spent trying the row, including the time spent in definitions nested in it
+# self_ns - time spent trying the row, excluding the time spent in definitions nested in it
+# failed_ns - time spent in failed attempts, including nested definitions
+class RowProfile:
+
+    def __init__(self):
+        self.attempts = 0
+        self.successes = 0
+        self.failed_chars = 0
+        self.total_ns = 0
+        self.self_ns = 0
+        self.failed_ns = 0
+        return
+
+    def failures(self):
+        return self.attempts - self.successes
+
+
+# Collects a RowProfile for each row of each instruction definition tried by the parser.
+class ParserProfiler:
+
+    def __init__(self, spec: AsmGrammarSpec):
+        self.spec = spec
+        self.rows = {}              # type: Dict[Tuple[str, int], RowProfile]
+
+        # Start time of each attempt in progress, and the time spent in attempts nested in it.
+        self.attempt_stack = []     # type: List[list]
+        return
+
+    # Called by the parser before trying a row.
+    def begin_attempt(self):
+        self.attempt_stack.append([time.perf_counter_ns(), 0])
+        return
+
+    # Called by the parser after trying a row.
+    # consumed_chars - number of characters the parser consumed while trying the row
+    def end_attempt(self, defn: AsmInstructionDefinition, row: int, matched: bool, consumed_chars: int):
+        start_ns, nested_ns = self.attempt_stack.pop()
+        duration_ns = time.perf_counter_ns() - start_ns
+        if len(self.attempt_stack) > 0:
+            self.attempt_stack[-1][1] += duration_ns
+
+        key = (defn.name, row)
+        row_profile = self.rows.get(key)
+        if row_profile is None:
+            row_profile = RowProfile()
+            self.rows[key] = row_profile
+
+        row_profile.attempts += 1
+        row_profile.total_ns += duration_ns
+        row_profile.self_ns += duration_ns - nested_ns
+        if matched:
+            row_profile.successes += 1
+        else:
+            row_profile.failed_chars += consumed_chars
+            row_profile.failed_ns += duration_ns
+        return
+
+    # Profiles of all rows of a definition, in spec order. Rows which were never tried have an empty profile.
+    def get_definition_rows(self, defn_name) -> List[RowProfile]:
+        defn = self.spec.spec[defn_name]
+        return [self.rows.get((defn_name, row), RowProfile()) for row in range(len(defn.spec_patterns))]
+
+    # Names of all definitions which were tried at least once.
+    def get_profiled_definitions(self) -> List[str]:
+        names = []
+        for defn_name, row in self.rows.keys():
+            if defn_name not in names:
+                names.append(defn_name)
+        return names
+
+    # Suggested order of the rows of a definition: row indexes sorted by the number of times each row matched, most
+    # frequent first. Rows with the same number of matches keep their order from the spec.
+    def get_suggested_order(self, defn_name) -> List[int]:
+        row_profiles = self.get_definition_rows(defn_name)
+        return sorted(range(len(row_profiles)), key=lambda row: -row_profiles[row].successes)
+
+    def print_report(self):
+        from tabulate import tabulate
+
+        definition_rows = []
+        for defn_name in self.get_profiled_definitions():
+            row_profiles = self.get_definition_rows(defn_name)
+            definition_rows.append([
+                defn_name,
+                sum(r.attempts for r in row_profiles),
+                sum(r.successes for r in row_profiles),
+                sum(r.failures() for r in row_profiles),
+                sum(r.failed_chars for r in row_profiles),
+                sum(r.self_ns for r in row_profiles) / 1e6,
+                sum(r.failed_ns for r in row_profiles) / 1e6,
+            ])
+        definition_rows.sort(key=lambda r: -r[5])
+
+        print("Hottest definitions:")
+        print(tabulate(definition_rows[:REPORT_TOP], floatfmt=".3f", headers=[
+            "definition", "attempts", "matches", "failures", "wasted chars", "self ms", "wasted ms"]))
+        print("")
+
+        wasted_rows = []
+        for (defn_name, row), r in self.rows.items():
+            if r.failures() == 0:
+                continue
+            pattern = self.spec.spec[defn_name].spec_patterns[row]
+            wasted_rows.append([defn_name, pattern.line_num, pattern.text.split("::")[0].strip(), r.attempts,
+                                r.successes, r.failed_chars, r.failed_ns / 1e6])
+        wasted_rows.sort(key=lambda r: -r[6])
+
+        print("Rows with the most wasted work:")
+        print(tabulate(wasted_rows[:REPORT_TOP], floatfmt=".3f", headers=[
+            "definition", "spec line", "pattern", "attempts", "matches", "wasted chars", "wasted ms"]))
+        print("")
+
+        total_failures = sum(r.failures() for r in self.rows.values())
+        total_attempts = sum(r.attempts for r in self.rows.values())
+        print("%s of %s row attempts failed, wasting %s consumed characters" % (
+            total_failures, total_attempts, sum(r.failed_chars for r in self.rows.values())))
+        return
+
+    # Returns the profile and suggested order of every profiled definition, as a dict which can be saved as JSON.
+    def to_dict(self):
+        definitions = {}
+        for defn_name in self.get_profiled_definitions():
+            defn = self.spec.spec[defn_name]
+            rows = []
+            for row, r in enumerate(self.get_definition_rows(defn_name)):
+                pattern = defn.spec_patterns[row]
+                rows.append({
+                    "row": row,
+                    "line": pattern.line_num,
+                    "pattern": pattern.text,
+                    "attempts": r.attempts,
+                    "matches": r.successes,
+                    "failures": r.failures(),
+                    "wasted_chars": r.failed_chars,
+                    "total_ms": r.total_ns / 1e6,
+                    "self_ms": r.self_ns / 1e6,
+                    "wasted_ms": r.failed_ns / 1e6,
+                })
+            definitions[defn_name] = {
+                "line": defn.line_num + 1,
+                "suggested_order": self.get_suggested_order(defn_name),
+                "rows": rows,
+            }
+        return {"definitions": definitions}
+
+    def write_json(self, output_file):
+        import json
+
+        with open(output_file, "w+") as out_file:
+            json.dump(self.to_dict(), out_file, indent=2)
+        return
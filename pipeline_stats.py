@@ -0,0 +1,127 @@
+import time
+import tracemalloc
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List
+
+# This module implements the optional per-stage instrumentation of the assembler pipeline, enabled with '--stats'. For
+# each stage of the pipeline (plugin load, spec read, the passes of the parser, the passes of the bitstream generator,
+# and the output writers) the wall time, CPU time and peak memory allocated by Python code are recorded, along with
+# counts such as the number of lines, instructions and bytes emitted. The stats can be printed as a table, or saved as
+# JSON.
+#
+# Peak memory is measured with tracemalloc, which is started when a PipelineStats object is created. Tracing every
+# allocation slows the whole run down, so the wall and CPU times recorded with memory tracing enabled are higher than
+# those of a normal run.
+
+# Order in which the stages are shown in the report, if they were recorded. Stages not listed here are shown after them
+# in the order they were first recorded.
+STAGE_ORDER = ["plugin load", "spec read", "label pass", "parse pass", "label assignment", "layout", "label fixup",
+               "encoding", "disassembly check", "write outputs", "write object"]
+
+
+# Time and memory recorded for one stage. If a stage runs several times (for example when the same Assembler is used
+# for several listings), the times are summed and the largest peak is kept.
+class StageStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.wall_ns = 0
+        self.cpu_ns = 0
+        self.peak_bytes = 0
+        return
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "wall_ms": self.wall_ns / 1e6,
+            "cpu_ms": self.cpu_ns / 1e6,
+            "peak_bytes": self.peak_bytes,
+        }
+
+
+# Collects StageStats for each stage of the pipeline, and counters.
+# trace_memory - record the peak memory of each stage with tracemalloc
+class PipelineStats:
+
+    def __init__(self, trace_memory=True):
+        self.stages = {}            # type: Dict[str, StageStats]
+        self.counts = {}            # type: Dict[str, int]
+        self.trace_memory = trace_memory
+
+        # Stages in progress, as [start memory, absolute peak memory] pairs. Used to measure the peak of nested stages,
+        # as tracemalloc only tracks a single peak, which each stage resets when it starts.
+        self.memory_stack = []      # type: List[list]
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        return
+
+    # Records the time and memory used by the code run inside the 'with' block as the given stage.
+    @contextmanager
+    def stage(self, stage_name):
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            for entry in self.memory_stack:
+                entry[1] = max(entry[1], peak)
+            tracemalloc.reset_peak()
+            self.memory_stack.append([current, current])
+
+        start_wall = time.perf_counter_ns()
+        start_cpu = time.process_time_ns()
+        try:
+            yield
+        finally:
+            stage_stats = self.stages.setdefault(stage_name, StageStats())
+            stage_stats.calls += 1
+            stage_stats.wall_ns += time.perf_counter_ns() - start_wall
+            stage_stats.cpu_ns += time.process_time_ns() - start_cpu
+
+            if self.trace_memory:
+                start_memory, peak = self.memory_stack.pop()
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+                stage_stats.peak_bytes = max(stage_stats.peak_bytes, peak - start_memory)
+                if len(self.memory_stack) > 0:
+                    self.memory_stack[-1][1] = max(self.memory_stack[-1][1], peak)
+
+    def add_count(self, name, value=1):
+        self.counts[name] = self.counts.get(name, 0) + value
+        return
+
+    def get_stage_names(self) -> List[str]:
+        names = [s for s in STAGE_ORDER if s in self.stages]
+        names.extend(s for s in self.stages.keys() if s not in STAGE_ORDER)
+        return names
+
+    def print_report(self):
+        from tabulate import tabulate
+
+        rows = []
+        for stage_name in self.get_stage_names():
+            s = self.stages[stage_name]
+            rows.append([stage_name, s.calls, s.wall_ns / 1e6, s.cpu_ns / 1e6, s.peak_bytes / 1024])
+        headers = ["stage", "calls", "wall ms", "cpu ms", "peak KiB"]
+        print(tabulate(rows, headers=headers, floatfmt=".3f"))
+        print("")
+        print(tabulate(sorted(self.counts.items()), headers=["count", "value"]))
+        return
+
+    def to_dict(self):
+        return {
+            "stages": {stage_name: self.stages[stage_name].to_dict() for stage_name in self.get_stage_names()},
+            "counts": dict(sorted(self.counts.items())),
+            "memory_traced": self.trace_memory,
+        }
+
+    def write_json(self, output_file):
+        import json
+
+        with open(output_file, "w+") as out_file:
+            json.dump(self.to_dict(), out_file, indent=2)
+        return
+
+
+# Times a stage with the given stats object. Does nothing if stats is None, so instrumented code doesn't need to check.
+def stage(stats: PipelineStats, stage_name):
+    if stats is None:
+        return nullcontext()
+    return stats.stage(stage_name)
@@ -0,0 +1,137 @@
+import time
+from typing import Dict, List, Tuple
+
+# This module implements optional instrumentation of the plugin system. When enabled, every call into a plugin (or
+# native int type) method is timed, and for each registered type the call count and latency distribution of its
+# verify/emit/calc methods are recorded. The chars method is only called once, when the plugin is loaded, so it isn't
+# instrumented. At the end of a run the recorded stats can be printed as a table, or
+# saved as JSON, which makes it possible to tell how much of the assembly time is spent in plugin code.
+
+# Percentiles shown in the report.
+REPORT_PERCENTILES = [50, 90, 99]
+
+
+# Latency histogram with power-of-two buckets. Bucket k counts calls which took less than 2^k nanoseconds (and at
+# least 2^(k-1) nanoseconds), so the histogram has a fixed, small size no matter how many calls are recorded.
+# Percentiles are estimated as the upper bound of the bucket they fall into, capped at the slowest recorded call.
+class LatencyHistogram:
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.buckets = {}  # type: Dict[int, int]
+        return
+
+    def record(self, duration_ns: int):
+        self.count += 1
+        self.total_ns += duration_ns
+        if self.min_ns is None or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+        bucket = duration_ns.bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        return
+
+    def percentile(self, p) -> int:
+        if self.count == 0:
+            return 0
+        threshold = self.count * p / 100.0
+        seen = 0
+        for bucket in sorted(self.buckets.keys()):
+            seen += self.buckets[bucket]
+            if seen >= threshold:
+                return min((1 << bucket) - 1, self.max_ns)
+        return self.max_ns
+
+    def mean_ns(self) -> float:
+        if self.count == 0:
+            return 0.0
+        return self.total_ns / self.count
+
+    def to_dict(self):
+        result = {
+            "calls": self.count,
+            "total_ns": self.total_ns,
+            "mean_ns": self.mean_ns(),
+            "min_ns": self.min_ns if self.min_ns is not None else 0,
+            "max_ns": self.max_ns,
+            "histogram": [{"lt_ns": 1 << b, "calls": self.buckets[b]} for b in sorted(self.buckets.keys())],
+        }
+        for p in REPORT_PERCENTILES:
+            result["p%s_ns" % p] = self.percentile(p)
+        return result
+
+
+# Collects a LatencyHistogram for each (type, method) pair of the plugin system.
+class PluginStats:
+
+    def __init__(self):
+        self.histograms = {}  # type: Dict[Tuple[str, str], LatencyHistogram]
+        return
+
+    def get_histogram(self, type_name, method_kind) -> LatencyHistogram:
+        key = (type_name, method_kind)
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        return self.histograms[key]
+
+    # Returns a wrapper around a plugin method which records the latency of each call. method_kind is one of 'verify',
+    # 'emit', 'calc'.
+    def wrap(self, type_name, method_kind, method):
+        histogram = self.get_histogram(type_name, method_kind)
+
+        def timed_method(*args):
+            start = time.perf_counter_ns()
+            try:
+                return method(*args)
+            finally:
+                histogram.record(time.perf_counter_ns() - start)
+
+        return timed_method
+
+    # Rows of the report, grouped by type. The types with the most time spent in plugin code come first, and the
+    # methods of each type are sorted the same way.
+    def get_report_rows(self) -> List[list]:
+        types = {}  # type: Dict[str, List[Tuple[str, LatencyHistogram]]]
+        for (type_name, method_kind), h in self.histograms.items():
+            if h.count > 0:
+                types.setdefault(type_name, []).append((method_kind, h))
+
+        def get_type_total_ns(type_name):
+            return sum(h.total_ns for method_kind, h in types[type_name])
+
+        rows = []
+        for type_name in sorted(types.keys(), key=lambda t: (-get_type_total_ns(t), t)):
+            for method_kind, h in sorted(types[type_name], key=lambda i: (-i[1].total_ns, i[0])):
+                row = [type_name, method_kind, h.count, h.total_ns / 1e6, h.mean_ns() / 1e3]
+                row.extend(h.percentile(p) / 1e3 for p in REPORT_PERCENTILES)
+                row.append(h.max_ns / 1e3)
+                rows.append(row)
+        return rows
+
+    def print_report(self):
+        from tabulate import tabulate
+
+        headers = ["type", "method", "calls", "total ms", "mean us"]
+        headers.extend("p%s us" % p for p in REPORT_PERCENTILES)
+        headers.append("max us")
+        print(tabulate(self.get_report_rows(), headers=headers, floatfmt=".3f"))
+        return
+
+    def to_dict(self):
+        types = {}
+        for (type_name, method_kind), h in sorted(self.histograms.items()):
+            if h.count == 0:
+                continue
+            types.setdefault(type_name, {})[method_kind] = h.to_dict()
+        return {"types": types}
+
+    def write_json(self, output_file):
+        import json
+
+        with open(output_file, "w+") as out_file:
+            json.dump(self.to_dict(), out_file, indent=2)
+        return
@@ -1,7 +1,7 @@
 from yapsy.IPlugin import IPlugin
 from bitstring import BitArray
 
-from typing import Optional
+from typing import Dict, Optional
 
 # This plugin implement the different ARM immediate encodings.
 
@@ -22,6 +22,8 @@ class ARMTypes(IPlugin):
             "int_12_bits_constrained": True,
         }
 
+        self.rotated_immediates = self.build_rotated_immediates_table()
+
         return
 
     def get_registered_types(self):
@@ -72,58 +74,29 @@ class ARMTypes(IPlugin):
                 return None
         return None
 
+    # Data processing immediates are an 8 bit base rotated right by an even amount (2 * rotation). There are only
+    # 16 * 256 such values, so a table mapping every encodable 32 bit value to its 12 bit rotation/base encoding is
+    # built once when the plugin is loaded. Rotations are visited in the same order as the original bit window search
+    # (4..15, then 0..3), and the first encoding found for a value is kept, so values with several possible encodings
+    # always get the same one.
+    @staticmethod
+    def build_rotated_immediates_table() -> Dict[int, str]:
+        table = {}
+        for rotation in list(range(4, 16)) + list(range(0, 4)):
+            shift = rotation * 2
+            for base in range(0, 256):
+                value = ((base >> shift) | (base << (32 - shift))) & 0xFFFFFFFF
+                if value not in table:
+                    table[value] = "{:04b}{:08b}".format(rotation, base)
+        return table
+
     def emit_int_12_bits_constrained(self, int_string):
         parsed_int = self.parse_int(int_string)
         if parsed_int is None:
             return None
-        b = BitArray(int=parsed_int, length=32)
-        bits = str(b.bin)
-
-        base = None
-        rotation = None
-        for i in range(0, 16):
-
-            has_bits_outside_window = False
-            bits_outside_window = bits
-            # noinspection PyUnusedLocal
-            bits_in_window = []
-
-            window_start = i * 2
-            window_end = window_start + 8
-            if window_end >= len(bits):
-                window_end = window_end - len(bits)
-
-                bits_in_window = bits[window_start:len(bits)] + bits[0:window_end]
-
-                bits_outside_window = bits_outside_window[window_end:window_start]
-            else:
-                bits_in_window = bits[window_start:window_end]
-                bits_outside_window = bits_outside_window[0:window_start] + bits_outside_window[window_end:len(bits_outside_window)]
-
-            for bit in bits_outside_window:
-                if bit == '1':
-                    has_bits_outside_window = True
-                    break
-
-            if not has_bits_outside_window:
-                base = bits_in_window
-
-                if window_end > window_start:
-                    rotation = 4 + i
-                else:
-                    rotation = (window_end / 2)
-
-                break
-
-        if base is None or rotation is None:
+        if not -2147483648 <= parsed_int <= 4294967295:
             return None
-
-        base_bits = BitArray('0b' + base)
-        rotation_bits = BitArray(uint=rotation, length=4)
-
-        rotation_bits.append(base_bits)
-
-        return rotation_bits.bin
+        return self.rotated_immediates.get(parsed_int & 0xFFFFFFFF)
 
     def emit_int_8_bits_absolute(self, int_string):
         parsed_int = self.parse_int(int_string)
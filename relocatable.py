@@ -0,0 +1,229 @@
+import json
+import os
+from typing import Dict, List, Tuple
+
+from asm_int_types import IntTypeRegistry
+from bitstream_gen import BitstreamGenerator
+
+# This module implements relocatable images, an intermediate format written with '--write-reloc'. The imagebase only
+# affects the addresses of instructions and labels, and through them the bits emitted for label references. A
+# relocatable image holds the encoded machine code along with a fixup record for each label reference, so '--rebase' can
+# produce the final image at any imagebase by recomputing only the label bits, without reading the spec or parsing the
+# listing again.
+#
+# Addresses which follow from the imagebase are stored as offsets from it, and move when the image is rebased. Addresses
+# set by '.org' or '.section' directives are absolute, and stay where they are, just like when assembling the listing
+# again with another imagebase.
+#
+# The file starts with a line holding RELOC_MAGIC, followed by a line of JSON describing the segments, labels and fixups,
+# followed by the bytes of each segment in order.
+
+RELOC_MAGIC = "GENASM-RELOC 1"
+
+
+# A contiguous run of machine code.
+# address - offset from the imagebase if relative, otherwise the absolute address
+# relative - whether the segment moves with the imagebase
+# data - bytes of the segment, with label references encoded for the imagebase the image was assembled at
+class RelocatableSegment:
+
+    def __init__(self, address: int, relative: bool, data):
+        self.address = address
+        self.relative = relative
+        self.data = data
+        return
+
+
+# A label reference, whose bits are recomputed when the image is rebased.
+# segment - index of the segment holding the reference
+# bit_offset - offset of the bits of the reference from the start of the segment
+# bit_length - number of bits of the reference
+# source_offset - offset of the instruction holding the reference from the start of the segment
+# label_type - label type which calculates the bits of the reference
+# label_name - name of the referenced label
+class Fixup:
+
+    def __init__(self, segment: int, bit_offset: int, bit_length: int, source_offset: int, label_type: str,
+                 label_name: str):
+        self.segment = segment
+        self.bit_offset = bit_offset
+        self.bit_length = bit_length
+        self.source_offset = source_offset
+        self.label_type = label_type
+        self.label_name = label_name
+        return
+
+
+# Machine code which can be placed at any imagebase.
+# imagebase - imagebase the image was assembled at
+# segments - segments of machine code
+# labels - address of each label, as an (address, relative) tuple like the address of a segment
+# fixups - label references in the segments. References to labels which aren't in labels are imports, which must be
+#           resolved by linking the image with other units (see linker.py).
+# exports - names of the labels declared .global, which other units can refer to. The other labels are local to the
+#           image when it's linked.
+class RelocatableImage:
+
+    def __init__(self, imagebase: int, segments: List[RelocatableSegment], labels: Dict[str, Tuple[int, bool]],
+                 fixups: List[Fixup], exports: List[str] = None):
+        self.imagebase = imagebase
+        self.segments = segments
+        self.labels = labels
+        self.fixups = fixups
+        self.exports = exports if exports is not None else []
+        return
+
+    @staticmethod
+    def get_address(address, relative, imagebase) -> int:
+        return imagebase + address if relative else address
+
+    # Returns the address of each label, with the image placed at the given imagebase.
+    def get_label_addresses(self, imagebase) -> Dict[str, int]:
+        return {name: self.get_address(address, relative, imagebase)
+                for name, (address, relative) in self.labels.items()}
+
+    # Returns the names of the labels referred to, but not defined, by the image.
+    def get_imports(self) -> List[str]:
+        return sorted({fixup.label_name for fixup in self.fixups if fixup.label_name not in self.labels})
+
+    # Returns the number of bytes taken up by the code which moves with the imagebase.
+    def get_relative_size(self) -> int:
+        return max([s.address + len(s.data) for s in self.segments if s.relative], default=0)
+
+    # Returns the machine code placed at the given imagebase, as (address, bytes) segments sorted by address.
+    def rebase(self, imagebase, int_type_registry: IntTypeRegistry) -> List[Tuple[int, bytes]]:
+        label_addresses = self.get_label_addresses(imagebase)
+        patched = {}    # type: Dict[int, bytearray]
+
+        for fixup in self.fixups:
+            segment = self.segments[fixup.segment]
+            if fixup.label_name not in label_addresses:
+                print("Relocatable Image ERROR: Fixup refers to unknown label '%s'" % fixup.label_name)
+                raise ValueError
+            if not int_type_registry.is_defined_type(fixup.label_type):
+                print("Relocatable Image ERROR: Label type '%s' is not defined in any plugin." % fixup.label_type)
+                raise ValueError
+
+            source_address = self.get_address(segment.address, segment.relative, imagebase) + fixup.source_offset
+            label_address = label_addresses[fixup.label_name]
+            label_bits = int_type_registry.calc_label_bits(fixup.label_type, source_address, label_address)
+            if len(label_bits) != fixup.bit_length or any(c != "0" and c != "1" for c in label_bits):
+                print("Relocatable Image ERROR: Label type '%s' returned the bitstring '%s' for label '%s' at imagebase 0x%x, but the image has room for %s bits" % (fixup.label_type, label_bits, fixup.label_name, imagebase, fixup.bit_length))
+                raise ValueError
+
+            if fixup.segment not in patched:
+                patched[fixup.segment] = bytearray(segment.data)
+            patch_bits(patched[fixup.segment], fixup.bit_offset, label_bits)
+
+        segments = []
+        for idx, segment in enumerate(self.segments):
+            data = patched[idx] if idx in patched else segment.data
+            segments.append((self.get_address(segment.address, segment.relative, imagebase), data))
+
+        # Relative segments may now overlap absolute ones.
+        return BitstreamGenerator.sort_segments(segments)
+
+    def write(self, path):
+        header = {
+            "imagebase": self.imagebase,
+            "segments": [{"address": s.address, "relative": s.relative, "size": len(s.data)} for s in self.segments],
+            "labels": {name: [address, relative] for name, (address, relative) in self.labels.items()},
+            "fixups": [[f.segment, f.bit_offset, f.bit_length, f.source_offset, f.label_type, f.label_name]
+                       for f in self.fixups],
+            "exports": self.exports,
+        }
+
+        with open(path, "wb+") as reloc_file:
+            reloc_file.write((RELOC_MAGIC + "\n").encode("ascii"))
+            reloc_file.write(json.dumps(header).encode("utf-8") + b"\n")
+            for segment in self.segments:
+                reloc_file.write(segment.data)
+        return
+
+    @staticmethod
+    def read(path):
+        if not os.path.isfile(path):
+            print("Relocatable Image ERROR: File '%s' does not exist" % path)
+            raise ValueError
+
+        with open(path, "rb") as reloc_file:
+            if reloc_file.readline().rstrip(b"\n") != RELOC_MAGIC.encode("ascii"):
+                print("Relocatable Image ERROR: File '%s' is not a relocatable image written with --write-reloc" % path)
+                raise ValueError
+            try:
+                header = json.loads(reloc_file.readline().decode("utf-8"))
+            except ValueError:
+                print("Relocatable Image ERROR: Header of relocatable image '%s' is not valid JSON" % path)
+                raise ValueError
+            data = reloc_file.read()
+
+        segments = []
+        offset = 0
+        for s in header["segments"]:
+            segments.append(RelocatableSegment(s["address"], s["relative"], data[offset:offset + s["size"]]))
+            offset += s["size"]
+        if offset != len(data):
+            print("Relocatable Image ERROR: Relocatable image '%s' is truncated or has trailing data" % path)
+            raise ValueError
+
+        labels = {name: (address, relative) for name, (address, relative) in header["labels"].items()}
+        fixups = [Fixup(*f) for f in header["fixups"]]
+        return RelocatableImage(header["imagebase"], segments, labels, fixups, header.get("exports"))
+
+
+# Overwrites bits of a buffer, starting at the given bit offset.
+def patch_bits(buffer: bytearray, bit_offset, bits: str):
+    start = bit_offset // 8
+    end = (bit_offset + len(bits) + 7) // 8
+    shift = (end - start) * 8 - (bit_offset - start * 8) - len(bits)
+    mask = ((1 << len(bits)) - 1) << shift
+
+    value = int.from_bytes(buffer[start:end], "big")
+    value = (value & ~mask) | (int(bits, 2) << shift)
+    buffer[start:end] = value.to_bytes(end - start, "big")
+    return
+
+
+# Builds the relocatable image of code laid out by a bitstream generator. Must be given the segments returned by the
+# generator's get_segments, as the generator only keeps track of label references while generating them.
+# exports - names of the labels declared .global
+def make_relocatable(bits_gen: BitstreamGenerator, segments: List[Tuple[int, bytes]],
+                     exports: List[str] = None) -> RelocatableImage:
+    imagebase = bits_gen.imagebase
+    segment_indexes = {address: idx for idx, (address, data) in enumerate(segments)}
+
+    reloc_segments = []
+    for address, data in segments:
+        relative = bits_gen.segment_relative[address]
+        reloc_segments.append(RelocatableSegment(address - imagebase if relative else address, relative, data))
+
+    labels = {}
+    for ast_index, ast_node in enumerate(bits_gen.ast):
+        relative = bits_gen.node_relative[ast_index]
+        for lbl in ast_node.labels:
+            labels[lbl] = (ast_node.address - imagebase if relative else ast_node.address, relative)
+
+    fixups = []
+    for ast_index, modifier, label_type, label_name in bits_gen.label_references:
+        ast_node = bits_gen.ast[ast_index]
+        # The label's bits don't end up in the machine code if another modifier overwrites the bitfield.
+        if bits_gen.get_last_modifier(ast_node, modifier.bitfield_name) is not modifier:
+            continue
+        if ast_index not in bits_gen.node_positions:
+            continue
+
+        segment_address, node_bit_offset = bits_gen.node_positions[ast_index]
+        field_offset, field_length = bits_gen.get_bitfield_position(ast_node, modifier.bitfield_name)
+        node_bits = bits_gen.bitfields_to_bitarray(ast_node.node_bitfields).length
+        node_bytes = (node_bits + 7) // 8
+        for copy in range(ast_node.repeat):
+            fixups.append(Fixup(segment_indexes[segment_address], node_bit_offset + copy * node_bytes * 8 + field_offset,
+                                field_length, ast_node.address - segment_address, label_type, label_name))
+
+    return RelocatableImage(imagebase, reloc_segments, labels, fixups, exports)
+
+
+# Returns the path of an output for one of several imagebases, with the imagebase added to its name.
+def get_rebased_path(path, imagebase) -> str:
+    root, extension = os.path.splitext(path)
+    return "%s_0x%x%s" % (root, imagebase, extension)
@@ -74,6 +74,37 @@ def with_disasm():
     if os.system("python main.py " + test_string) != 0:
         return
 
+    # Same listings with the Sigma16 data type declared natively in the spec, instead of by the sigma16_types plugin.
+    for listing in ["test/sigma16_Write.asm.txt", "test/sigma16_Add.asm.txt"]:
+        test_string = """
+                        -s
+                        test/sigma16_native_spec.txt
+                        -a
+                        %s
+                        --sigma16-labels
+                        --imagebase=0
+                        --write-sigma16=out.exe
+                        """ % listing
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) != 0:
+            return
+
+    # Both the plugin and the native Sigma16 data type must reject hex literals which don't have 4 digits.
+    for spec in ["test/sigma16_spec.txt", "test/sigma16_native_spec.txt"]:
+        test_string = """
+                        -s
+                        %s
+                        -a
+                        test/sigma16_bad_hex.asm.txt
+                        --sigma16-labels
+                        --imagebase=0
+                        --write-sigma16=out.exe
+                        """ % spec
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) == 0:
+            print("TEST FAILED: %s accepted a hex literal with 2 digits" % spec)
+            return
+
     test_string = """
                         -s
                         test/test_x86_spec.txt
@@ -128,6 +159,7 @@ def with_disasm():
     if os.system("python main.py " + test_string) != 0:
         return
 
+    feature_tests()
     return
 
 
@@ -188,6 +220,37 @@ def without_disasm():
     if os.system("python main.py " + test_string) != 0:
         return
 
+    # Same listings with the Sigma16 data type declared natively in the spec, instead of by the sigma16_types plugin.
+    for listing in ["test/sigma16_Write.asm.txt", "test/sigma16_Add.asm.txt"]:
+        test_string = """
+                        -s
+                        test/sigma16_native_spec.txt
+                        -a
+                        %s
+                        --sigma16-labels
+                        --imagebase=0
+                        --write-sigma16=out.exe
+                        """ % listing
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) != 0:
+            return
+
+    # Both the plugin and the native Sigma16 data type must reject hex literals which don't have 4 digits.
+    for spec in ["test/sigma16_spec.txt", "test/sigma16_native_spec.txt"]:
+        test_string = """
+                        -s
+                        %s
+                        -a
+                        test/sigma16_bad_hex.asm.txt
+                        --sigma16-labels
+                        --imagebase=0
+                        --write-sigma16=out.exe
+                        """ % spec
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) == 0:
+            print("TEST FAILED: %s accepted a hex literal with 2 digits" % spec)
+            return
+
     test_string = """
                             -s
                             test/test_x86_spec.txt
@@ -233,9 +296,272 @@ def without_disasm():
     if os.system("python main.py " + test_string) != 0:
         return
 
+    feature_tests()
+    return
+
+
+# Returns whether two files hold the same bytes. Prints a failure message if they don't.
+def check_same_output(path, expected_path):
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(expected_path, "rb") as f:
+        expected_data = f.read()
+
+    if data != expected_data:
+        print("TEST FAILED: '%s' doesn't match '%s'" % (path, expected_path))
+        return False
+
+    return True
+
+
+# Tests of the directives, output formats, relocation, separate compilation and watch mode. These don't need the
+# disassembler, so they run with and without it. Output files are compared against files checked into the test folder,
+# or against the output of assembling the same code another way.
+def feature_tests():
+
+    # .org and .section directives, with references between the sections. Also checks the Intel HEX and S-record output
+    # of code with gaps.
+    test_string = """
+            -s
+            test/test_x86_spec.txt
+            -a
+            test/test_x86_layout.txt
+            --imagebase=0x1000
+            --write-bin=out_layout.bin
+            --write-ihex=out_layout.hex
+            --write-srec=out_layout.srec
+            """
+    test_string = test_string.replace("\n", " ")
+    if os.system("python main.py " + test_string) != 0:
+        return
+    for extension in ["bin", "hex", "srec"]:
+        if not check_same_output("out_layout." + extension, "test/test_x86_layout." + extension):
+            return
+
+    # Code placed with .org on top of code which is already there must be rejected.
+    test_string = """
+            -s
+            test/test_x86_spec.txt
+            -a
+            test/test_x86_overlap.txt
+            --write-bin=out_overlap.bin
+            """
+    test_string = test_string.replace("\n", " ")
+    if os.system("python main.py " + test_string) == 0:
+        print("TEST FAILED: test/test_x86_overlap.txt was accepted with overlapping code")
+        return
+
+    # .repeat, .fill and .incbin directives.
+    test_string = """
+            -s
+            test/test_x86_spec.txt
+            -a
+            test/test_x86_data.txt
+            --imagebase=0x1000
+            --write-bin=out_data.bin
+            """
+    test_string = test_string.replace("\n", " ")
+    if os.system("python main.py " + test_string) != 0:
+        return
+    if not check_same_output("out_data.bin", "test/test_x86_data.bin"):
+        return
+
+    # Long runs of data statements must assemble to the same machine code with and without the data run fast path.
+    for flags, out_path in [("", "out_data_run.bin"), ("--no-fast-data-runs", "out_data_run_slow.bin")]:
+        test_string = """
+                -s
+                test/sigma16_spec.txt
+                -a
+                test/sigma16_data_run.asm.txt
+                --sigma16-labels
+                --imagebase=0
+                --write-bin=%s
+                %s
+                """ % (out_path, flags)
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) != 0:
+            return
+    if not check_same_output("out_data_run.bin", "out_data_run_slow.bin"):
+        return
+
+    # A relocatable image rebased to two imagebases must match the code assembled directly at each imagebase. The image
+    # is also written after printing the bitstream, which generates the bitstream an extra time.
+    for imagebase in ["0x1000", "0x400000"]:
+        test_string = """
+                -s
+                test/test_x86_spec.txt
+                -a
+                test/test_x86_listing.txt
+                --imagebase=%s
+                --write-bin=out_direct_%s.bin
+                """ % (imagebase, imagebase)
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) != 0:
+            return
+
+    for flags in ["", "--print-bitstream"]:
+        test_string = """
+                -s
+                test/test_x86_spec.txt
+                -a
+                test/test_x86_listing.txt
+                --imagebase=0x1000
+                --write-reloc=out_listing.reloc
+                %s
+                """ % flags
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) != 0:
+            return
+
+        test_string = """
+                -s
+                test/test_x86_spec.txt
+                --rebase=out_listing.reloc
+                --rebase-to=0x1000,0x400000
+                --write-bin=out_rebase.bin
+                """
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) != 0:
+            return
+
+        for imagebase in ["0x1000", "0x400000"]:
+            if not check_same_output("out_rebase_%s.bin" % imagebase, "out_direct_%s.bin" % imagebase):
+                return
+
+    # Two units linked together, each with its own local 'loop' label, must match the same code assembled as a single
+    # listing.
+    test_string = """
+            -s
+            test/test_x86_spec.txt
+            --unit=test/test_x86_unit_main.txt
+            --unit=test/test_x86_unit_lib.txt
+            --imagebase=0x1000
+            --write-bin=out_linked.bin
+            """
+    test_string = test_string.replace("\n", " ")
+    if os.system("python main.py " + test_string) != 0:
+        return
+
+    test_string = """
+            -s
+            test/test_x86_spec.txt
+            -a
+            test/test_x86_unit_whole.txt
+            --imagebase=0x1000
+            --write-bin=out_whole.bin
+            """
+    test_string = test_string.replace("\n", " ")
+    if os.system("python main.py " + test_string) != 0:
+        return
+    if not check_same_output("out_linked.bin", "out_whole.bin"):
+        return
+
+    if not watch_tests():
+        return
+
+    if not service_tests():
+        return
+
+    for path in os.listdir("."):
+        if path.startswith("out_"):
+            os.remove(path)
+
     return
 
 
+# Reassembles a listing in a watch session after inserting a line, deleting a line and moving a label, and a listing
+# starting with .org after adding a comment above the .org directive. After each edit, the output of the watch session
+# must match the edited listing assembled from scratch. Returns whether the tests passed.
+def watch_tests():
+    from asm_grammar_spec import AsmGrammarSpec
+    from asm_int_types import IntTypeRegistry
+
+    int_type_registry = IntTypeRegistry()
+    int_type_registry.load_plugins()
+    asm_grammar = AsmGrammarSpec(int_type_registry)
+    asm_grammar.read_spec("test/test_x86_spec.txt")
+
+    with open("test/test_x86_listing.txt", "r") as asm_file:
+        lines = asm_file.readlines()
+
+    inserted = lines[:3] + ["push ebx\n"] + lines[3:]
+    deleted = inserted[:4] + inserted[5:]
+    label_line = deleted.index("test_label3:\n")
+    moved = deleted[:label_line] + deleted[label_line + 1:]
+    moved.insert(moved.index("mov al, -1\n"), "test_label3:\n")
+
+    if not check_watch_edits(asm_grammar, [("initial", lines), ("insert", inserted), ("delete", deleted),
+                                           ("label move", moved)]):
+        return False
+
+    org_lines = [".org 0x2000\n"] + lines
+    commented = ["; comment\n"] + org_lines
+    changed = commented[:2] + ["push ebx\n"] + commented[3:]
+
+    return check_watch_edits(asm_grammar, [("initial", org_lines), ("comment above .org", commented),
+                                           ("instruction after .org", changed)])
+
+
+# Runs a watch session through a list of (edit name, lines) edits, checking its output after each one. Returns whether
+# the output was right after every edit.
+def check_watch_edits(asm_grammar, edits):
+    from asm_watch import WatchSession
+
+    if os.path.exists("out_watch.bin"):
+        os.remove("out_watch.bin")
+    session = WatchSession(asm_grammar, "out_watch.txt", 0x1000, outputs={"bin": "out_watch.bin"})
+
+    for edit, edited_lines in edits:
+        try:
+            print(session.update(edited_lines))
+        except (ValueError, OSError):
+            print("TEST FAILED: Watch session failed to reassemble the listing after the %s edit" % edit)
+            return False
+
+        with open("out_watch.txt", "w") as asm_file:
+            asm_file.writelines(edited_lines)
+
+        test_string = """
+                -s
+                test/test_x86_spec.txt
+                -a
+                out_watch.txt
+                --imagebase=0x1000
+                --write-bin=out_watch_full.bin
+                """
+        test_string = test_string.replace("\n", " ")
+        if os.system("python main.py " + test_string) != 0:
+            return False
+        if not check_same_output("out_watch.bin", "out_watch_full.bin"):
+            print("TEST FAILED: Watch session output is wrong after the %s edit" % edit)
+            return False
+
+    return True
+
+# Sends requests straight to the service of the assembler daemon. A request including a binary file with .incbin must
+# be rejected, as clients mustn't be able to read files through the daemon. Returns whether the tests passed.
+def service_tests():
+    from asm_int_types import IntTypeRegistry
+    from asm_server import AssemblerService
+
+    int_type_registry = IntTypeRegistry()
+    int_type_registry.load_plugins()
+    service = AssemblerService(int_type_registry)
+
+    reply = service.handle_request({"spec": "test/test_x86_spec.txt", "source": "push eax\nret\n"})
+    if not reply["ok"]:
+        print("TEST FAILED: Assembler daemon failed to assemble a request: %s" % reply["errors"])
+        return False
+
+    reply = service.handle_request({"spec": "test/test_x86_spec.txt",
+                                    "source": "push eax\n.incbin test/test_data_blob.bin\n"})
+    if reply["ok"] or reply["errors"][0]["stage"] != "parse":
+        print("TEST FAILED: Assembler daemon accepted a request using .incbin")
+        return False
+
+    return True
+
+
 def main():
 
     if len(sys.argv) >= 2 and sys.argv[1] == '--without-disasm':
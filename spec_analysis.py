@@ -0,0 +1,122 @@
+from typing import Dict, List, Set
+
+from asm_grammar_spec import AsmGrammarSpec, TokenTypes
+
+# This module implements static analysis of the instruction definitions of a spec. It works out which rows of a
+# definition can never match the same input, so that the order in which the parser tries them makes no difference to
+# which row matches first. This is used to decide which rows may safely be reordered.
+#
+# The analysis is based on the literal text each row must start with. The parser matches raw tokens exactly, against the
+# lowercased input, so a row starting with the raw tokens 'mov' and ' ' can only match input starting with 'mov'
+# followed by whitespace. Rows starting with a placeholder start with whatever the rows of the placeholder's definition
+# start with. Rows starting with an int or label (or with nothing at all) could start with anything. Two rows are
+# disjoint if every prefix one of them can start with is incompatible with every prefix the other can start with, i.e.
+# neither is a prefix of the other.
+
+# Stands for a run of one or more whitespace characters in a prefix.
+WHITESPACE_MARK = " "
+
+
+# Returns the set of literal prefixes the input must start with for the given definition to match. An empty string in
+# the set means the definition may match input starting with anything.
+def get_definition_prefixes(spec: AsmGrammarSpec, defn_name, cache: Dict[str, Set[str]] = None,
+                            in_progress: Set[str] = None) -> Set[str]:
+    if cache is None:
+        cache = {}
+    if in_progress is None:
+        in_progress = set()
+
+    if defn_name in cache:
+        return cache[defn_name]
+    if defn_name in in_progress or defn_name not in spec.spec:
+        # Recursive (or unknown) definitions could start with anything.
+        return {""}
+
+    in_progress.add(defn_name)
+    prefixes = set()
+    for pattern in spec.spec[defn_name].spec_patterns:
+        prefixes |= get_row_prefixes(spec, pattern.token_patterns, cache, in_progress)
+    in_progress.remove(defn_name)
+
+    cache[defn_name] = prefixes
+    return prefixes
+
+
+# Returns the set of literal prefixes the input must start with for a row with the given token pattern to match.
+def get_row_prefixes(spec: AsmGrammarSpec, token_patterns, cache: Dict[str, Set[str]],
+                     in_progress: Set[str]) -> Set[str]:
+    literal = ""
+    for token_type, token_value in token_patterns:
+        if token_type == TokenTypes.RAW_TOKEN:
+            literal += token_value.lower()
+        elif token_type == TokenTypes.LITERAL:
+            if " " in token_value:
+                return {literal + token_value[:token_value.index(" ")].lower() + WHITESPACE_MARK}
+            literal += token_value.lower()
+        elif token_type == TokenTypes.WHITESPACE:
+            # The parser skips the whole run of whitespace, so nothing more can be said about the following characters.
+            return {literal + WHITESPACE_MARK}
+        elif token_type == TokenTypes.PLACEHOLDER and len(literal) == 0:
+            return get_definition_prefixes(spec, token_value, cache, in_progress)
+        else:
+            return {literal}
+
+    return {literal}
+
+
+def are_prefixes_compatible(a: str, b: str) -> bool:
+    return a.startswith(b) or b.startswith(a)
+
+
+# Works out which rows of the definitions of a spec can match the same input.
+class RowConflicts:
+
+    def __init__(self, spec: AsmGrammarSpec):
+        self.spec = spec
+        self.prefix_cache = {}      # type: Dict[str, Set[str]]
+        self.conflicts = {}         # type: Dict[str, List[Set[int]]]
+        return
+
+    # Returns, for each row of a definition, the set of other rows which may match the same input as it. The relative
+    # order of two conflicting rows must be kept, any other rows may be freely reordered.
+    def get_conflicts(self, defn_name) -> List[Set[int]]:
+        if defn_name in self.conflicts:
+            return self.conflicts[defn_name]
+
+        patterns = self.spec.spec[defn_name].spec_patterns
+        row_prefixes = [get_row_prefixes(self.spec, p.token_patterns, self.prefix_cache, set()) for p in patterns]
+
+        conflicts = [set() for _ in patterns]
+        for a in range(len(patterns)):
+            for b in range(a + 1, len(patterns)):
+                if any(are_prefixes_compatible(pa, pb) for pa in row_prefixes[a] for pb in row_prefixes[b]):
+                    conflicts[a].add(b)
+                    conflicts[b].add(a)
+
+        self.conflicts[defn_name] = conflicts
+        return conflicts
+
+    # True if at least two rows of the definition can be reordered.
+    def is_reorderable(self, defn_name) -> bool:
+        conflicts = self.get_conflicts(defn_name)
+        return any(len(c) < len(conflicts) - 1 for c in conflicts)
+
+    # Returns the order of rows closest to the given priorities (highest first) which keeps the relative order of every
+    # pair of conflicting rows. Rows are taken greedily: at each step the highest priority row whose conflicting rows
+    # from earlier in the spec have all been taken already. Ties are broken by the order of rows in the spec.
+    def get_constrained_order(self, defn_name, priorities: List[int]) -> List[int]:
+        conflicts = self.get_conflicts(defn_name)
+        remaining = list(range(len(conflicts)))
+        order = []
+
+        while len(remaining) > 0:
+            best = None
+            for row in remaining:
+                if any(other < row for other in conflicts[row] if other in remaining):
+                    continue
+                if best is None or priorities[row] > priorities[best]:
+                    best = row
+            order.append(best)
+            remaining.remove(best)
+
+        return order
@@ -0,0 +1,158 @@
+from typing import Dict, List, Set
+
+from asm_grammar_spec import AsmGrammarSpec, DefinitionPattern, TokenTypes
+
+# This module implements the spec optimizer, which rewrites the instruction definitions of a validated spec into an
+# equivalent form that is cheaper to parse. It is run by AsmGrammarSpec after validation when enabled with
+# '--optimize-spec'. The optimizer never changes which lines a spec accepts or the machine code they assemble to, only
+# the shape of the AST and the wording of parse error messages, which is why it is opt-in: the merged literals and
+# inlined definitions change how deep the parser gets on a bad line, so errors can name a different position and
+# expected token than they do for the spec as written.
+#
+# It runs three passes:
+#   - Inlining. A placeholder for a definition with a single row, no bitfield modifiers and no int or label tokens is
+#       replaced by the tokens of that row. Matching the row in place is equivalent to matching it through the
+#       placeholder, as the definition has no other rows to fall back on and contributes no bitfields of its own. This
+#       also flattens chains of definitions which only forward to another placeholder (%A% -> %B% -> %C%).
+#   - Dead definition removal. Definitions which can no longer be reached from INSTRUCTION are removed.
+#   - Literal merging. Each run of adjacent raw tokens and whitespace tokens in a row is merged into a single LITERAL
+#       token, which the parser matches in one step instead of character by character.
+
+# Name of the definition every line of assembly code is parsed as.
+ROOT_DEFINITION = "INSTRUCTION"
+
+
+# Returns the names of the definitions which are placeholders in any row of the given definition.
+def get_referenced_definitions(spec: AsmGrammarSpec, defn_name) -> List[str]:
+    names = []
+    for pattern in spec.spec[defn_name].spec_patterns:
+        for token_type, token_value in pattern.token_patterns:
+            if token_type == TokenTypes.PLACEHOLDER and token_value not in names:
+                names.append(token_value)
+    return names
+
+
+# Returns the names of all definitions which can be reached from the given definition, including itself.
+def get_reachable_definitions(spec: AsmGrammarSpec, defn_name) -> Set[str]:
+    reachable = {defn_name}
+    pending = [defn_name]
+    while len(pending) > 0:
+        for name in get_referenced_definitions(spec, pending.pop()):
+            if name not in reachable:
+                reachable.add(name)
+                pending.append(name)
+    return reachable
+
+
+# Returns the names of all definitions which can reach themselves through placeholders.
+def get_recursive_definitions(spec: AsmGrammarSpec) -> Set[str]:
+    recursive = set()
+    for defn_name in spec.spec.keys():
+        for name in get_referenced_definitions(spec, defn_name):
+            if defn_name in get_reachable_definitions(spec, name):
+                recursive.add(defn_name)
+                break
+    return recursive
+
+
+# Runs all passes of the optimizer on the spec, modifying it in place.
+# inlined - number of placeholders replaced by the row of their definition
+# removed - number of unreachable definitions removed
+# merged - number of raw and whitespace tokens merged into literals
+class SpecOptimizer:
+
+    def __init__(self, spec: AsmGrammarSpec):
+        self.spec = spec
+        self.inlined = 0
+        self.removed = 0
+        self.merged = 0
+        return
+
+    def optimize(self):
+        self.inline_definitions()
+        self.remove_unreachable_definitions()
+        self.merge_literals()
+        return
+
+    def is_inlinable(self, defn_name, recursive_defns: Set[str]) -> bool:
+        if defn_name == ROOT_DEFINITION or defn_name in recursive_defns:
+            return False
+
+        patterns = self.spec.spec[defn_name].spec_patterns
+        if len(patterns) != 1 or len(patterns[0].bitfield_modifiers) > 0 or len(patterns[0].token_patterns) == 0:
+            return False
+
+        # The int and label tokens of a row are looked up by the bitfield modifiers of the row they are in, so moving
+        # them into another row could change which bitfield modifiers they are assigned to.
+        for token_type, token_value in patterns[0].token_patterns:
+            if token_type == TokenTypes.INT_TOKEN or token_type == TokenTypes.LABEL_TOKEN:
+                return False
+
+        return True
+
+    def inline_definitions(self):
+        recursive_defns = get_recursive_definitions(self.spec)
+        inlinable = {name for name in self.spec.spec.keys() if self.is_inlinable(name, recursive_defns)}
+
+        # Fully expanded tokens of each inlinable definition. None of them are recursive, so the expansion ends.
+        expanded = {}       # type: Dict[str, list]
+
+        def expand(token_patterns):
+            result = []
+            for token in token_patterns:
+                if token[0] == TokenTypes.PLACEHOLDER and token[1] in inlinable:
+                    if token[1] not in expanded:
+                        expanded[token[1]] = expand(self.spec.spec[token[1]].spec_patterns[0].token_patterns)
+                    result.extend(expanded[token[1]])
+                    self.inlined += 1
+                else:
+                    result.append(token)
+            return result
+
+        for defn in self.spec.spec.values():
+            for row, pattern in enumerate(defn.spec_patterns):
+                if not any(t[0] == TokenTypes.PLACEHOLDER and t[1] in inlinable for t in pattern.token_patterns):
+                    continue
+                defn.spec_patterns[row] = DefinitionPattern(expand(pattern.token_patterns), pattern.bitfield_modifiers,
+                                                            pattern.line_num, pattern.text)
+            defn.only_raw_values = not any(t[0] == TokenTypes.PLACEHOLDER
+                                           for p in defn.spec_patterns for t in p.token_patterns)
+        return
+
+    def remove_unreachable_definitions(self):
+        reachable = get_reachable_definitions(self.spec, ROOT_DEFINITION)
+        for defn_name in list(self.spec.spec.keys()):
+            if defn_name not in reachable:
+                del self.spec.spec[defn_name]
+                self.removed += 1
+        return
+
+    def merge_literals(self):
+        for defn in self.spec.spec.values():
+            for pattern in defn.spec_patterns:
+                pattern.token_patterns = self.merge_row_literals(pattern.token_patterns)
+        return
+
+    # Merges each run of raw and whitespace tokens containing at least one raw token into a LITERAL token. The value of
+    # a literal is the text of the raw tokens, with a single space standing for each whitespace token.
+    def merge_row_literals(self, token_patterns):
+        result = []
+        run = []
+
+        def end_run():
+            if any(t[0] == TokenTypes.RAW_TOKEN for t in run):
+                result.append((TokenTypes.LITERAL, "".join(t[1] if t[0] == TokenTypes.RAW_TOKEN else " " for t in run)))
+                self.merged += len(run)
+            else:
+                result.extend(run)
+            run.clear()
+
+        for token in token_patterns:
+            if token[0] == TokenTypes.RAW_TOKEN or token[0] == TokenTypes.WHITESPACE:
+                run.append(token)
+            else:
+                end_run()
+                result.append(token)
+        end_run()
+
+        return result
@@ -0,0 +1,110 @@
+import builtins
+import sys
+import time
+from contextlib import contextmanager
+
+# This module implements the '--startup-report' option of main.py. When installed, it wraps the import machinery and
+# times the first import of every module, which includes running the module's top level code. main.py also times each
+# phase of the run (loading plugins, reading the spec, etc). At the end of the run, both are printed as a report,
+# which shows where the time of a short run goes.
+#
+# The report has to be installed before the modules it should time are imported, so main.py installs it before its
+# own imports. Only 'import x' and 'from x import y' statements are timed. Submodules imported implicitly by a
+# 'from package import submodule' statement are counted towards the importing module.
+
+# Imports which took less than this many milliseconds are not listed individually in the report.
+REPORT_THRESHOLD_MS = 1.0
+
+# Report of the current run. None if the report isn't enabled.
+current_report = None  # type: StartupReport
+
+
+# Records the import time of each module, and the duration of each phase of the run.
+class StartupReport:
+
+    def __init__(self):
+        self.start_ns = time.perf_counter_ns()
+        self.imports = []           # list of [module, imported by, self ns, cumulative ns, nesting depth]
+        self.phases = []            # list of (phase, ns)
+        self.import_stack = []      # records of the imports in progress
+        self.original_import = builtins.__import__
+        return
+
+    def timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        module_name = name
+        if level > 0 and globals is not None:
+            package = globals.get("__package__") or ""
+            module_name = package.rsplit(".", level - 1)[0] + "." + name if len(name) > 0 else package
+
+        if module_name in sys.modules:
+            return self.original_import(name, globals, locals, fromlist, level)
+
+        parent = self.import_stack[-1] if len(self.import_stack) > 0 else None
+        importer = globals.get("__name__", "?") if globals is not None else "?"
+        record = [module_name, importer, 0, 0, len(self.import_stack)]
+        self.imports.append(record)
+        self.import_stack.append(record)
+
+        start = time.perf_counter_ns()
+        try:
+            return self.original_import(name, globals, locals, fromlist, level)
+        finally:
+            duration = time.perf_counter_ns() - start
+            self.import_stack.pop()
+            record[3] = duration
+            record[2] += duration
+            if parent is not None:
+                parent[2] -= duration
+
+    @contextmanager
+    def time_phase(self, phase_name):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.phases.append((phase_name, time.perf_counter_ns() - start))
+
+    def print_report(self):
+        total_ns = time.perf_counter_ns() - self.start_ns
+        imports_ns = sum(r[3] for r in self.imports if r[4] == 0)
+
+        # Imported after the timings are taken, so the report doesn't time itself.
+        from tabulate import tabulate
+
+        rows = [[r[0], r[1], r[2] / 1e6, r[3] / 1e6] for r in sorted(self.imports, key=lambda r: -r[3])
+                if r[3] / 1e6 >= REPORT_THRESHOLD_MS]
+        print(tabulate(rows, headers=["module", "imported by", "self ms", "cumulative ms"], floatfmt=".2f"))
+        print("")
+
+        # Imports made during a phase are also counted in the time of that phase.
+        rows = [["all imports", imports_ns / 1e6]]
+        rows.extend([phase_name, ns / 1e6] for phase_name, ns in self.phases)
+        rows.append(["total", total_ns / 1e6])
+        print(tabulate(rows, headers=["phase", "ms"], floatfmt=".2f"))
+        return
+
+
+# Starts recording the startup report. Should be called before the modules to be timed are imported.
+def install():
+    global current_report
+
+    current_report = StartupReport()
+    builtins.__import__ = current_report.timed_import
+    return
+
+
+# Stops recording imports, and prints the report.
+def print_report():
+    builtins.__import__ = current_report.original_import
+    current_report.print_report()
+    return
+
+
+# Times a phase of the run. Does nothing if the report isn't enabled.
+@contextmanager
+def phase(phase_name):
+    if current_report is None:
+        yield
+        return
+    with current_report.time_phase(phase_name):
+        yield
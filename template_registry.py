@@ -0,0 +1,141 @@
+import io
+import os
+from typing import Dict, Optional, Tuple
+
+# This module implements the template registry, which keeps object templates (see obj_writer.py) loaded in memory. The
+# assembler daemon and batch mode inject machine code into the same few templates over and over, so instead of checking
+# for the template, reading and parsing its .info file and reading the whole template for every object, the registry
+# does this once per template. On creation it indexes every template in the bin_templates folder, other templates are
+# loaded the first time they are used. A template is reloaded if the modification time of the template or its .info
+# file changes.
+
+# Folder holding the object templates which ship with the generic assembler.
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin_templates")
+
+# Extension of the file next to each template which describes its code cave.
+INFO_EXTENSION = ".info"
+
+
+# An object template, and the code cave described by its .info file.
+# path - path of the template object file
+# offset - offset of the code cave in the template
+# size - size of the code cave
+# data - bytes of the template. None if they weren't read.
+# mtimes - modification times of the template and its .info file when they were read
+class ObjectTemplate:
+
+    def __init__(self, path, offset: int, size: int, data: Optional[bytes], mtimes: Tuple[float, float]):
+        self.path = path
+        self.offset = offset
+        self.size = size
+        self.data = data
+        self.mtimes = mtimes
+        return
+
+
+# Checks that a template object file and its .info file exist, and returns the modification times of both. Errors are
+# printed to output, or to the console if it's None.
+def get_template_mtimes(template_file, output=None) -> Tuple[float, float]:
+    if not os.path.isfile(template_file):
+        print("Object Writer Error: Binary template file at %s does not exist." % template_file, file=output)
+        raise ValueError
+
+    info_file_path = template_file + INFO_EXTENSION
+    if not os.path.isfile(info_file_path):
+        print("Object Writer Error: Info file for binary template %s does not exist." % info_file_path, file=output)
+        raise ValueError
+
+    return os.path.getmtime(template_file), os.path.getmtime(info_file_path)
+
+
+# Reads a template object file and its .info file.
+# read_data - also read the bytes of the template
+# output - text stream which error messages are printed to. None prints them to the console.
+def read_template(template_file, read_data=True, output=None) -> ObjectTemplate:
+    mtimes = get_template_mtimes(template_file, output)
+    offset, size = read_template_info(template_file + INFO_EXTENSION, output)
+
+    data = None
+    if read_data:
+        with open(template_file, "rb") as bin_file:
+            data = bin_file.read()
+
+    return ObjectTemplate(template_file, offset, size, data, mtimes)
+
+
+# Reads .info file of an object template file. First line will specify offset of code cave where assembled machine
+# code should be injected, second line will specify size of code cave. Size of machine code should not exceed size
+# of code cave. Errors are printed to output, or to the console if it's None.
+def read_template_info(info_file_path, output=None):
+    with open(info_file_path, "r") as info_file:
+        lines = info_file.readlines()
+
+    if len(lines) != 2:
+        print("Object Writer Error: Info file %s should only have two lines. First line should be offset where binary blob will be inserted. Second line should be maximum size of binary blob." % info_file_path, file=output)
+        raise ValueError
+
+    lines = [l.strip() for l in lines]
+
+    try:
+        if lines[0].startswith("0x"):
+            offset = int(lines[0], 16)
+        else:
+            offset = int(lines[0], 10)
+    except ValueError:
+        print("Object Writer Error: Unable to parse offset int %s in info file %s" % (lines[0], info_file_path), file=output)
+        raise ValueError
+
+    try:
+        if lines[1].startswith("0x"):
+            size = int(lines[1], 16)
+        else:
+            size = int(lines[1], 10)
+    except ValueError:
+        print("Object Writer Error: Unable to parse size int %s in info file %s" % (lines[1], info_file_path), file=output)
+        raise ValueError
+
+    return offset, size
+
+
+# Keeps object templates loaded in memory, keyed by their absolute path.
+# template_dirs - folders whose templates are loaded up front. Defaults to the bin_templates folder.
+class TemplateRegistry:
+
+    def __init__(self, template_dirs=None):
+        self.templates = {}  # type: Dict[str, ObjectTemplate]
+
+        if template_dirs is None:
+            template_dirs = [TEMPLATES_DIR]
+        for template_dir in template_dirs:
+            self.index(template_dir)
+        return
+
+    # Loads every template in a folder and its subfolders. A template is any file with a .info file next to it.
+    # Templates which fail to load are skipped here, and report their error when they are used.
+    def index(self, template_dir):
+        for dir_path, dir_names, file_names in os.walk(template_dir):
+            for file_name in file_names:
+                if not file_name.endswith(INFO_EXTENSION):
+                    continue
+                template_file = os.path.join(dir_path, file_name[:-len(INFO_EXTENSION)])
+                if not os.path.isfile(template_file):
+                    continue
+                try:
+                    self.get_template(template_file, output=io.StringIO())
+                except (ValueError, OSError):
+                    continue
+        return
+
+    # Returns a template, loading it if it isn't loaded yet or if it changed since it was loaded. Errors are printed to
+    # output, or to the console if it's None.
+    def get_template(self, template_file, output=None) -> ObjectTemplate:
+        template_file = os.path.abspath(template_file)
+        mtimes = get_template_mtimes(template_file, output)
+
+        template = self.templates.get(template_file)
+        if template is not None and template.mtimes == mtimes:
+            return template
+
+        template = read_template(template_file, output=output)
+        self.templates[template_file] = template
+        return template